@@ -8,6 +8,7 @@ import traceback
 from typing import Dict
 
 from modules import Encoder, Recorder, Generator, Notifier, Cleaner
+from modules.encoder import EncoderWorker
 
 LOOP = asyncio.get_event_loop()
 
@@ -52,18 +53,32 @@ def run_cleaner(args: argparse.Namespace):
 
 def run_encoder(args: argparse.Namespace):
     env_map = {
+        "chunk_parallel": "ENC_CHUNK_PARALLEL",
+        "chunk_segments": "ENC_CHUNK_SEGMENTS",
         "clean_days": None,
+        "coordinator": None,
         "copy_pattern": None,
         "copy_pattern_opt": None,
+        "copy_slots": "ENC_COPY_SLOTS",
+        "cpus": "ENC_CPUS",
+        "disk_reserve": "ENC_DISK_RESERVE",
+        "drain_seconds": "ENC_DRAIN_SECONDS",
         "dry_run": None,
         "enable_cleaner": None,
+        "hash_output": None,
         "hevc_pattern": None,
         "hevc_pattern_opt": None,
+        "hevc_slots": "ENC_HEVC_SLOTS",
+        "ingest": None,
+        "ingest_settle": "ENC_INGEST_SETTLE",
+        "lease_seconds": "ENC_LEASE_SECONDS",
         "listen_address": "ENC_LISTEN_ADDRESS",
+        "nice": "ENC_NICE",
         "no_notifications": None,
         "out_path": "ENC_OUT",
         "print_every": None,
         "src_path": "ENC_SRC",
+        "target_latency": "ENC_TARGET_LATENCY",
         "time_format": "TIME_FORMAT",
         "warn_at": None,
         "webhook_url": "WEBHOOK_URL",
@@ -73,6 +88,24 @@ def run_encoder(args: argparse.Namespace):
     inst.run_app()
 
 
+def run_encoder_worker(args: argparse.Namespace):
+    env_map = {
+        "chunk_parallel": "ENC_CHUNK_PARALLEL",
+        "codecs": None,
+        "coordinator_url": "ENC_COORDINATOR_URL",
+        "cpus": "ENC_CPUS",
+        "dry_run": None,
+        "name": "ENC_WORKER_NAME",
+        "nice": "ENC_NICE",
+        "poll_interval": None,
+        "print_every": None,
+        "src_path": "ENC_SRC",
+    }
+    kwargs = merge_env_args(env_map, args)
+    inst = EncoderWorker(LOOP, **kwargs)
+    LOOP.run_until_complete(inst.run())
+
+
 def run_generator(args: argparse.Namespace):
     env_map = {
         "out_path": "GEN_DST",
@@ -133,10 +166,24 @@ def run_notifier(args: argparse.Namespace):
 
 def run_recorder(args: argparse.Namespace):
     env_map = {
+        "cache_file": "REC_CACHE_FILE",
+        "cache_ttl": "REC_CACHE_TTL",
         "dry_run": None,
         "enc_path": "ENC_PATH",
+        "eventsub_address": "REC_EVENTSUB_ADDRESS",
+        "eventsub_secret": "REC_EVENTSUB_SECRET",
+        "fast_timeout": "REC_FAST_TIMEOUT",
+        "history_file": "REC_HISTORY_FILE",
+        "keep_raw": None,
+        "max_restarts": "REC_MAX_RESTARTS",
+        "max_timeout": "REC_MAX_TIMEOUT",
         "no_notifications": None,
         "out_path": "REC_OUT",
+        "remux": None,
+        "safety_timeout": "REC_SAFETY_TIMEOUT",
+        "segment_seconds": "REC_SEGMENT_SECONDS",
+        "stall_rate": "REC_STALL_RATE",
+        "stall_seconds": "REC_STALL_SECONDS",
         "time_format": "TIME_FORMAT",
         "timeout": "REC_TIMEOUT",
         "twitch_id": "REC_TWITCH_ID",
@@ -184,15 +231,41 @@ parser_cln.set_defaults(func=run_cleaner)
 parser_enc = subparsers.add_parser('encoder', help='Start encoder REST API server')
 parser_enc.add_argument('-i', '--src_path', type=str, help='Source file location')
 parser_enc.add_argument('-o', '--out_path', type=str, help='Processed file location')
+parser_enc.add_argument('--chunk_parallel', type=int, required=False, help='Number of HEVC segments to encode concurrently')
+parser_enc.add_argument('--chunk_segments', type=int, required=False, help='Split HEVC jobs into this many segments, 0 to disable')
+parser_enc.add_argument('--coordinator', action='store_true', help='Lease queued jobs to encoder-worker processes')
 parser_enc.add_argument('--copy_pattern', type=str, required=False, help='Regex pattern for copying files')
 parser_enc.add_argument('--copy_pattern_opt', type=str, action='append', help='Python Regex compile options, case sensitive')
+parser_enc.add_argument('--copy_slots', type=int, required=False, help='Number of copy jobs to run concurrently')
+parser_enc.add_argument('--cpus', type=str, required=False, help='CPU list for ffmpeg, like 0-7,16-23 (default all)')
+parser_enc.add_argument('--disk_reserve', type=float, required=False, help='GB to keep free, jobs that would use it are deferred')
+parser_enc.add_argument('--drain_seconds', type=float, required=False, help='On SIGTERM, seconds running jobs get to finish before they are interrupted and resumed after restart')
 parser_enc.add_argument('--enable_cleaner', action='store_true', help='Delete old files not included in processing pattern')
+parser_enc.add_argument('--hash_output', action='store_true', help='Record the SHA-256 of outputs copied to another filesystem')
 parser_enc.add_argument('--hevc_pattern', type=str, required=False, help='Regex pattern for HEVC transcoding, takes precedence')
 parser_enc.add_argument('--hevc_pattern_opt', type=str, action='append', help='Python Regex compile options, case sensitive')
+parser_enc.add_argument('--hevc_slots', type=int, required=False, help='Number of HEVC jobs to run concurrently')
+parser_enc.add_argument('--ingest', action='store_true', help='Queue raw files in the source location nobody submitted')
+parser_enc.add_argument('--ingest_settle', type=float, required=False, help='Seconds a raw file must be unchanged before it is ingested')
+parser_enc.add_argument('--lease_seconds', type=int, required=False, help='Re-queue jobs of workers silent for this long')
 parser_enc.add_argument('--listen_address', type=str, required=False, help='Absolute path (socket) or IP:PORT')
+parser_enc.add_argument('--nice', type=int, required=False, help='Niceness of ffmpeg processes (default 10)')
 parser_enc.add_argument('--print_every', action='store_true', help='Print progress after encoding X seconds')
+parser_enc.add_argument('--target_latency', type=float, required=False, help='Pick x265 presets to drain the HEVC backlog within this many hours')
 parser_enc.set_defaults(func=run_encoder)
 
+parser_wrk = subparsers.add_parser('encoder-worker', help='Encode jobs leased from an encoder started with --coordinator')
+parser_wrk.add_argument('-c', '--coordinator_url', type=str, required=False, help='URL or absolute socket path of the coordinator')
+parser_wrk.add_argument('-i', '--src_path', type=str, help='Source file location, shared with the coordinator')
+parser_wrk.add_argument('--chunk_parallel', type=int, required=False, help='Number of HEVC segments to encode concurrently')
+parser_wrk.add_argument('--codecs', type=str, action='append', help='Codecs to lease, in order of preference (default hevc)')
+parser_wrk.add_argument('--cpus', type=str, required=False, help='CPU list for ffmpeg, like 0-7,16-23 (default all)')
+parser_wrk.add_argument('--name', type=str, required=False, help='Worker name, defaults to hostname-PID')
+parser_wrk.add_argument('--nice', type=int, required=False, help='Niceness of ffmpeg processes (default 10)')
+parser_wrk.add_argument('--poll_interval', type=float, required=False, help='Seconds between lease attempts when idle')
+parser_wrk.add_argument('--print_every', action='store_true', help='Print progress after encoding X seconds')
+parser_wrk.set_defaults(func=run_encoder_worker)
+
 parser_gen = subparsers.add_parser('generator', help='Start UUID generator')
 parser_gen.add_argument('-i', '--src', type=str, action='append', help='Source path, formatted as [<type>]<path>')
 parser_gen.add_argument('-o', '--out_path', type=str, required=False, help='Path where symlinks are placed')
@@ -205,11 +278,35 @@ parser_not.add_argument('-m', '--mention-id', type=str, help='User ID to mention
 parser_not.set_defaults(func=run_notifier)
 
 parser_rec = subparsers.add_parser('recorder', help='Start Twitch recorder')
-parser_rec.add_argument('-u', '--user', type=str, required=False, help='User to record')
+parser_rec.add_argument('-u', '--user', type=str, action='append', required=False,
+                        help='User to record, repeat or comma separate for several')
 parser_rec.add_argument('-tid', '--twitch_id', type=str, required=False, help='Twitch API Client-ID')
-parser_rec.add_argument('-t', '--timeout', type=int, required=False, help='Time between live checks')
+parser_rec.add_argument('-t', '--timeout', type=int, required=False,
+                        help='Time between live checks, the first one outside usual start windows')
+parser_rec.add_argument('--fast_timeout', type=int, required=False,
+                        help='Time between live checks in windows a channel usually goes live in')
+parser_rec.add_argument('--max_timeout', type=int, required=False,
+                        help='Most time between live checks outside those windows')
 parser_rec.add_argument('-o', '--out_path', type=str, required=False, help='Output directory of raw recordings')
 parser_rec.add_argument('-e', '--enc_path', type=str, required=False, help='Path/URL to encoder API')
+parser_rec.add_argument('--remux', action='store_true', default=False,
+                        help='Remux to MP4 while recording, copy jobs then need no encode. '
+                             'Only the raw copy of --keep_raw gets a keyframe index')
+parser_rec.add_argument('--keep_raw', action='store_true', default=False,
+                        help='Also keep the raw FLV when remuxing, deleted by the encoder once the MP4 is checked')
+parser_rec.add_argument('--segment_seconds', type=int, required=False,
+                        help='Record parts of this many seconds, the encoder encodes them while the stream continues')
+parser_rec.add_argument('--stall_seconds', type=int, required=False,
+                        help='Restart streamlink when the recording grew slower than --stall_rate for this long')
+parser_rec.add_argument('--stall_rate', type=int, required=False, help='Slowest recording rate in bytes/s')
+parser_rec.add_argument('--max_restarts', type=int, required=False,
+                        help='Most streamlink restarts per recording, the pieces are joined by the encoder')
+parser_rec.add_argument('--eventsub_secret', type=str, required=False,
+                        help='Receive EventSub stream.online/offline notifications signed with this secret')
+parser_rec.add_argument('--eventsub_address', type=str, required=False,
+                        help='host:port or socket path the EventSub receiver listens on')
+parser_rec.add_argument('--safety_timeout', type=int, required=False,
+                        help='Time between live checks when EventSub is used')
 parser_rec.set_defaults(func=run_recorder)
 
 
@@ -1,5 +1,6 @@
 from .notifier import Notifier
 from .cleaner import Cleaner
+from .keyframe_index import KeyframeIndex, KeyframeIndexer
 from .intro_trimmer import IntroTrimmer
 from .encoder import Encoder
 from .recorder import Recorder
@@ -7,6 +7,7 @@ from typing import List, Tuple, Dict, Optional
 from discord import Embed
 
 from utils import get_datetime, setup_logger, human_timedelta, fmt_plural_str
+from .keyframe_index import remove_sidecar
 from .notifier import Notifier
 
 NAME = 'Twitch Cleaner'
@@ -203,6 +204,7 @@ class Cleaner:
             try:
                 if not self.dry_run:
                     os.unlink(os.path.join(self.check_path, k))
+                    remove_sidecar(os.path.join(self.check_path, k))
                 del_list.append(f"- \"{name}\"")
             except Exception as e:
                 self.blacklist.append(k)
@@ -259,7 +261,7 @@ class Cleaner:
             return f"{fmt_plural_str(len(warn_list))} to be deleted:\n" + "\n".join(warn_list)
         return ""
 
-    def get_files(self, check_ext: Tuple[str] = (".flv",)) -> List[str]:
+    def get_files(self, check_ext: Tuple[str, ...] = (".flv", ".mp4")) -> List[str]:
         check_files = []
         for f in os.listdir(self.check_path):
             if f in self.blacklist:
@@ -1,3 +1,15 @@
+from .chunked import ChunkedEncode
+from .cpu import CpuAllocator, CpuTopology
+from .disk_space import DiskAdmission, SizeModel
+from .ingest import Ingester
 from .job import Job
+from .job_index import JobIndex
+from .job_store import JobStore
+from .metrics import EncoderMetrics
+from .policy import PresetPolicy
+from .progress import Progress
 from .response import Response
+from .scheduler import Deferred, Scheduler
+from .transfer import FileTransfer
 from .encoder import Encoder
+from .worker import EncoderWorker
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+from typing import Callable, Dict, List, Optional
+
+from .cpu import CpuAllocator
+
+from utils import parse_duration, run_ffmpeg
+
+"""
+### Split at keyframes, encode segments, concat
+ffmpeg -i ${IN} -map 0 -c copy -f segment -segment_time 1800 -segment_format matroska -reset_timestamps 1 seg_%03d.mkv
+ffmpeg -i seg_000.mkv -c:v libx265 -x265-params crf=23:pools=4 -preset:v fast -c:a copy enc_000.mkv
+ffmpeg -f concat -safe 0 -i list.txt -map 0 -c:v copy -c:a aac ${OUT}
+"""
+
+
+def replace_opt(args: list, opt: str, value: str) -> list:
+    """Returns copy of ffmpeg args with the value of opt replaced"""
+    ret = args.copy()
+    if opt in ret:
+        ret[ret.index(opt) + 1] = value
+    return ret
+
+
+def get_opt(args: list, opt: str, default: str = None) -> Optional[str]:
+    if opt in args:
+        return args[args.index(opt) + 1]
+    return default
+
+
+def fmt_seconds(seconds: float) -> str:
+    """Format as HH:MM:SS.MICROSECONDS, same as ffmpeg's out_time"""
+    m, s = divmod(seconds, 60)
+    h, m = divmod(int(m), 60)
+    return f'{h:02d}:{m:02d}:{s:09.6f}'
+
+
+class ChunkedEncode:
+    """
+    Segment-parallel encode of one file
+
+    The input is split at keyframes into segments without re-encoding, video is
+    encoded per segment with at most `parallel` ffmpeg processes and the results
+    are concatenated losslessly. Audio is copied per segment and encoded once
+    while concatenating, this avoids gaps from AAC priming at segment boundaries.
+    If the encode is cancelled the work directory is kept, a later run with the
+    same input and arguments only encodes the segments that were not finished.
+    """
+    out_flags = ['-v', 'warning', '-y', '-progress', '-', '-nostats', '-hide_banner']
+
+    def __init__(self, logger: logging.Logger, segments: int, parallel: int, print_every: int = 30,
+                 allocator: CpuAllocator = None):
+        self.logger = logger
+        self.segments: int = segments
+        self.parallel: int = max(parallel, 1)
+        self.print_every: int = print_every
+        self.allocator: Optional[CpuAllocator] = allocator
+
+    async def ffmpeg(self, codec: str, args: list, progress: Callable[[dict], None] = None):
+        """Segment encodes get their own CPUs, splitting and concatenating is only copying"""
+        if self.allocator:
+            await self.allocator.run(self.logger, codec, args, self.print_every, progress=progress)
+        else:
+            await run_ffmpeg(self.logger, args, self.print_every, progress=progress)
+
+    @staticmethod
+    def work_dir(tmp_out_fp: str) -> str:
+        """Directory holding segments while tmp_out_fp is being encoded"""
+        base, _ = os.path.splitext(tmp_out_fp)
+        return f'{base}_chunks'
+
+    def manifest(self, in_fp: str, enc_args: list, duration: float, start_seconds: Optional[int]) -> dict:
+        """Identifies the split, a work directory is only resumed if it matches"""
+        st = os.stat(in_fp)
+        return dict(input=os.path.abspath(in_fp), size=st.st_size, mtime_ns=st.st_mtime_ns, duration=duration,
+                    start_seconds=start_seconds, segments=self.segments, args=enc_args, done=[])
+
+    @staticmethod
+    def read_manifest(work_dir: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(work_dir, 'manifest.json'), 'r', encoding='utf-8') as fr:
+                return json.load(fr)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def write_manifest(work_dir: str, manifest: dict):
+        tmp_fp = os.path.join(work_dir, 'manifest.json.tmp')
+        with open(tmp_fp, 'w', encoding='utf-8') as fw:
+            json.dump(manifest, fw)
+        os.replace(tmp_fp, os.path.join(work_dir, 'manifest.json'))
+
+    def split_args(self, in_fp: str, work_dir: str, duration: float, start_seconds: int = None) -> list:
+        args = []
+        if start_seconds:
+            args += ['-ss', str(start_seconds)]
+        args += [
+            '-i', in_fp, '-map', '0', '-c', 'copy',
+            '-f', 'segment', '-segment_time', f'{duration / self.segments:.3f}',
+            '-segment_format', 'matroska', '-reset_timestamps', '1',
+        ]
+        args += self.out_flags
+        args.append(os.path.join(work_dir, 'seg_%03d.mkv'))
+        return args
+
+    async def run(self, in_fp: str, out_fp: str, enc_args: list, duration: float,
+                  start_seconds: int = None, progress: Callable[[dict], None] = None, codec: str = 'hevc'):
+        """
+        Encode in_fp to out_fp, enc_args are the codec arguments without input and output.
+        duration is the output duration in seconds, start_seconds are skipped from the input.
+        """
+        work_dir = self.work_dir(out_fp)
+        manifest = self.manifest(in_fp, enc_args, duration, start_seconds)
+        previous = self.read_manifest(work_dir)
+        resumed = bool(previous) and dict(previous, done=[]) == manifest
+        if resumed:
+            manifest = previous
+            self.logger.info('Resuming %s, %d segments already encoded', in_fp, len(manifest['done']))
+        else:
+            if os.path.exists(work_dir):
+                shutil.rmtree(work_dir)
+            os.mkdir(work_dir, 0o750)
+        keep = False
+        try:
+            if not resumed:
+                await self.ffmpeg('copy', self.split_args(in_fp, work_dir, duration, start_seconds))
+                self.write_manifest(work_dir, manifest)
+            segments = sorted(f for f in os.listdir(work_dir) if f.startswith('seg_'))
+            if not segments:
+                raise RuntimeError(f'No segments created from {in_fp}')
+            self.logger.info('Split %s into %d segments, encoding %d at a time', in_fp, len(segments), self.parallel)
+            seg_args = replace_opt(enc_args, '-c:a', 'copy')
+            samples: Dict[str, dict] = {}
+            sem = asyncio.Semaphore(self.parallel)
+
+            async def encode(seg: str) -> str:
+                enc_fp = os.path.join(work_dir, f'enc_{seg}')
+                if seg in manifest['done'] and os.path.exists(enc_fp):
+                    return enc_fp
+                args = ['-i', os.path.join(work_dir, seg)] + seg_args + [enc_fp]
+
+                def on_progress(sample: dict):
+                    samples[seg] = sample
+                    if progress:
+                        progress(self.combine(samples.values()))
+
+                async with sem:
+                    await self.ffmpeg(codec, args, progress=on_progress)
+                manifest['done'].append(seg)
+                self.write_manifest(work_dir, manifest)
+                # Finished segments only count towards output time
+                samples[seg] = dict(samples.get(seg, {}), fps='0', speed='0')
+                return enc_fp
+
+            # Let every segment finish before cleaning up, even if one fails
+            encoded: List[str] = await asyncio.gather(*(encode(seg) for seg in segments), return_exceptions=True)
+            for ret in encoded:
+                if isinstance(ret, BaseException):
+                    raise ret
+            await self.concat(encoded, out_fp, get_opt(enc_args, '-c:a', 'copy'), os.path.join(work_dir, 'list.txt'))
+        except asyncio.CancelledError:
+            keep = True
+            raise
+        finally:
+            if not keep:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    async def concat(self, files: List[str], out_fp: str, audio_codec: str = 'copy', list_fp: str = None):
+        """Losslessly concatenate video of files to out_fp, audio is encoded once with audio_codec"""
+        list_fp = list_fp or f'{os.path.splitext(out_fp)[0]}_list.txt'
+        with open(list_fp, 'w', encoding='utf-8') as fw:
+            for fp in files:
+                escaped = os.path.abspath(fp).replace("'", "'\\''")
+                fw.write(f"file '{escaped}'\n")
+        # No bitstream filters, a file cut off mid-packet would fail the whole concat
+        concat_args = [
+            '-f', 'concat', '-safe', '0', '-auto_convert', '0', '-i', list_fp, '-map', '0',
+            '-c:v', 'copy', '-c:a', audio_codec,
+        ]
+        await self.ffmpeg('copy', concat_args + self.out_flags + [out_fp])
+
+    @staticmethod
+    def combine(samples) -> dict:
+        """Sum progress samples of concurrently encoded segments"""
+        ret = dict(frame=0, fps=0.0, total_size=0, speed=0.0, out_time=0.0)
+        for s in samples:
+            try:
+                ret['frame'] += int(s.get('frame', 0))
+                ret['fps'] += float(s.get('fps', 0))
+                ret['total_size'] += int(s.get('total_size', 0))
+                if s.get('speed'):
+                    ret['speed'] += float(s['speed'])
+                if (td := parse_duration(s.get('out_time', ''))) is not None:
+                    ret['out_time'] += td.total_seconds()
+            except ValueError:
+                continue
+        ret['out_time'] = fmt_seconds(ret['out_time'])
+        return {k: str(v) for k, v in ret.items()}
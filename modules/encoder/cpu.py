@@ -0,0 +1,317 @@
+import logging
+import math
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+from utils import parse_duration, run_ffmpeg
+
+
+def parse_cpulist(text: str) -> List[int]:
+    """Parse a kernel CPU list like 0-3,8,10-11"""
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return sorted(set(cpus))
+
+
+def fmt_cpulist(cpus: List[int]) -> str:
+    """Inverse of parse_cpulist"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
+
+
+def read_file(fp: str) -> Optional[str]:
+    try:
+        with open(fp, 'r') as fr:
+            return fr.read().strip()
+    except OSError:
+        return None
+
+
+def frame_threads(threads: int) -> int:
+    """x265's own frame thread default for a pool of this many threads"""
+    for min_threads, frames in ((32, 6), (16, 5), (8, 3), (4, 2)):
+        if threads >= min_threads:
+            return frames
+    return 1
+
+
+class CpuTopology:
+    """
+    CPUs this process may use, their NUMA nodes and the cgroup CPU quota
+
+    ordered lists CPUs by node, package and core, so hyperthread siblings and
+    CPUs of one node are next to each other. usable is the number of CPUs the
+    quota allows, fractional if the quota is.
+    """
+    def __init__(self, cpus: List[int], nodes: Dict[int, List[int]] = None, cores: Dict[int, tuple] = None,
+                 quota: float = None):
+        self.cpus: List[int] = sorted(cpus)
+        # Node -> CPUs
+        self.nodes: Dict[int, List[int]] = nodes or {0: self.cpus}
+        # CPU -> (package, core)
+        self.cores: Dict[int, tuple] = cores or {}
+        # CPUs allowed by the cgroup, None if unlimited
+        self.quota: Optional[float] = quota
+        node_of = {cpu: node for node, node_cpus in self.nodes.items() for cpu in node_cpus}
+        self.ordered: List[int] = sorted(self.cpus, key=lambda c: (node_of.get(c, 0), self.cores.get(c, (0, c)), c))
+
+    @property
+    def usable(self) -> float:
+        if self.quota:
+            return min(len(self.cpus), self.quota)
+        return len(self.cpus)
+
+    @classmethod
+    def detect(cls, cpus: List[int] = None, sys_path: str = '/sys', cgroup_path: str = '/sys/fs/cgroup'):
+        """Read the topology from sysfs, cpus restricts it to a subset of the CPUs we are allowed to run on"""
+        if hasattr(os, 'sched_getaffinity'):
+            allowed = sorted(os.sched_getaffinity(0))
+        else:
+            allowed = list(range(os.cpu_count() or 1))
+        if cpus:
+            allowed = [c for c in allowed if c in set(cpus)] or allowed
+        nodes = {}
+        node_dir = os.path.join(sys_path, 'devices/system/node')
+        if os.path.isdir(node_dir):
+            for name in os.listdir(node_dir):
+                if name.startswith('node') and name[4:].isdigit():
+                    node_cpus = parse_cpulist(read_file(os.path.join(node_dir, name, 'cpulist')) or '')
+                    if node_cpus := [c for c in node_cpus if c in allowed]:
+                        nodes[int(name[4:])] = node_cpus
+        cores = {}
+        for cpu in allowed:
+            topo = os.path.join(sys_path, f'devices/system/cpu/cpu{cpu}/topology')
+            core, package = read_file(f'{topo}/core_id'), read_file(f'{topo}/physical_package_id')
+            if core is not None and package is not None:
+                cores[cpu] = (int(package), int(core))
+        return cls(allowed, nodes or None, cores, cls.read_quota(cgroup_path))
+
+    @staticmethod
+    def read_quota(cgroup_path: str) -> Optional[float]:
+        """CPUs allowed by the cgroup v2 cpu.max or v1 CFS quota, None if unlimited"""
+        if cpu_max := read_file(os.path.join(cgroup_path, 'cpu.max')):
+            quota, _, period = cpu_max.partition(' ')
+            if quota != 'max' and period:
+                return int(quota) / int(period)
+            return None
+        for v1 in ('cpu', 'cpu,cpuacct'):
+            quota = read_file(os.path.join(cgroup_path, v1, 'cpu.cfs_quota_us'))
+            period = read_file(os.path.join(cgroup_path, v1, 'cpu.cfs_period_us'))
+            if quota and period and int(quota) > 0:
+                return int(quota) / int(period)
+        return None
+
+    def __str__(self):
+        ret = f'{len(self.cpus)} CPUs ({fmt_cpulist(self.cpus)}) on {len(self.nodes)} NUMA node(s)'
+        if self.quota:
+            ret += f', cgroup quota {self.quota:g} CPUs'
+        return ret
+
+
+class Allocation:
+    """CPUs and threads given to one ffmpeg process"""
+    __slots__ = ('id', 'codec', 'cpus', 'threads', 'pid', 'start', 'out_time', 'sampled')
+
+    def __init__(self, codec: str):
+        self.id: str = uuid.uuid4().hex
+        self.codec: str = codec
+        self.cpus: List[int] = []
+        # Encoder threads, fixed once the process started
+        self.threads: int = 0
+        self.pid: Optional[int] = None
+        self.start: float = time.perf_counter()
+        # Seconds of video written so far and when they were reported
+        self.out_time: float = 0
+        self.sampled: float = self.start
+
+    @property
+    def speed(self) -> Optional[float]:
+        """Speed as of the last progress sample"""
+        elapsed = self.sampled - self.start
+        if elapsed <= 0 or not self.out_time:
+            return None
+        return self.out_time / elapsed
+
+    def to_dict(self) -> dict:
+        return dict(codec=self.codec, cpus=fmt_cpulist(self.cpus), threads=self.threads, pid=self.pid,
+                    speed=round(self.speed, 3) if self.speed else None)
+
+
+class CpuAllocator:
+    """
+    Splits CPUs between running ffmpeg processes
+
+    Every running x265 process gets its own slice of topology.ordered, slices
+    are rebalanced whenever a process starts or exits and applied to running
+    processes by changing the affinity of all their threads. x265 pools and
+    frame-threads are sized from the slice (and the cgroup quota) when a
+    process starts. Processes that only copy streams are not pinned. Everything
+    runs at nice, so the recorder and the rest of the host come first.
+    """
+    # Codecs that get their own CPUs, anything else shares all of them
+    pinned_codecs = ('hevc',)
+
+    def __init__(self, topology: CpuTopology, nice: int = 10, logger: logging.Logger = None,
+                 on_release: Callable[[Allocation], None] = None, alpha: float = 0.3):
+        self.topology: CpuTopology = topology
+        self.nice: int = nice
+        self.logger: logging.Logger = logger or logging.getLogger(self.__class__.__name__)
+        self.on_release = on_release
+        self.alpha: float = alpha
+        self.allocations: Dict[str, Allocation] = {}
+        # CPUs per process -> EWMA of encode speed
+        self.throughput: Dict[int, float] = {}
+        # Incremented whenever to_dict would change
+        self.version: int = 0
+
+    @contextmanager
+    def process(self, codec: str) -> Iterator[Allocation]:
+        """Allocate CPUs for one ffmpeg process for the duration of the with block"""
+        alloc = Allocation(codec)
+        self.allocations[alloc.id] = alloc
+        self.version += 1
+        self.rebalance()
+        pinned = [a for a in self.allocations.values() if a.codec in self.pinned_codecs]
+        if codec in self.pinned_codecs:
+            alloc.threads = max(1, min(len(alloc.cpus), math.floor(self.topology.usable / len(pinned))))
+        try:
+            yield alloc
+        except BaseException:
+            # Interrupted or failed processes say nothing about throughput
+            alloc.out_time = 0
+            raise
+        finally:
+            del self.allocations[alloc.id]
+            self.version += 1
+            self.release(alloc)
+            self.rebalance()
+
+    def release(self, alloc: Allocation):
+        speed = alloc.speed
+        if alloc.codec not in self.pinned_codecs or not speed:
+            return
+        n = len(alloc.cpus)
+        if n in self.throughput:
+            self.throughput[n] += self.alpha * (speed - self.throughput[n])
+        else:
+            self.throughput[n] = speed
+        self.logger.info('%s on CPUs %s with %d threads encoded at %.2fx',
+                         alloc.codec, fmt_cpulist(alloc.cpus), alloc.threads, speed)
+        if self.on_release:
+            self.on_release(alloc)
+
+    def rebalance(self):
+        """Give every pinned process a contiguous slice of the CPUs"""
+        cpus = self.topology.ordered
+        pinned = [a for a in self.allocations.values() if a.codec in self.pinned_codecs]
+        for alloc in self.allocations.values():
+            if alloc.codec not in self.pinned_codecs:
+                alloc.cpus = cpus
+        if pinned:
+            if len(pinned) >= len(cpus):
+                slices = [[cpus[i % len(cpus)]] for i in range(len(pinned))]
+            else:
+                size, extra = divmod(len(cpus), len(pinned))
+                slices, pos = [], 0
+                for i in range(len(pinned)):
+                    end = pos + size + (1 if i < extra else 0)
+                    slices.append(cpus[pos:end])
+                    pos = end
+            for alloc, cpu_slice in zip(pinned, slices):
+                changed = alloc.cpus != cpu_slice
+                alloc.cpus = cpu_slice
+                if changed and alloc.pid:
+                    self.set_affinity(alloc.pid, alloc.cpus)
+
+    def set_affinity(self, pid: int, cpus: List[int]):
+        """Pin every thread of a running process"""
+        if not hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            tids = [int(t) for t in os.listdir(f'/proc/{pid}/task')]
+        except OSError:
+            tids = [pid]
+        for tid in tids:
+            try:
+                os.sched_setaffinity(tid, cpus)
+            except OSError:
+                # Thread exited
+                pass
+
+    def preexec(self, alloc: Allocation) -> Callable[[], None]:
+        """Runs in the forked child before ffmpeg starts, threads inherit its affinity and priority"""
+        cpus, nice = list(alloc.cpus), self.nice
+
+        def _preexec():
+            try:
+                if cpus and hasattr(os, 'sched_setaffinity'):
+                    os.sched_setaffinity(0, cpus)
+                if nice > os.getpriority(os.PRIO_PROCESS, 0):
+                    os.setpriority(os.PRIO_PROCESS, 0, nice)
+            except OSError:
+                pass
+        return _preexec
+
+    def attach(self, alloc: Allocation) -> Callable[[int], None]:
+        """Called with the PID once ffmpeg started, catches up with rebalances done while it was starting"""
+        def _attach(pid: int):
+            alloc.pid = pid
+            self.version += 1
+            if alloc.codec in self.pinned_codecs:
+                self.set_affinity(pid, alloc.cpus)
+        return _attach
+
+    def track(self, alloc: Allocation, progress: Callable[[dict], None] = None) -> Callable[[dict], None]:
+        """Wrap an ffmpeg progress callback to measure the speed of alloc"""
+        def _progress(sample: dict):
+            if (td := parse_duration(sample.get('out_time', ''))) is not None:
+                alloc.out_time = td.total_seconds()
+                alloc.sampled = time.perf_counter()
+                self.version += 1
+            if progress:
+                progress(sample)
+        return _progress
+
+    @staticmethod
+    def apply(alloc: Allocation, args: list) -> list:
+        """Returns a copy of ffmpeg args with x265 pools and frame-threads sized for alloc"""
+        if not alloc.threads or '-x265-params' not in args:
+            return args.copy()
+        ret = args.copy()
+        idx = ret.index('-x265-params') + 1
+        params = dict(p.split('=', 1) if '=' in p else (p, '') for p in ret[idx].split(':') if p)
+        params['pools'] = str(alloc.threads)
+        params['frame-threads'] = str(frame_threads(alloc.threads))
+        ret[idx] = ':'.join(f'{k}={v}' if v else k for k, v in params.items())
+        return ret
+
+    async def run(self, logger: logging.Logger, codec: str, args: list, print_every: int = 30,
+                  progress: Callable[[dict], None] = None):
+        """run_ffmpeg on CPUs allocated for codec"""
+        with self.process(codec) as alloc:
+            await run_ffmpeg(logger, self.apply(alloc, args), print_every, progress=self.track(alloc, progress),
+                             preexec_fn=self.preexec(alloc), on_start=self.attach(alloc))
+
+    def to_dict(self) -> dict:
+        return dict(
+            cpus=fmt_cpulist(self.topology.cpus),
+            nodes={n: fmt_cpulist(c) for n, c in self.topology.nodes.items()},
+            quota=self.topology.quota,
+            running=[a.to_dict() for a in self.allocations.values()],
+            throughput={n: round(s, 3) for n, s in sorted(self.throughput.items())},
+        )
@@ -0,0 +1,111 @@
+import os
+import shutil
+from typing import Dict, Iterable, Optional, Tuple
+
+from .job import Job
+
+
+def fmt_gb(size: float) -> str:
+    return f'{size / 1e9:,.1f}GB'
+
+
+class SizeModel:
+    """
+    Output size estimates per codec profile (codec and x265 preset)
+
+    Output bytes per second of video and the output/input size ratio are
+    learned from finished jobs as exponentially weighted moving averages.
+    The bitrate is preferred when the duration is known.
+    """
+    # Output size / input size before anything was measured
+    default_ratio = dict(copy=1.05, hevc=0.6)
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha: float = alpha
+        # Profile -> bytes per second
+        self.bitrates: Dict[str, float] = {}
+        # Profile -> output size / input size
+        self.ratios: Dict[str, float] = {}
+
+    @staticmethod
+    def profiles(job: Job) -> Tuple[str, ...]:
+        """Most specific profile first"""
+        if job.preset:
+            return f'{job.enc_codec}:{job.preset}', job.enc_codec
+        return job.enc_codec,
+
+    def _update(self, values: Dict[str, float], key: str, value: float):
+        if key in values:
+            values[key] += self.alpha * (value - values[key])
+        else:
+            values[key] = value
+
+    def observe(self, job: Job):
+        if job.error or not job.in_size or not job.out_size:
+            return
+        for profile in self.profiles(job):
+            self._update(self.ratios, profile, job.out_size / job.in_size)
+            if job.duration:
+                self._update(self.bitrates, profile, job.out_size / job.duration)
+
+    def load_history(self, jobs: Iterable[Job], last: int = 50):
+        done = [j for j in jobs if j.enc_end and j.in_size and j.out_size and not j.error]
+        done.sort(key=lambda j: j.enc_end)
+        for job in done[-last:]:
+            self.observe(job)
+
+    def estimate(self, job: Job, in_size: int, duration: float = None) -> int:
+        for profile in self.profiles(job):
+            if duration and profile in self.bitrates:
+                return int(self.bitrates[profile] * duration)
+            if profile in self.ratios:
+                return int(self.ratios[profile] * in_size)
+        return int(self.default_ratio.get(job.enc_codec, 1.0) * in_size)
+
+
+class DiskAdmission:
+    """
+    Decides if a job's output fits on the temporary and destination filesystems
+
+    A job is admitted if every filesystem it writes to keeps at least reserve
+    bytes free after its estimated output (times margin). Admitted jobs keep
+    their space reserved until released, so concurrent jobs do not count the
+    same free space twice.
+    """
+    def __init__(self, reserve: int, margin: float = 1.2, model: SizeModel = None):
+        self.reserve: int = reserve
+        self.margin: float = margin
+        self.model: SizeModel = model or SizeModel()
+        # Job ID -> device -> reserved bytes
+        self.reserved: Dict[str, Dict[int, int]] = {}
+
+    def needed(self, job: Job, in_size: int, duration: Optional[float], tmp_dir: str, out_dir: str) -> Dict[int, int]:
+        """Peak bytes written per device"""
+        est = int(self.model.estimate(job, in_size, duration) * self.margin)
+        tmp_dev = os.stat(tmp_dir).st_dev
+        out_dev = os.stat(out_dir).st_dev
+        tmp_need = est
+        if job.chunks:
+            # Split input and encoded segments exist next to the concatenated output
+            tmp_need += in_size + est
+        need = {tmp_dev: tmp_need}
+        # Moving within one filesystem is a rename
+        if out_dev != tmp_dev:
+            need[out_dev] = est
+        return need
+
+    def admit(self, job: Job, in_size: int, duration: Optional[float], tmp_dir: str, out_dir: str) -> Optional[str]:
+        """Reserves space for job, returns None if it fits, otherwise the reason it has to wait"""
+        need = self.needed(job, in_size, duration, tmp_dir, out_dir)
+        paths = {os.stat(out_dir).st_dev: out_dir, os.stat(tmp_dir).st_dev: tmp_dir}
+        for dev, size in need.items():
+            reserved = sum(r.get(dev, 0) for job_id, r in self.reserved.items() if job_id != job.id)
+            free = shutil.disk_usage(paths[dev]).free - reserved
+            if free - size < self.reserve:
+                return (f'needs {fmt_gb(size)} on {paths[dev]}, {fmt_gb(free)} free '
+                        f'after {fmt_gb(reserved)} reserved, keeping {fmt_gb(self.reserve)}')
+        self.reserved[job.id] = need
+        return None
+
+    def release(self, job: Job):
+        self.reserved.pop(job.id, None)
@@ -1,4 +1,6 @@
 import asyncio
+import functools
+import hashlib
 import json
 import logging
 import os
@@ -6,15 +8,21 @@ import re
 import shutil
 import signal
 import time
-from datetime import datetime
-from typing import List, Optional
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlencode
 
 from aiohttp import web
 from discord import Embed, Colour
 
 from modules import Cleaner, IntroTrimmer, Notifier
-from utils import read_video_info, run_ffmpeg, setup_logger, get_datetime
-from . import Job, Response
+from modules.keyframe_index import probe_duration, remove_sidecar
+from utils import ProbeCache, setup_logger, get_datetime
+from . import (ChunkedEncode, CpuAllocator, CpuTopology, Deferred, DiskAdmission, EncoderMetrics, FileTransfer,
+               Ingester, Job, JobStore, PresetPolicy, Progress, Response, Scheduler)
+from .chunked import get_opt, replace_opt
+from .cpu import Allocation, parse_cpulist
+from .ingest import find_pieces
 
 """
 ### Run in shell
@@ -44,6 +52,7 @@ ICON_URL = 'https://raw.githubusercontent.com/cosandr/twitch-vods/master/icons/e
 # noinspection PyBroadException
 class Encoder:
     jobs_file = './data/jobs.json'
+    probe_cache_file = './data/probe_cache.json'
     copy_args = [
         '-c:v', 'copy', '-f', 'mp4',
         '-c:a', 'aac',
@@ -55,20 +64,44 @@ class Encoder:
         '-c:a', 'aac',
         '-v', 'warning', '-y', '-progress', '-', '-nostats', '-hide_banner'
     ]
+    # Seconds until a job is leased again while its pieces are joined
+    join_retry = 30
 
     def __init__(self, loop: asyncio.AbstractEventLoop, **kwargs):
         self.loop = loop
+        self.chunk_parallel: int = int(kwargs.pop('chunk_parallel', 4))
+        self.chunk_segments: int = int(kwargs.pop('chunk_segments', 0))
         self.cleaner: Optional[Cleaner] = kwargs.pop('cleaner', None)
+        self.coordinator: bool = kwargs.pop('coordinator', False)
         self.copy_pattern: str = kwargs.pop('copy_pattern', '.*')
         self.copy_pattern_opt: list = kwargs.pop('copy_pattern_opt', [])
+        self.copy_slots: int = int(kwargs.pop('copy_slots', 2))
+        # CPU list like 0-7, limits the CPUs given to ffmpeg
+        cpus: Optional[str] = kwargs.pop('cpus', None)
+        self.defer_seconds: int = int(kwargs.pop('defer_seconds', 300))
+        # Seconds running jobs get to finish on SIGTERM before they are interrupted
+        self.drain_seconds: float = float(kwargs.pop('drain_seconds', 900))
+        # GB kept free on the temporary and output filesystems
+        self.disk_reserve: float = float(kwargs.pop('disk_reserve', 5))
         self.dry_run: bool = kwargs.get('dry_run', False)
         self.out_path: str = kwargs.pop('out_path', '.')
         self.hevc_pattern: str = kwargs.pop('hevc_pattern', '')
         self.hevc_pattern_opt: list = kwargs.pop('hevc_pattern_opt', [])
+        self.hevc_slots: int = int(kwargs.pop('hevc_slots', 1))
+        # SHA-256 of outputs copied to another filesystem, computed while copying
+        self.hash_output: bool = kwargs.pop('hash_output', False)
+        self.ingest: bool = kwargs.pop('ingest', False)
+        # Seconds a raw file must be unchanged before it is ingested
+        self.ingest_settle: float = float(kwargs.pop('ingest_settle', 120))
+        self.lease_seconds: int = int(kwargs.pop('lease_seconds', 60))
         self.listen_address: str = kwargs.pop('listen_address', '0.0.0.0:3626')
+        self.nice: int = int(kwargs.pop('nice', 10))
         self.notifier: Optional[Notifier] = kwargs.pop('notifier', None)
         self.print_every: int = kwargs.pop('print_every', 30)
+        probe_cache_file: Optional[str] = kwargs.pop('probe_cache_file', self.probe_cache_file)
         self.src_path: str = kwargs.pop('src_path', '.')
+        # Hours, 0 always uses the preset in hevc_args
+        self.target_latency: float = float(kwargs.pop('target_latency', 0))
         self.time_format: str = kwargs.get('time_format', '%y%m%d-%H%M')
         trim_cfg_path: str = kwargs.pop('trim_cfg_path', 'data/trimmer/config.json')
         # --- Logger ---
@@ -84,7 +117,22 @@ class Encoder:
             f'- Output: {self.out_path}\n'
             f'- File time format: {self.time_format}\n'
             f'- Jobs file: {self.jobs_file}\n'
+            f'- Slots: {self.copy_slots} copy, {self.hevc_slots} HEVC\n'
+            f'- Disk reserve: {self.disk_reserve}GB, deferred jobs retry after {self.defer_seconds}s\n'
+            f'- Drain: running jobs get {self.drain_seconds}s to finish on SIGTERM\n'
         )
+        topology = CpuTopology.detect(parse_cpulist(cpus) if cpus else None)
+        status_str += f'- CPUs: {topology}, ffmpeg at nice {self.nice}\n'
+        if self.chunk_segments > 1:
+            status_str += f'- Chunked HEVC: {self.chunk_segments} segments, {self.chunk_parallel} in parallel\n'
+        if self.target_latency:
+            status_str += f'- Adaptive x265 preset, backlog target {self.target_latency} hours\n'
+        if self.ingest:
+            status_str += f'- Ingesting unclaimed files after {self.ingest_settle}s without changes\n'
+        if self.hash_output:
+            status_str += f'- SHA-256 of outputs copied across filesystems\n'
+        if self.coordinator:
+            status_str += f'- Coordinator: remote worker leases expire after {self.lease_seconds}s\n'
         if self.dry_run:
             status_str += f'- DRY RUN\n'
         # Removes illegal NTFS characters, extra spaces and trailing whitespace
@@ -100,8 +148,27 @@ class Encoder:
         else:
             self.re_copy = None
         self.logger.info('\n%s', status_str)
-        self.jobs: List[Job] = []
-        self.trimmer = IntroTrimmer(cfg_path=trim_cfg_path, **kwargs)
+        # Job ID -> progress of running encodes
+        self.progress: Dict[str, Progress] = {}
+        self.metrics = EncoderMetrics()
+        self.store = JobStore(self.loop, self.jobs_file, dry_run=self.dry_run, logger=self.logger)
+        self.scheduler = Scheduler(self.loop, self.run_job, logger=self.logger, on_expire=self.lease_expired,
+                                   slots=dict(copy=self.copy_slots, hevc=self.hevc_slots))
+        # Probed once per file version, shared by encode, check_duration and delete_raw
+        self.probe_cache = ProbeCache(store_path=None if self.dry_run else probe_cache_file)
+        self.transfer = FileTransfer(self.loop, hash_name='sha256' if self.hash_output else None, logger=self.logger)
+        self.cpu = CpuAllocator(topology, self.nice, logger=self.logger, on_release=self.record_allocation)
+        self.chunker = ChunkedEncode(self.logger, self.chunk_segments, self.chunk_parallel, self.print_every,
+                                     allocator=self.cpu)
+        self.ingester: Optional[Ingester] = None
+        # Broadcasts whose parts are being concatenated
+        self.stitching: Set[str] = set()
+        # Job ID -> task joining its pieces
+        self.joining: Dict[str, asyncio.Task] = {}
+        # True once run_app started the web app, which then handles shutting down
+        self.app_running: bool = False
+        self.closed: bool = False
+        self.trimmer = IntroTrimmer(cfg_path=trim_cfg_path, probe_cache=self.probe_cache, **kwargs)
         self.loop.add_signal_handler(signal.SIGTERM, self.signal_handler)
         # Check source and destination directories
         for path in (self.src_path, self.out_path):
@@ -110,7 +177,13 @@ class Encoder:
                 if not self.dry_run:
                     os.mkdir(path, 0o750)
                     self.logger.info('%s created', path)
-        self.read_jobs()
+        self.store.load()
+        self.policy: Optional[PresetPolicy] = None
+        if self.target_latency:
+            self.policy = PresetPolicy(self.target_latency * 3600)
+            self.policy.load_history(self.store.jobs.values())
+        self.admission = DiskAdmission(int(self.disk_reserve * 1e9))
+        self.admission.model.load_history(self.store.jobs.values())
         self._kwargs = kwargs
 
     async def async_init(self, _app=None):
@@ -139,30 +212,115 @@ class Encoder:
             except Exception:
                 self.logger.exception('Cannot initialize Cleaner')
 
+        # web.run_app installs its own SIGTERM handler during startup, ours drains first
+        self.loop.add_signal_handler(signal.SIGTERM, self.signal_handler)
+        await self.recover_jobs()
+        # Broadcasts that ended while we were stopped
+        for broadcast in {j.broadcast for j in self.store.jobs.values() if j.broadcast}:
+            if os.path.isdir(self.broadcast_dir(broadcast)):
+                self.loop.create_task(self.stitch(broadcast))
+        self.scheduler.start()
+        # Resume jobs which were still queued when we last stopped
+        for job in self.store.jobs.values():
+            if job.queued_at and job.enc_codec and not any((job.enc_start, job.ignored, job.error)):
+                self.logger.info('Re-queueing %s', job.input)
+                self.scheduler.submit(job, job.enc_codec, job.priority)
+        if self.ingest:
+            self.ingester = Ingester(self.loop, self.src_path, self.ingest_files, self.is_claimed,
+                                     settle=self.ingest_settle, logger=self.logger)
+            self.ingester.start()
+
     def signal_handler(self):
-        async def _run():
-            await self.close()
+        if self.scheduler.draining:
+            return
+        self.loop.create_task(self.shutdown())
+
+    async def shutdown(self):
+        """Drain and close, then stop web.run_app if it is running"""
+        await self.drain()
+        await self.close()
+        if self.app_running:
+            self.loop.call_soon(self.raise_exit)
+        else:
             exit(0)
-        self.loop.create_task(_run())
+
+    @staticmethod
+    def raise_exit():
+        raise web.GracefulExit()
+
+    async def drain(self):
+        """Stop taking jobs, give running ones drain_seconds to finish and checkpoint the rest"""
+        running = self.scheduler.running()
+        self.logger.info('Draining, waiting up to %.0fs for %d running jobs', self.drain_seconds, len(running))
+        self.scheduler.drain()
+        if self.ingester:
+            await self.ingester.close()
+            self.ingester = None
+        if running:
+            embed = self.make_embed()
+            embed.colour = Colour.orange()
+            embed.title = 'Draining'
+            embed.description = '\n'.join(f'- {j.input}' for j in running)
+            await self.send_notification(embed=embed)
+        try:
+            await asyncio.wait_for(self.scheduler.wait_idle(), self.drain_seconds)
+        except asyncio.TimeoutError:
+            self.logger.warning('Drain timed out')
+        left = self.scheduler.running()
+        # Cancelled local encodes checkpoint themselves in run_job
+        await self.scheduler.close()
+        for lease_id, lease in list(self.scheduler.leases.items()):
+            self.scheduler.release(lease_id)
+            self.checkpoint(lease.job)
+        if running:
+            embed = self.make_embed()
+            embed.colour = Colour.orange()
+            embed.title = 'Drained'
+            finished = [j for j in running if j not in left]
+            if finished:
+                embed.add_field(name='Finished', value='\n'.join(j.input for j in finished), inline=False)
+            if left:
+                embed.add_field(name='Resume After Restart', value='\n'.join(j.input for j in left), inline=False)
+            await self.send_notification(embed=embed)
 
     async def close(self, _app=None):
         """Cleanup"""
+        if self.closed:
+            return
+        self.closed = True
         embed = self.make_embed()
         embed.colour = Colour.orange()
         embed.description = 'Closing'
         await self.send_notification(embed=embed)
-        self.write_jobs()
+        if self.ingester:
+            await self.ingester.close()
+        await self.scheduler.close()
+        await self.store.close()
+        await self.probe_cache.close()
         if self.cleaner:
             self.cleaner.close()
 
     def run_app(self):
+        self.app_running = True
         app = web.Application()
         app.on_startup.append(self.async_init)
         app.on_shutdown.append(self.close)
         routes = [
             web.get("/job/list", self.handler_list),
+            web.get("/job/progress", self.handler_progress_list),
+            web.get("/job/progress/{id}", self.handler_progress),
             web.post("/job/run", self.handler_run),
+            web.post("/job/batch", self.handler_batch),
+            web.post("/job/broadcast/{broadcast}", self.handler_broadcast),
+            web.get("/metrics", self.handler_metrics),
         ]
+        if self.coordinator:
+            routes += [
+                web.post("/worker/lease", self.handler_lease),
+                web.post("/worker/heartbeat/{lease}", self.handler_heartbeat),
+                web.post("/worker/result/{lease}", self.handler_result),
+                web.post("/worker/release/{lease}", self.handler_release),
+            ]
         app.add_routes(routes)
         if self.listen_address.startswith('/'):
             web.run_app(app, path=self.listen_address)
@@ -193,7 +351,8 @@ class Encoder:
             if not embed and content:
                 embed = self.make_embed()
                 embed.description = content
-            await self.notifier.send(embed=embed)
+            with self.metrics.notification_seconds.time():
+                await self.notifier.send(embed=embed)
         except Exception:
             self.logger.exception('Cannot send notification')
 
@@ -203,31 +362,239 @@ class Encoder:
             return
         self.cleaner.en_del.set()
 
-    def read_jobs(self):
-        if not os.path.exists(self.jobs_file):
-            return
-        with open(self.jobs_file, 'r', encoding='utf-8') as fr:
-            jobs = json.load(fr)
-        self.jobs = []
-        for j in jobs:
-            self.jobs.append(Job.from_dict(j))
-        self.logger.info('Jobs file read')
-
-    def write_jobs(self):
-        if not self.dry_run:
-            jobs = [j.to_dict(no_dt=True) for j in self.jobs]
-            with open(self.jobs_file, 'w', encoding='utf-8') as fw:
-                json.dump(jobs, fw, indent=2)
-        self.logger.info('Jobs file updated')
-
     async def handler_list(self, r: web.Request) -> web.Response:
+        """
+        List jobs, optional query parameters:
+        user, codec, status (repeat or comma separated), since, until (ISO format, created_at),
+        limit, cursor (from previous response's next), order (asc/desc)
+        """
+        self.logger.debug(r.path_qs)
+        resp = Response()
+        try:
+            status = []
+            for s in r.query.getall('status', []):
+                status.extend(v for v in s.split(',') if v)
+            since = datetime.fromisoformat(r.query['since']) if 'since' in r.query else None
+            until = datetime.fromisoformat(r.query['until']) if 'until' in r.query else None
+            limit = int(r.query['limit']) if 'limit' in r.query else None
+            cursor = int(r.query['cursor']) if 'cursor' in r.query else None
+            desc = r.query.get('order', 'asc') == 'desc'
+            if limit is not None and limit < 1:
+                raise ValueError('limit must be at least 1')
+        except ValueError as e:
+            resp.error = str(e)
+            resp.status = web.HTTPBadRequest.status_code
+            return resp.web_response
+        # Everything in the body is versioned, a poll with nothing new is answered before querying
+        state = (self.store.index.version, self.scheduler.version, self.policy.version if self.policy else 0,
+                 self.cpu.version, urlencode(sorted(r.query.items())))
+        etag = f'"{hashlib.md5(repr(state).encode()).hexdigest()}"'
+        if r.headers.get('If-None-Match') == etag:
+            return web.Response(status=web.HTTPNotModified.status_code, headers={'ETag': etag})
+        jobs, next_cursor, total = self.store.index.query(
+            user=r.query.get('user'), codec=r.query.get('codec'), status=status,
+            since=since, until=until, cursor=cursor, limit=limit, desc=desc,
+        )
+        resp.data = dict(
+            jobs=[j.to_dict(no_dt=True) for j in jobs],
+            total=total,
+            scheduler=self.scheduler.status(),
+        )
+        if self.policy:
+            resp.data['policy'] = self.policy.to_dict()
+        resp.data['cpu'] = self.cpu.to_dict()
+        if next_cursor is not None:
+            resp.data['next'] = next_cursor
+        web_resp = resp.web_response
+        web_resp.headers['ETag'] = etag
+        return web_resp
+
+    async def handler_progress_list(self, r: web.Request) -> web.Response:
+        """Current progress of all running encodes"""
         self.logger.debug(r.path)
         resp = Response()
-        resp.data = [j.to_dict(no_dt=True) for j in self.jobs]
+        resp.data = [p.to_dict() for p in self.progress.values()]
         return resp.web_response
 
-    async def run_job(self, job: Job):
-        # Create folder from username if needed
+    async def handler_metrics(self, r: web.Request) -> web.Response:
+        """Metrics in the Prometheus text format"""
+        self.logger.debug(r.path)
+        for codec, queued in self.scheduler.queued.items():
+            self.metrics.queue_depth.set(len(queued), codec=codec)
+            self.metrics.running.set(len(self.scheduler.running(codec)), codec=codec)
+        return web.Response(text=self.metrics.render(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def handler_progress(self, r: web.Request) -> web.StreamResponse:
+        """Server-Sent Events stream of a running encode's progress, ends when the encode does"""
+        self.logger.debug(r.path)
+        progress = self.progress.get(r.match_info['id'])
+        if not progress:
+            resp = Response()
+            resp.error = f'Job {r.match_info["id"]} is not running'
+            resp.status = web.HTTPNotFound.status_code
+            return resp.web_response
+        stream = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await stream.prepare(r)
+        q = progress.subscribe()
+        try:
+            while True:
+                data = await q.get()
+                await stream.write(f'event: progress\ndata: {json.dumps(data)}\n\n'.encode())
+                if data['state'] != 'running':
+                    break
+        except ConnectionResetError:
+            pass
+        finally:
+            progress.unsubscribe(q)
+        return stream
+
+    async def handler_lease(self, r: web.Request) -> web.Response:
+        """
+        Lease the next queued job to a remote worker, optional JSON body:
+        worker (name), codecs (list, in order of preference). Has no data if nothing is queued.
+        """
+        self.logger.debug(r.path)
+        resp = Response()
+        try:
+            body: dict = await r.json()
+        except ValueError:
+            body = {}
+        worker = body.get('worker') or r.remote
+        codecs = body.get('codecs') or list(self.scheduler.queues)
+        lease = self.scheduler.lease(codecs, worker, self.lease_seconds)
+        if not lease:
+            return resp.web_response
+        job = lease.job
+        await self.choose_preset(job)
+        args = self.job_args(job)
+        if job.pieces:
+            # Workers read the input from the shared source directory, lease it again once it is one file
+            self.join_task(job)
+            self.scheduler.defer_lease(lease.id, Deferred('Joining pieces', self.join_retry))
+            return resp.web_response
+        if reason := await self.check_space(job):
+            self.scheduler.defer_lease(lease.id, Deferred(reason, self.defer_seconds))
+            return resp.web_response
+        tmp_file = os.path.basename(self.tmp_path(job, 'enc'))
+        job.worker = worker
+        job.enc_start = datetime.utcnow()
+        job.ffmpeg_args = ' '.join(self.input_args(job, job.input) + args + [tmp_file])
+        self.store.save(job)
+        self.progress[job.id] = Progress(job.id)
+        resp.data = dict(
+            lease=lease.id,
+            lease_seconds=self.lease_seconds,
+            job=job.to_dict(no_dt=True),
+            args=args,
+            tmp_file=tmp_file,
+            trim=job.start_seconds is None and not job.part and bool(self.trimmer.get_cfg(job.title)),
+        )
+        return resp.web_response
+
+    async def handler_heartbeat(self, r: web.Request) -> web.Response:
+        """Renew a lease, optional JSON body: sample (watch_ffmpeg progress), duration (seconds)"""
+        resp = Response()
+        lease = self.scheduler.renew(r.match_info['lease'])
+        if not lease:
+            resp.error = f'Lease {r.match_info["lease"]} not found'
+            resp.status = web.HTTPNotFound.status_code
+            return resp.web_response
+        try:
+            body: dict = await r.json()
+        except ValueError:
+            body = {}
+        if progress := self.progress.get(lease.job.id):
+            if body.get('duration'):
+                progress.duration = float(body['duration'])
+            if body.get('sample'):
+                progress.update(body['sample'])
+        resp.data = dict(expires=lease.expires_at.isoformat())
+        return resp.web_response
+
+    async def handler_result(self, r: web.Request) -> web.Response:
+        """
+        Finish a leased job, JSON body: error (None if the encode succeeded),
+        start_seconds (intro found by the worker), chunks, ffmpeg_args
+        """
+        self.logger.debug(r.path)
+        resp = Response()
+        lease = self.scheduler.release(r.match_info['lease'])
+        if not lease:
+            resp.error = f'Lease {r.match_info["lease"]} not found'
+            resp.status = web.HTTPNotFound.status_code
+            return resp.web_response
+        body: dict = await r.json()
+        job = lease.job
+        if body.get('start_seconds') is not None:
+            job.start_seconds = int(body['start_seconds'])
+        job.chunks = body.get('chunks', job.chunks)
+        job.ffmpeg_args = body.get('ffmpeg_args') or job.ffmpeg_args
+        embed = self.make_embed()
+        embed.title = 'Encode'
+        embed.add_field(name='Source', value=job.input, inline=True)
+        embed.add_field(name='Target', value=job.out_file, inline=True)
+        embed.add_field(name='Worker', value=lease.worker, inline=False)
+        if job.start_seconds:
+            embed.add_field(name='Trimmed', value=f'{job.start_seconds} seconds', inline=False)
+        progress = self.progress.pop(job.id, None)
+        if progress and progress.duration:
+            job.duration = progress.duration
+        try:
+            if body.get('error'):
+                raise Exception(body['error'])
+            if job.chunks or job.start_seconds:
+                await self.check_duration(os.path.join(self.src_path, job.input), self.tmp_path(job, 'enc'),
+                                          offset=job.start_seconds or 0)
+            job.enc_end = datetime.utcnow()
+            td = job.enc_end - job.enc_start
+            self.logger.info('%s encoded %s in %s', lease.worker, job.input, str(td))
+            embed.add_field(name='Encode Time', value=str(td), inline=False)
+            self.record_speed(job, td.total_seconds(), progress)
+            if progress:
+                progress.finish('done')
+        except Exception as e:
+            embed.add_field(name='Encode Failed', value=str(e), inline=False)
+            self.logger.error('%s failed to encode %s: %s', lease.worker, job.input, str(e))
+            job.error = str(e)
+            job.ignored = True
+            if progress:
+                progress.finish('error')
+        self.store.save(job)
+        try:
+            await self.finish_job(job, embed)
+        finally:
+            if not lease.fut.done():
+                lease.fut.set_result(job)
+        resp.data = "Job done"
+        return resp.web_response
+
+    async def handler_release(self, r: web.Request) -> web.Response:
+        """Give back a lease whose job was not finished, it is queued again"""
+        self.logger.debug(r.path)
+        resp = Response()
+        lease = self.scheduler.requeue(r.match_info['lease'])
+        if not lease:
+            resp.error = f'Lease {r.match_info["lease"]} not found'
+            resp.status = web.HTTPNotFound.status_code
+            return resp.web_response
+        self.logger.info('%s released %s, re-queueing', lease.worker, lease.job.input)
+        self.lease_expired(lease.job)
+        resp.data = 'Lease released'
+        return resp.web_response
+
+    def lease_expired(self, job: Job):
+        """Resets a job whose remote worker stopped responding or released it, the scheduler queues it again"""
+        if progress := self.progress.pop(job.id, None):
+            progress.finish('error')
+        self.admission.release(job)
+        job.enc_start = None
+        job.ffmpeg_args = None
+        job.worker = None
+        self.store.save(job)
+
+    async def prepare_job(self, job: Job) -> bool:
+        """Picks codec and output name, returns False if the job is ignored"""
         if not job.created_at:
             job.created_at = get_datetime(job.input, self.time_format, self.src_path)
         out_name = f'{job.created_at.strftime(self.time_format)}_{self.re_ntfs.sub("", job.title)}'
@@ -235,89 +602,437 @@ class Encoder:
         will_copy = bool(self.re_copy.search(out_name)) if self.re_copy else False
         self.logger.debug("File: %s, HEVC? %s, Copy? %s", out_name, str(will_hevc), str(will_copy))
         if will_hevc:
-            cmd = self.hevc_args.copy()
-            out_ext = '.mkv'
             job.enc_codec = 'hevc'
+            job.out_file = out_name + '.mkv'
         elif will_copy:
-            cmd = self.copy_args.copy()
-            out_ext = '.mp4'
             job.enc_codec = 'copy'
+            job.out_file = out_name + '.mp4'
         else:
             embed = self.make_embed()
             embed.title = 'Ignore'
             embed.description = job.title
             await self.send_notification(embed=embed)
             self.logger.info(f'Ignoring job for {job.input}')
-            job.ignore = True
-            self.write_jobs()
+            job.ignored = True
+            self.store.save(job)
+            self.metrics.jobs.inc(codec=None, outcome='ignored')
             self.update_cleaner()
+            return False
+        return True
+
+    def enqueue(self, job: Job) -> asyncio.Future:
+        """Adds a prepared job to the scheduler queue"""
+        job.queued_at = datetime.utcnow()
+        self.store.save(job)
+        return self.scheduler.submit(job, job.enc_codec, job.priority)
+
+    def tmp_path(self, job: Job, prefix: str) -> str:
+        """Path of a temporary output file for job in the source directory"""
+        out_ext = os.path.splitext(job.out_file)[1]
+        return os.path.join(self.src_path, f'{prefix}_{os.path.splitext(job.input)[0]}{out_ext}')
+
+    async def recover_jobs(self):
+        """Finds jobs interrupted by a restart, re-queues or finishes them"""
+        recovered = []
+        for job in self.store.jobs.values():
+            if not job.enc_start or not job.out_file or job.deleted is not None or job.ignored or job.error:
+                continue
+            in_fp = os.path.join(self.src_path, job.input)
+            tmp_out_fp = self.tmp_path(job, 'enc')
+            out_fp = os.path.join(self.out_path, job.user, job.out_file)
+            if job.enc_end and os.path.exists(tmp_out_fp):
+                # Encode had finished, reuse its output
+                self.logger.info('Resuming %s after encode', job.input)
+                embed = self.make_embed()
+                embed.title = 'Resume'
+                embed.add_field(name='Source', value=job.input, inline=True)
+                embed.add_field(name='Target', value=job.out_file, inline=True)
+                await self.finish_job(job, embed)
+            elif os.path.exists(in_fp):
+                self.logger.info('Re-queueing interrupted %s', job.input)
+                self.checkpoint(job)
+            elif job.enc_end and os.path.exists(out_fp):
+                # Only the final save was lost
+                job.deleted = True
+                self.store.save(job)
+            else:
+                self.logger.error('Cannot recover %s, source and output missing', job.input)
+                job.error = 'Source and output missing after restart'
+                job.ignored = True
+                self.store.save(job)
+            recovered.append(f'- {job.input}')
+        if recovered:
+            embed = self.make_embed()
+            embed.colour = Colour.orange()
+            embed.title = 'Recovered'
+            embed.description = '\n'.join(recovered)
+            await self.send_notification(embed=embed)
+
+    def checkpoint(self, job: Job):
+        """
+        Reset an interrupted job to queued so it runs again after a restart.
+        Partial output is deleted, segments of a chunked encode are kept for ChunkedEncode to resume.
+        """
+        tmp_out_fp = self.tmp_path(job, 'enc')
+        partial = [tmp_out_fp, self.tmp_path(job, 'trimmed')]
+        if self.chunk_segments <= 1:
+            partial.append(ChunkedEncode.work_dir(tmp_out_fp))
+        for fp in partial:
+            if os.path.exists(fp):
+                self.logger.info('Deleting partial output %s', fp)
+                if self.dry_run:
+                    continue
+                if os.path.isdir(fp):
+                    shutil.rmtree(fp)
+                else:
+                    os.unlink(fp)
+        job.enc_start = None
+        job.enc_end = None
+        job.ffmpeg_args = None
+        job.worker = None
+        job.queued_at = job.queued_at or datetime.utcnow()
+        self.admission.release(job)
+        self.store.save(job)
+
+    def job_args(self, job: Job) -> list:
+        """Codec arguments for a prepared job, also decides if it is encoded in chunks"""
+        if job.enc_codec == 'hevc' and self.chunk_segments > 1:
+            job.chunks = self.chunk_segments
+        if job.enc_codec == 'hevc':
+            args = replace_opt(self.hevc_args, '-preset:v', job.preset) if job.preset else self.hevc_args.copy()
+        else:
+            args = self.copy_args.copy()
+        if job.broadcast:
+            # Audio of parts is encoded once when they are stitched, like chunked segments
+            args = replace_opt(args, '-c:a', 'copy')
+        return args
+
+    async def choose_preset(self, job: Job):
+        """Picks the x265 preset of a HEVC job from the current backlog"""
+        if not self.policy or job.enc_codec != 'hevc':
+            return
+        if job.preset and os.path.exists(ChunkedEncode.work_dir(self.tmp_path(job, 'enc'))):
+            # Segments encoded before a restart are resumed with the same preset
+            return
+        pending = [job] + self.scheduler.queued['hevc']
+        durations = await asyncio.gather(
+            *(probe_duration(os.path.join(self.src_path, j.input), self.logger, self.probe_cache) for j in pending),
+            return_exceptions=True)
+        backlog = sum(d.total_seconds() for d in durations if isinstance(d, timedelta))
+        for running in self.scheduler.running('hevc'):
+            progress = self.progress.get(running.id)
+            if running is not job and progress and progress.duration:
+                backlog += max(progress.duration - progress.out_time, 0)
+        workers = {le.worker for le in self.scheduler.leases.values() if le.codec == 'hevc'}
+        parallel = len(self.scheduler.slots['hevc']) + len(workers)
+        job.preset, job.preset_reason = self.policy.choose(backlog, parallel)
+        self.logger.info('Preset %s for %s: %s', job.preset, job.input, job.preset_reason)
+
+    async def check_space(self, job: Job) -> Optional[str]:
+        """Reserves disk space for job's output, returns why the job has to wait if it does not fit"""
+        in_fp = os.path.join(self.src_path, job.input)
+        try:
+            in_size = os.path.getsize(in_fp)
+        except OSError:
+            # Fails later with a proper error
+            return None
+        duration = await probe_duration(in_fp, self.logger, self.probe_cache)
+        reason = self.admission.admit(job, in_size, duration.total_seconds() if duration else None,
+                                      self.src_path, self.out_path)
+        if reason or job.deferred:
+            job.deferred = reason
+            self.store.save(job)
+        return reason
+
+    def record_speed(self, job: Job, elapsed: float, progress: Progress = None):
+        """Feeds the encode time and speed of a finished job to metrics and the preset policy"""
+        self.metrics.encode_seconds.observe(elapsed, codec=job.enc_codec)
+        speed = None
+        if job.duration and elapsed > 0:
+            speed = job.duration / elapsed
+        elif progress and progress.speed:
+            speed = progress.speed
+        if not speed:
             return
-        job.out_file = out_name + out_ext
+        self.metrics.speed.observe(speed, codec=job.enc_codec)
+        if self.policy and job.enc_codec == 'hevc':
+            self.policy.observe(job.preset or self.policy.default, speed)
+
+    def record_allocation(self, alloc: Allocation):
+        """Encode speed of a finished ffmpeg process by the number of CPUs it had"""
+        if speed := alloc.speed:
+            self.metrics.allocation_speed.observe(speed, cpus=len(alloc.cpus))
+
+    async def run_job(self, job: Job):
+        if not job.enc_codec and not await self.prepare_job(job):
+            return
+        await self.choose_preset(job)
+        args = self.job_args(job)
+        if job.pieces:
+            await self.join_task(job)
+        if reason := await self.check_space(job):
+            raise Deferred(reason, self.defer_seconds)
         in_fp = os.path.join(self.src_path, job.input)
-        input_new_ext = os.path.splitext(job.input)[0] + out_ext
-        tmp_out_fp = os.path.join(self.src_path, f'enc_{input_new_ext}')
-        # Insert input
-        cmd.insert(0, '-i')
-        cmd.insert(1, in_fp)
-        # Append output file
-        cmd.append(tmp_out_fp)
-        self.logger.info(f"Encoding {job.input} -> {job.out_file}")
+        tmp_out_fp = self.tmp_path(job, 'enc')
         embed = self.make_embed()
         embed.title = 'Encode'
         embed.add_field(name='Source', value=job.input, inline=True)
         embed.add_field(name='Target', value=job.out_file, inline=True)
+        # Find intro in the raw file so the encode can skip it
+        if job.start_seconds is None and not job.part and self.trimmer.get_cfg(job.title):
+            try:
+                with self.metrics.stage_seconds.time(stage='trim'):
+                    fps = await self.trimmer.probe_fps(in_fp)
+                    job.start_seconds = await self.loop.run_in_executor(
+                        None, functools.partial(self.trimmer.find_intro, file=in_fp, check_name=job.title, fps=fps))
+                embed.add_field(name='Trimmed', value=f'{job.start_seconds} seconds', inline=False)
+                self.store.save(job)
+            except Exception as e:
+                self.logger.exception('Could not find intro seconds')
+                embed.add_field(name='Trim Failed', value=str(e), inline=False)
+        cmd = self.input_args(job, in_fp) + args + [tmp_out_fp]
+        self.logger.info(f"Encoding {job.input} -> {job.out_file}")
         # Try to encode
         try:
-            job.enc_cmd = ' '.join(cmd)
-            job.enc_start = datetime.utcnow().isoformat()
-            if not self.dry_run:
-                await run_ffmpeg(logger=self.logger, args=cmd, print_every=self.print_every)
-            job.enc_end = datetime.utcnow().isoformat()
-            td = datetime.fromisoformat(job.enc_end) - datetime.fromisoformat(job.enc_start)
+            job.ffmpeg_args = ' '.join(cmd)
+            job.enc_start = datetime.utcnow()
+            self.store.save(job)
+            if self.dry_run:
+                pass
+            elif job.remuxed and job.enc_codec == 'copy' and not job.start_seconds:
+                await self.adopt_remux(job, in_fp, tmp_out_fp)
+                embed.add_field(name='Remuxed', value='While recording', inline=False)
+            else:
+                await self.encode(job, args, in_fp, tmp_out_fp)
+            job.enc_end = datetime.utcnow()
+            self.store.save(job)
+            td = job.enc_end - job.enc_start
             status = f"Encoded {job.input} in {str(td)}"
             self.logger.info(status)
             embed.add_field(name='Encode Time', value=str(td), inline=False)
             job.raw = False
+        except asyncio.CancelledError:
+            self.logger.info('Interrupted %s, it runs again after restart', job.input)
+            self.checkpoint(job)
+            self.metrics.jobs.inc(codec=job.enc_codec, outcome='interrupted')
+            raise
         except Exception as e:
             embed.add_field(name='Encode Failed', value=str(e), inline=False)
             self.logger.exception('Encoding failed')
             job.error = str(e)
-            job.ignore = True
-        # Trim intro if we can
-        if not job.error and self.trimmer.get_cfg(job.title):
+            job.ignored = True
+        await self.finish_job(job, embed)
+
+    @staticmethod
+    def input_args(job: Job, in_fp: str) -> list:
+        """Input arguments for ffmpeg, seeks past the intro if the job has one"""
+        if job.start_seconds:
+            return ['-ss', str(job.start_seconds), '-i', in_fp]
+        return ['-i', in_fp]
+
+    async def encode(self, job: Job, args: list, in_fp: str, out_fp: str):
+        """Encode in_fp to out_fp and track its progress in self.progress while it runs"""
+        with self.metrics.stage_seconds.time(stage='probe'):
+            duration = await probe_duration(in_fp, self.logger, self.probe_cache)
+        if duration and job.start_seconds:
+            duration -= timedelta(seconds=job.start_seconds)
+        progress = Progress(job.id, duration.total_seconds() if duration else None)
+        self.progress[job.id] = progress
+        job.duration = progress.duration
+        if job.chunks and not duration:
+            self.logger.warning('Unknown duration of %s, encoding in one piece', in_fp)
+            job.chunks = None
+        start = time.perf_counter()
+        try:
+            if job.chunks:
+                await self.chunker.run(in_fp, out_fp, args, progress.duration,
+                                       start_seconds=job.start_seconds, progress=progress.update)
+            else:
+                cmd = self.input_args(job, in_fp) + args + [out_fp]
+                await self.cpu.run(self.logger, job.enc_codec, cmd, self.print_every, progress=progress.update)
+            # Other encodes are checked before their raw input is deleted
+            if job.chunks or job.start_seconds:
+                await self.check_duration(in_fp, out_fp, offset=job.start_seconds or 0)
+            progress.finish('done')
+            self.record_speed(job, time.perf_counter() - start, progress)
+        except Exception:
+            progress.finish('error')
+            raise
+        finally:
+            self.progress.pop(job.id, None)
+
+    async def adopt_remux(self, job: Job, in_fp: str, out_fp: str):
+        """Use an input remuxed by the recorder as copy output, after checking it against the raw copy if any"""
+        raw_fp = os.path.join(self.src_path, job.raw_copy) if job.raw_copy else None
+        if raw_fp and os.path.exists(raw_fp):
+            await self.check_duration(raw_fp, in_fp)
+        job.in_size = job.out_size = os.path.getsize(in_fp)
+        # No await until enc_end is saved, an interrupt must not see the input moved
+        os.replace(in_fp, out_fp)
+        if raw_fp and os.path.exists(raw_fp):
+            os.unlink(raw_fp)
+            remove_sidecar(raw_fp)
+            self.logger.info('Deleted raw copy %s', raw_fp)
+
+    def join_task(self, job: Job) -> asyncio.Task:
+        """The task joining the pieces of job, local encodes and leases share it"""
+        task = self.joining.get(job.id)
+        if task is None:
+            task = self.joining[job.id] = self.loop.create_task(self.join_pieces(job))
+            task.add_done_callback(lambda _: self.joining.pop(job.id, None))
+        return task
+
+    async def join_pieces(self, job: Job):
+        """
+        Concatenate input and the pieces recorded after streamlink restarts into one input file.
+        The pieces stay claimed by the job until they are deleted, a job whose input is already
+        joined only deletes what is left of them. If joining fails the job encodes input alone,
+        the other pieces are no longer claimed and become jobs of their own.
+        """
+        base, ext = os.path.splitext(job.input)
+        if not base.endswith('.joined'):
+            joined = f'{base}.joined{ext}'
+            joined_fp = os.path.join(self.src_path, joined)
+            list_fp = os.path.join(self.src_path, f'{base}.joined_list.txt')
+            fps = [os.path.join(self.src_path, n) for n in [job.input] + job.pieces]
+            self.logger.info('Joining %d pieces of %s', len(fps), job.input)
             try:
-                trim_fp = os.path.join(self.src_path, f'trimmed_{input_new_ext}')
-                intro_seconds = await self.trimmer.run_crop(file=tmp_out_fp, out_file=trim_fp, check_name=job.title)
-                embed.add_field(name='Trimmed', value=f'{intro_seconds} seconds', inline=False)
-                job.start_seconds = intro_seconds
-                # Replace encoded file with trimmed one
-                shutil.move(trim_fp, tmp_out_fp)
+                if missing := [fp for fp in fps if not os.path.exists(fp)]:
+                    raise FileNotFoundError(', '.join(missing))
+                with self.metrics.stage_seconds.time(stage='join'):
+                    await self.chunker.concat(fps, joined_fp, list_fp=list_fp)
+                    durations = await asyncio.gather(*(probe_duration(fp, self.logger, self.probe_cache) for fp in fps))
+                    joined_dur = await probe_duration(joined_fp, self.logger, self.probe_cache)
+                expected = sum((d for d in durations if d), timedelta())
+                if joined_dur is None or (expected - joined_dur).total_seconds() > 5 * len(fps):
+                    raise Exception(f'{joined} is too short: {joined_dur}, pieces add up to {expected}')
             except Exception as e:
-                self.logger.exception('Could not find intro seconds')
-                embed.add_field(name='Trim Failed', value=str(e), inline=False)
-        # Try to delete raw
-        if not job.error and not job.start_seconds:
+                self.logger.exception('Cannot join pieces of %s', job.input)
+                embed = self.make_embed_error('Cannot join pieces, encoding them separately', e=e)
+                await self.send_notification(embed=embed)
+                if os.path.exists(joined_fp):
+                    os.unlink(joined_fp)
+                job.pieces = None
+                self.store.save(job)
+                return
+            finally:
+                if os.path.exists(list_fp):
+                    os.unlink(list_fp)
+            job.pieces = [job.input] + job.pieces
+            job.input = joined
+            self.store.save(job)
+        for name in job.pieces:
+            fp = os.path.join(self.src_path, name)
+            if os.path.exists(fp) and not self.dry_run:
+                os.unlink(fp)
+                remove_sidecar(fp)
+                self.logger.info('Deleted piece %s', fp)
+        job.pieces = None
+        self.store.save(job)
+
+    async def finish_job(self, job: Job, embed: Embed):
+        """Verifies and moves an encoded file, deletes raw input if possible"""
+        in_fp = os.path.join(self.src_path, job.input)
+        tmp_out_fp = self.tmp_path(job, 'enc')
+        if not job.error and os.path.exists(in_fp) and os.path.exists(tmp_out_fp):
+            job.in_size = os.path.getsize(in_fp)
+            job.out_size = os.path.getsize(tmp_out_fp)
+            self.metrics.bytes_in.inc(job.in_size, codec=job.enc_codec)
+            self.metrics.bytes_out.inc(job.out_size, codec=job.enc_codec)
+        # Try to delete raw, trimmed files keep it in case the intro was wrong
+        if not job.error and not job.start_seconds and os.path.exists(in_fp):
             try:
                 await self.delete_raw(in_fp, tmp_out_fp)
                 embed.set_field_at(0, name='Source Deleted', value=job.input, inline=True)
             except Exception as e:
                 job.error = str(e)
                 embed.add_field(name='Source Delete Failed', value=str(e), inline=False)
-        # Move encoded file to final directory
-        if os.path.exists(tmp_out_fp):
+        # Move encoded file to final directory, parts wait for the rest of their broadcast
+        if job.broadcast and os.path.exists(tmp_out_fp):
+            try:
+                os.makedirs(self.broadcast_dir(job.broadcast), 0o750, exist_ok=True)
+                os.replace(tmp_out_fp, self.part_path(job))
+            except Exception as e:
+                job.error = str(e)
+                embed.add_field(name='Move Failed', value=str(e), inline=False)
+        elif os.path.exists(tmp_out_fp):
             try:
                 out_path = os.path.join(self.out_path, job.user)
                 if not os.path.exists(out_path):
                     os.mkdir(out_path, 0o750)
                 out_fp = os.path.join(out_path, job.out_file)
-                shutil.move(tmp_out_fp, out_fp)
+                with self.metrics.stage_seconds.time(stage='move'):
+                    job.out_sha256 = await self.transfer.move(tmp_out_fp, out_fp, progress=self.log_transfer(out_fp))
             except Exception as e:
                 job.error = str(e)
                 embed.add_field(name='Move Failed', value=str(e), inline=False)
         await self.send_notification(embed=embed)
         job.deleted = not os.path.exists(in_fp)
-        self.write_jobs()
+        self.store.save(job)
+        self.metrics.jobs.inc(codec=job.enc_codec, outcome='error' if job.error else 'done')
+        self.admission.release(job)
+        self.admission.model.observe(job)
         self.update_cleaner()
+        if job.broadcast:
+            await self.stitch(job.broadcast)
+
+    def broadcast_dir(self, broadcast: str) -> str:
+        """Directory holding encoded parts of a segmented recording"""
+        return os.path.join(self.src_path, f'broadcast_{broadcast}')
+
+    def part_path(self, job: Job) -> str:
+        return os.path.join(self.broadcast_dir(job.broadcast), f'part_{job.part:04d}{os.path.splitext(job.out_file)[1]}')
+
+    async def stitch(self, broadcast: str):
+        """Concatenate the encoded parts of a broadcast once all of them are done"""
+        if broadcast in self.stitching:
+            return
+        parts = sorted((j for j in self.store.jobs.values() if j.broadcast == broadcast), key=lambda j: j.part)
+        total = next((j.parts_total for j in parts if j.parts_total), None)
+        if not total or [j.part for j in parts] != list(range(total)):
+            return
+        if any(j.error or j.ignored for j in parts):
+            self.logger.warning('Not stitching %s, parts failed or were ignored', broadcast)
+            return
+        if not all(j.enc_end and os.path.exists(self.part_path(j)) for j in parts):
+            return
+        self.stitching.add(broadcast)
+        first, last = parts[0], parts[-1]
+        work_dir = self.broadcast_dir(broadcast)
+        tmp_fp = os.path.join(work_dir, f'stitched{os.path.splitext(first.out_file)[1]}')
+        out_fp = os.path.join(self.out_path, first.user, first.out_file)
+        embed = self.make_embed()
+        embed.title = 'Stitch'
+        embed.add_field(name='Parts', value=str(total), inline=True)
+        embed.add_field(name='Target', value=first.out_file, inline=True)
+        self.logger.info('Stitching %d parts of %s -> %s', total, broadcast, first.out_file)
+        try:
+            audio = get_opt(self.hevc_args if first.enc_codec == 'hevc' else self.copy_args, '-c:a', 'copy')
+            with self.metrics.stage_seconds.time(stage='stitch'):
+                await self.chunker.concat([self.part_path(j) for j in parts], tmp_fp, audio)
+            os.makedirs(os.path.dirname(out_fp), 0o750, exist_ok=True)
+            with self.metrics.stage_seconds.time(stage='move'):
+                last.out_sha256 = await self.transfer.move(tmp_fp, out_fp, progress=self.log_transfer(out_fp))
+            self.store.save(last)
+            shutil.rmtree(work_dir, ignore_errors=True)
+        except Exception as e:
+            self.logger.exception('Stitching %s failed', broadcast)
+            embed.colour = Colour.red()
+            embed.add_field(name='Stitch Failed', value=str(e), inline=False)
+        finally:
+            self.stitching.discard(broadcast)
+        await self.send_notification(embed=embed)
+
+    def log_transfer(self, out_fp: str) -> Callable[[int, int], None]:
+        """Progress callback for FileTransfer, logs every 10%"""
+        logged = [0]
+
+        def _log(done: int, total: int):
+            percent = 100 * done // total if total else 100
+            if percent >= logged[0] + 10:
+                logged[0] = percent - percent % 10
+                self.logger.debug('Moving %s: %d%%', out_fp, percent)
+        return _log
 
     async def handler_run(self, r: web.Request) -> web.Response:
         self.logger.debug(r.path)
@@ -325,35 +1040,163 @@ class Encoder:
         resp = Response()
         job_json: dict = await r.json()
         try:
-            self.jobs.append(Job.from_dict(job_json))
-            job = self.jobs[-1]
+            job = Job.from_dict(job_json)
         except Exception as e:
             resp.error = str(e)
             resp.status = web.HTTPBadRequest.status_code
             return resp.web_response
         self.logger.debug('Got job from %s\n%s', r.remote, job.to_json(indent=2))
-        in_fp = os.path.join(self.src_path, job.input)
-        if not os.path.exists(in_fp):
-            status = f"Source file not found: {in_fp}"
-            embed = self.make_embed_error('Encode failed', e=status)
-            await self.send_notification(embed=embed)
-            self.logger.error(status)
-            job.ignore = True
-            self.write_jobs()
-            resp.error = status
+        status, done = await self.submit(job)
+        if status == 'missing':
+            resp.error = f"Source file not found: {os.path.join(self.src_path, job.input)}"
             resp.status = web.HTTPBadRequest.status_code
             return resp.web_response
+        elif status == 'ignored':
+            resp.data = "Job ignored"
+            return resp.web_response
+        elif status == 'duplicate':
+            resp.data = "Job already queued"
+            return resp.web_response
+        elif status == 'draining':
+            resp.error = "Shutting down, not accepting jobs"
+            resp.status = web.HTTPServiceUnavailable.status_code
+            return resp.web_response
         if immediate:
-            self.loop.create_task(self.run_job(job))
-            resp.data = "Job started"
+            resp.data = "Job queued"
             return resp.web_response
         start = time.perf_counter()
-        await self.run_job(job)
+        await done
         resp.time = time.perf_counter() - start
         resp.data = "Job done"
         return resp.web_response
 
+    async def handler_batch(self, r: web.Request) -> web.Response:
+        """Queue several jobs, JSON body is a list of jobs. Returns the status of each, does not wait for them."""
+        self.logger.debug(r.path)
+        resp = Response()
+        try:
+            data = await r.json()
+            if not isinstance(data, list):
+                raise ValueError('Expected a list of jobs')
+        except ValueError as e:
+            resp.error = str(e)
+            resp.status = web.HTTPBadRequest.status_code
+            return resp.web_response
+        results = []
+        for job_json in data:
+            if not isinstance(job_json, dict):
+                results.append(dict(input=None, status='invalid', error='Expected a job object'))
+                continue
+            try:
+                job = Job.from_dict(job_json)
+            except Exception as e:
+                results.append(dict(input=job_json.get('input'), status='invalid', error=f'Invalid job: {e!r}'))
+                continue
+            status, _ = await self.submit(job)
+            results.append(dict(input=job.input, id=job.id, status=status))
+        resp.data = results
+        return resp.web_response
+
+    async def handler_broadcast(self, r: web.Request) -> web.Response:
+        """A segmented recording ended, JSON body: parts (number of parts sent). Parts are stitched once encoded."""
+        self.logger.debug(r.path)
+        resp = Response()
+        broadcast = r.match_info['broadcast']
+        try:
+            parts = int((await r.json())['parts'])
+        except (ValueError, KeyError, TypeError) as e:
+            resp.error = f'Invalid body: {e!r}'
+            resp.status = web.HTTPBadRequest.status_code
+            return resp.web_response
+        jobs = [j for j in self.store.jobs.values() if j.broadcast == broadcast]
+        if not jobs:
+            resp.error = f'Broadcast {broadcast} not found'
+            resp.status = web.HTTPNotFound.status_code
+            return resp.web_response
+        for job in jobs:
+            job.parts_total = parts
+            self.store.save(job)
+        self.logger.info('Broadcast %s ended with %d parts, %d received', broadcast, parts, len(jobs))
+        self.loop.create_task(self.stitch(broadcast))
+        resp.data = "Broadcast ended"
+        return resp.web_response
+
+    async def submit(self, job: Job) -> Tuple[str, Optional[asyncio.Future]]:
+        """
+        Validate, prepare and queue a new job. Returns its status (queued, duplicate, ignored, missing or draining)
+        and a future resolved once it has run if it was queued.
+        """
+        if self.scheduler.draining:
+            return 'draining', None
+        in_fp = os.path.join(self.src_path, job.input)
+        if not os.path.exists(in_fp):
+            status = f"Source file not found: {in_fp}"
+            embed = self.make_embed_error('Encode failed', e=status)
+            await self.send_notification(embed=embed)
+            self.logger.error(status)
+            job.ignored = True
+            self.store.save(job)
+            self.metrics.jobs.inc(codec=None, outcome='missing')
+            return 'missing', None
+        for other in self.store.jobs.values():
+            if other.input == job.input and other.statuses() & {'queued', 'deferred', 'running'}:
+                self.logger.info('%s is already queued', job.input)
+                return 'duplicate', None
+        if not await self.prepare_job(job):
+            return 'ignored', None
+        return 'queued', self.enqueue(job)
+
+    def is_claimed(self, name: str) -> bool:
+        """True if any job was created for the raw file name"""
+        return any(name in (j.input, j.raw_copy) or name in (j.pieces or ()) for j in self.store.jobs.values())
+
+    def job_from_file(self, name: str) -> Job:
+        """
+        Job for a raw recording named {time}_{user}_{title}.flv as written by the Recorder,
+        non-empty pieces of it written after streamlink restarts are joined to it
+        """
+        base = re.sub(r'\.(part|piece)?\d+$', '', os.path.splitext(name)[0])
+        parts = base.split('_', 2)
+        pieces = [p for p in find_pieces(name, os.listdir(self.src_path))
+                  if os.path.getsize(os.path.join(self.src_path, p))]
+        return Job(
+            input=name,
+            title=parts[2].replace('_', ' ') if len(parts) > 2 else base,
+            user=parts[1] if len(parts) > 1 else 'unknown',
+            created_at=get_datetime(name, self.time_format, self.src_path),
+            pieces=pieces or None,
+        )
+
+    async def ingest_files(self, names: List[str]):
+        """Queue raw files found by the ingester"""
+        results = []
+        for name in names:
+            status, _ = await self.submit(self.job_from_file(name))
+            results.append(f'- {name}: {status}')
+        self.logger.info('Ingested %d files\n%s', len(names), '\n'.join(results))
+        embed = self.make_embed()
+        embed.title = 'Ingest'
+        embed.description = '\n'.join(results)
+        await self.send_notification(embed=embed)
+
     async def delete_raw(self, raw_fp: str, proc_fp: str):
+        await self.check_duration(raw_fp, proc_fp)
+        raw_size_str = f'{os.path.getsize(raw_fp)/1e6:,.1f}MB'
+        try:
+            if not self.dry_run:
+                with self.metrics.stage_seconds.time(stage='delete'):
+                    os.unlink(raw_fp)
+                    remove_sidecar(raw_fp)
+            self.logger.info('Deleted: %s [%s]', raw_fp, raw_size_str)
+        except Exception as e:
+            self.logger.error('Failed to delete %s [%s]: %s', raw_fp, raw_size_str, str(e))
+            raise
+
+    async def check_duration(self, raw_fp: str, proc_fp: str, offset: int = 0):
+        """
+        Raises an exception if proc_fp is missing or more than 5 seconds shorter than raw_fp,
+        offset is the number of seconds trimmed off the start of proc_fp
+        """
         if not os.path.exists(proc_fp):
             self.logger.critical('%s -> MISSING %s', raw_fp, proc_fp)
             raise FileNotFoundError(proc_fp)
@@ -361,22 +1204,16 @@ class Encoder:
         proc_size = os.path.getsize(proc_fp)
         raw_size_str = f'{raw_size/1e6:,.1f}MB'
         proc_size_str = f'{proc_size/1e6:,.1f}MB'
-        raw_dur = await read_video_info(raw_fp, self.logger)
-        proc_dur = await read_video_info(proc_fp, self.logger)
+        with self.metrics.stage_seconds.time(stage='probe'):
+            raw_dur, proc_dur = await asyncio.gather(probe_duration(raw_fp, self.logger, self.probe_cache),
+                                                     probe_duration(proc_fp, self.logger, self.probe_cache))
         if raw_dur is None:
             self.logger.warning('Cannot parse duration: %s', raw_fp)
             raise Exception('Cannot parse raw duration')
         elif proc_dur is None:
             self.logger.warning('Cannot parse duration: %s', proc_fp)
             raise Exception('Cannot parse processed duration')
-        dur_diff = raw_dur - proc_dur
+        dur_diff = raw_dur - timedelta(seconds=offset) - proc_dur
         if dur_diff.total_seconds() > 5:
             self.logger.warning('%s [%s] -> SHORTER %s [%s]', raw_dur, raw_size_str, proc_dur, proc_size_str)
             raise Exception(f'{proc_fp} is too short: {proc_dur}')
-        try:
-            if not self.dry_run:
-                os.unlink(raw_fp)
-            self.logger.info('Deleted: %s [%s]', raw_fp, raw_size_str)
-        except Exception as e:
-            self.logger.error('Failed to delete %s [%s]: %s', raw_fp, raw_size_str, str(e))
-            raise
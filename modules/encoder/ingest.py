@@ -0,0 +1,198 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import struct
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+# <recording>.piece<N>.<ext>, written by the recorder after streamlink was restarted
+PIECE_RE = re.compile(r'(?P<base>.+)\.piece(?P<num>\d+)(?P<ext>\.[^.]+)')
+
+
+def piece_of(name: str) -> Optional[Tuple[str, int]]:
+    """Recording name and number of a piece file name, None if it is not a piece"""
+    if m := PIECE_RE.fullmatch(name):
+        return m.group('base') + m.group('ext'), int(m.group('num'))
+    return None
+
+
+def find_pieces(name: str, names: Iterable[str]) -> List[str]:
+    """Pieces of the recording name among names, in recording order"""
+    pieces = []
+    for n in names:
+        if (piece := piece_of(n)) and piece[0] == name:
+            pieces.append((piece[1], n))
+    return [n for _, n in sorted(pieces)]
+
+
+class Inotify:
+    """Minimal inotify binding for one directory, raises OSError where inotify is not available"""
+    def __init__(self, path: str, mask: int = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+        lib_name = ctypes.util.find_library('c')
+        if not lib_name:
+            raise OSError('libc not found')
+        libc = ctypes.CDLL(lib_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not supported')
+        self.fd: int = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err), path)
+
+    def read(self) -> List[Tuple[int, str]]:
+        """Pending events as (mask, file name)"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if name:
+                events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Candidate:
+    __slots__ = ('size', 'mtime')
+
+    def __init__(self):
+        self.size: int = -1
+        self.mtime: float = 0
+
+
+class Ingester:
+    """
+    Watches a directory for raw recordings nobody submitted
+
+    New and changed files are reported by inotify, or found by rescanning every
+    poll_interval seconds if inotify is not available. A file is ready once its
+    size stopped changing and it was not modified for settle seconds, ready
+    files are passed to on_ready in batches. Files for which is_claimed returns
+    True are skipped, the first scan picks up the backlog left from before startup.
+
+    Pieces of a restarted recording are never passed on their own, a recording
+    is only ready once none of its pieces changed for settle seconds either.
+    The recorder starts the next piece within seconds, so a recording is not
+    taken while streamlink is being restarted.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, path: str,
+                 on_ready: Callable[[List[str]], Awaitable[None]], is_claimed: Callable[[str], bool],
+                 settle: float = 120, poll_interval: float = 60, extensions: Tuple[str, ...] = ('.flv',),
+                 logger: logging.Logger = None):
+        self.loop = loop
+        self.path: str = path
+        self.on_ready = on_ready
+        self.is_claimed = is_claimed
+        self.settle: float = settle
+        self.poll_interval: float = poll_interval
+        self.extensions: Tuple[str, ...] = extensions
+        self.logger: logging.Logger = logger or logging.getLogger(self.__class__.__name__)
+        self.candidates: Dict[str, Candidate] = {}
+        self.inotify: Optional[Inotify] = None
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        try:
+            self.inotify = Inotify(self.path)
+            self.loop.add_reader(self.inotify.fd, self.on_events)
+            self.logger.info('Watching %s with inotify', self.path)
+        except OSError as e:
+            self.inotify = None
+            self.logger.warning('Cannot use inotify (%s), polling %s every %.0fs', str(e), self.path, self.poll_interval)
+        self.scan()
+        self.tasks.append(self.loop.create_task(self.checker()))
+        if not self.inotify:
+            self.tasks.append(self.loop.create_task(self.poller()))
+
+    async def close(self):
+        if self.inotify:
+            self.loop.remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+    def wanted(self, name: str) -> bool:
+        return name.endswith(self.extensions) and not piece_of(name) and not self.is_claimed(name)
+
+    def scan(self):
+        for name in os.listdir(self.path):
+            if name not in self.candidates and self.wanted(name):
+                self.candidates[name] = Candidate()
+
+    def on_events(self):
+        for _, name in self.inotify.read():
+            if name not in self.candidates and self.wanted(name):
+                self.logger.debug('New file %s', name)
+                self.candidates[name] = Candidate()
+
+    async def poller(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.scan()
+
+    def ready(self) -> List[str]:
+        """Removes and returns candidates which stopped changing"""
+        now = time.time()
+        ret = []
+        names = os.listdir(self.path) if self.candidates else []
+        for name, cand in list(self.candidates.items()):
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                del self.candidates[name]
+                continue
+            # Total size and latest change of the recording and its pieces
+            size, mtime = st.st_size, st.st_mtime
+            for piece in find_pieces(name, names):
+                try:
+                    st = os.stat(os.path.join(self.path, piece))
+                except FileNotFoundError:
+                    continue
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+            if self.is_claimed(name):
+                del self.candidates[name]
+            elif size == cand.size and mtime == cand.mtime and now - mtime >= self.settle:
+                del self.candidates[name]
+                ret.append(name)
+            else:
+                cand.size = size
+                cand.mtime = mtime
+        return sorted(ret)
+
+    async def checker(self):
+        interval = min(max(self.settle / 4, 1), 30)
+        while True:
+            if names := self.ready():
+                try:
+                    await self.on_ready(names)
+                except Exception:
+                    self.logger.exception('Cannot submit %s', ', '.join(names))
+                    for name in names:
+                        self.candidates.setdefault(name, Candidate())
+            await asyncio.sleep(interval)
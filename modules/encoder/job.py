@@ -1,11 +1,14 @@
 import json
 import os
+import uuid
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional, Set
 
 
 class Job:
     def __init__(self, **kwargs):
+        # Unique job ID
+        self.id: str = kwargs.pop('id', None) or uuid.uuid4().hex
         # Input file name
         self.input: str = kwargs.pop('input')
         # File name
@@ -32,12 +35,45 @@ class Job:
         self.enc_end: Optional[datetime] = kwargs.pop('enc_end', None)
         if isinstance(self.enc_end, str):
             self.enc_end = datetime.fromisoformat(self.enc_end)
+        # Input was remuxed to MP4 while recording, copy jobs use it as is
+        self.remuxed: Optional[bool] = kwargs.pop('remuxed', None)
+        # Raw recording kept next to a remuxed input in case the remux is broken
+        self.raw_copy: Optional[str] = kwargs.pop('raw_copy', None)
+        # Files recorded after input when streamlink was restarted, joined to input before encoding
+        self.pieces: Optional[List[str]] = kwargs.pop('pieces', None)
+        # Segmented recordings, ID shared by all parts of one broadcast, index of this part
+        # and the number of parts once the recording ended
+        self.broadcast: Optional[str] = kwargs.pop('broadcast', None)
+        self.part: Optional[int] = kwargs.pop('part', None)
+        self.parts_total: Optional[int] = kwargs.pop('parts_total', None)
         # Seconds trimmed off the video start
         self.start_seconds: Optional[int] = kwargs.pop('start_seconds', None)
+        # Number of segments encoded in parallel, None if encoded in one piece
+        self.chunks: Optional[int] = kwargs.pop('chunks', None)
+        # x265 preset picked for this job and why
+        self.preset: Optional[str] = kwargs.pop('preset', None)
+        self.preset_reason: Optional[str] = kwargs.pop('preset_reason', None)
+        # Seconds of video encoded
+        self.duration: Optional[float] = kwargs.pop('duration', None)
+        # Source and encoded file sizes in bytes
+        self.in_size: Optional[int] = kwargs.pop('in_size', None)
+        self.out_size: Optional[int] = kwargs.pop('out_size', None)
+        # SHA-256 of the encoded file, computed while moving it to the output directory
+        self.out_sha256: Optional[str] = kwargs.pop('out_sha256', None)
+        # Remote worker which encoded this file, None if it was encoded locally
+        self.worker: Optional[str] = kwargs.pop('worker', None)
         # FFMPEG command used for encoding this file
         self.ffmpeg_args: Optional[str] = kwargs.pop('ffmpeg_args', None)
         # Error text
         self.error: Optional[str] = kwargs.pop('error', None)
+        # Scheduling priority, lower runs first
+        self.priority: int = int(kwargs.pop('priority', 0))
+        # Why the job is waiting for disk space, None once it can run
+        self.deferred: Optional[str] = kwargs.pop('deferred', None)
+        # Time the job was added to the encode queue
+        self.queued_at: Optional[datetime] = kwargs.pop('queued_at', None)
+        if isinstance(self.queued_at, str):
+            self.queued_at = datetime.fromisoformat(self.queued_at)
 
     def __repr__(self):
         d = {}
@@ -46,6 +82,23 @@ class Job:
                 d[k] = v
         return str(d)
 
+    def statuses(self) -> Set[str]:
+        """Returns the states this job is in, a finished job can be both deleted and done"""
+        ret = set()
+        if self.error:
+            ret.add('error')
+        if self.ignored:
+            ret.add('ignored')
+        if self.deleted:
+            ret.add('deleted')
+        if self.enc_start and not self.enc_end and not self.error:
+            ret.add('running')
+        elif self.queued_at and not self.enc_start and not self.ignored and not self.error:
+            ret.add('deferred' if self.deferred else 'queued')
+        elif self.enc_end and self.deleted is not None and not self.error:
+            ret.add('done')
+        return ret
+
     @classmethod
     def from_dict(cls, data: dict):
         if not data:
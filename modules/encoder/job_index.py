@@ -0,0 +1,109 @@
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .job import Job
+
+
+def local_naive(dt: datetime) -> datetime:
+    """Convert aware datetimes to naive local time so they can be compared"""
+    if dt.tzinfo is not None:
+        return dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+class JobIndex:
+    """
+    In-memory secondary indexes over jobs
+
+    Jobs are numbered in insertion order, each index maps a value to the set of job numbers.
+    version is incremented on every change.
+    """
+    def __init__(self):
+        self.version: int = 0
+        self.jobs: Dict[int, Job] = {}
+        # Job ID -> number
+        self.seq: Dict[str, int] = {}
+        # Index name -> value -> job numbers
+        self.indexes: Dict[str, Dict[str, Set[int]]] = dict(user={}, codec={}, status={})
+        # Job number -> index name -> values it is currently indexed under
+        self._keys: Dict[int, Dict[str, Tuple[str, ...]]] = {}
+
+    @staticmethod
+    def keys_for(job: Job) -> Dict[str, Tuple[str, ...]]:
+        return dict(
+            user=(job.user.lower(),) if job.user else (),
+            codec=(job.enc_codec,) if job.enc_codec else (),
+            status=tuple(sorted(job.statuses())),
+        )
+
+    def update(self, job: Job):
+        """Add job or re-index it after it changed"""
+        num = self.seq.get(job.id)
+        if num is None:
+            num = len(self.seq)
+            self.seq[job.id] = num
+        self.jobs[num] = job
+        new_keys = self.keys_for(job)
+        old_keys = self._keys.get(num, {})
+        for name, values in new_keys.items():
+            old = old_keys.get(name, ())
+            if old == values:
+                continue
+            index = self.indexes[name]
+            for v in old:
+                index[v].discard(num)
+            for v in values:
+                index.setdefault(v, set()).add(num)
+        self._keys[num] = new_keys
+        self.version += 1
+
+    def rebuild(self, jobs: Iterable[Job]):
+        self.__init__()
+        for job in jobs:
+            self.update(job)
+
+    def query(self, user: str = None, codec: str = None, status: List[str] = None,
+              since: datetime = None, until: datetime = None,
+              cursor: int = None, limit: int = None, desc=False) -> Tuple[List[Job], Optional[int], int]:
+        """
+        Returns matching jobs in insertion order (newest first if desc),
+        the cursor for the next page (None if this is the last) and the total number of matches.
+        Multiple statuses match jobs with any of them.
+        """
+        candidates: Optional[Set[int]] = None
+        filters = []
+        if user:
+            filters.append(self.indexes['user'].get(user.lower(), set()))
+        if codec:
+            filters.append(self.indexes['codec'].get(codec, set()))
+        if status:
+            filters.append(set().union(*(self.indexes['status'].get(s, set()) for s in status)))
+        for f in sorted(filters, key=len):
+            candidates = set(f) if candidates is None else candidates & f
+        if candidates is None:
+            candidates = self.jobs.keys()
+        nums = sorted(candidates, reverse=desc)
+        if since or until:
+            since = local_naive(since) if since else None
+            until = local_naive(until) if until else None
+            matched = []
+            for n in nums:
+                created_at = self.jobs[n].created_at
+                if not created_at:
+                    continue
+                created_at = local_naive(created_at)
+                if since and created_at < since:
+                    continue
+                if until and created_at >= until:
+                    continue
+                matched.append(n)
+            nums = matched
+        total = len(nums)
+        if cursor is not None:
+            nums = [n for n in nums if (n < cursor if desc else n > cursor)]
+        next_cursor = None
+        if limit is not None and len(nums) > limit:
+            nums = nums[:max(limit, 0)]
+            if nums:
+                next_cursor = nums[-1]
+        return [self.jobs[n] for n in nums], next_cursor, total
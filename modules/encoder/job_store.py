@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional, TextIO
+
+from .job import Job
+from .job_index import JobIndex
+
+
+class JobStore:
+    """
+    Job history kept in a JSON snapshot plus an append-only journal
+
+    The snapshot has the same format as the old jobs.json, a list of Job dicts.
+    Every update appends the full job as one JSON line to the journal, on load
+    the journal is replayed over the snapshot, the last line for a job ID wins.
+    Compaction folds the journal back into the snapshot off the event loop.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, path: str, **kwargs):
+        self.loop = loop
+        self.path: str = path
+        self.journal_path: str = os.path.splitext(path)[0] + '.journal'
+        # Compact after this many journal appends
+        self.compact_every: int = int(kwargs.pop('compact_every', 500))
+        self.dry_run: bool = kwargs.pop('dry_run', False)
+        self.logger: logging.Logger = kwargs.pop('logger', None) or logging.getLogger(self.__class__.__name__)
+        # Jobs in insertion order
+        self.jobs: Dict[str, Job] = {}
+        self.index = JobIndex()
+        self._journal: Optional[TextIO] = None
+        self._appends = 0
+        self._compact_task: Optional[asyncio.Task] = None
+
+    @property
+    def rotated_path(self) -> str:
+        """Journal being folded into the snapshot by a running compaction"""
+        return f'{self.journal_path}.1'
+
+    def load(self) -> List[Job]:
+        """Read snapshot and replay journals, returns all jobs"""
+        self.jobs.clear()
+        migrated = False
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as fr:
+                for d in json.load(fr):
+                    migrated |= 'id' not in d
+                    job = Job.from_dict(d)
+                    self.jobs[job.id] = job
+        replayed = 0
+        for fp in (self.rotated_path, self.journal_path):
+            replayed += self._replay(fp)
+        self.index.rebuild(self.jobs.values())
+        self.logger.info('Loaded %d jobs, replayed %d journal entries', len(self.jobs), replayed)
+        # Jobs from old files had no ID, they must be written before the journal refers to them
+        if migrated and not self.dry_run:
+            self.logger.info('Migrating %s', self.path)
+            self._write_snapshot([j.to_dict(no_dt=True) for j in self.jobs.values()])
+        if not self.dry_run:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        return list(self.jobs.values())
+
+    def _replay(self, fp: str) -> int:
+        if not os.path.exists(fp):
+            return 0
+        num = 0
+        with open(fp, 'r', encoding='utf-8') as fr:
+            for i, line in enumerate(fr):
+                if not line.strip():
+                    continue
+                try:
+                    job = Job.from_dict(json.loads(line))
+                except Exception as e:
+                    # Most likely a partial line from a crash
+                    self.logger.warning('Skipping %s line %d: %s', fp, i + 1, str(e))
+                    continue
+                self.jobs[job.id] = job
+                num += 1
+        return num
+
+    def save(self, job: Job):
+        """Journal the current state of job"""
+        self.jobs[job.id] = job
+        self.index.update(job)
+        if self.dry_run or not self._journal:
+            return
+        self._journal.write(job.to_json() + '\n')
+        self._journal.flush()
+        self._appends += 1
+        if self._appends >= self.compact_every and not self._compact_task:
+            self._compact_task = self.loop.create_task(self.compact())
+
+    async def compact(self):
+        """Write snapshot and truncate journal"""
+        if self.dry_run:
+            return
+        data = [j.to_dict(no_dt=True) for j in self.jobs.values()]
+        # New appends go to a fresh journal while the snapshot is written
+        if self._journal:
+            self._journal.close()
+        if os.path.exists(self.journal_path):
+            if os.path.exists(self.rotated_path):
+                # Left over from a failed compaction, keep its entries
+                with open(self.rotated_path, 'a', encoding='utf-8') as fw, \
+                        open(self.journal_path, 'r', encoding='utf-8') as fr:
+                    fw.write(fr.read())
+                os.unlink(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.rotated_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._appends = 0
+        try:
+            await self.loop.run_in_executor(None, self._write_snapshot, data)
+            if os.path.exists(self.rotated_path):
+                os.unlink(self.rotated_path)
+            self.logger.info('Jobs file compacted [%d jobs]', len(data))
+        except Exception:
+            self.logger.exception('Compaction failed')
+        finally:
+            self._compact_task = None
+
+    def _write_snapshot(self, data: list):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fw:
+            json.dump(data, fw, indent=2)
+            fw.flush()
+            os.fsync(fw.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def close(self):
+        if self._compact_task:
+            await self._compact_task
+        await self.compact()
+        if self._journal:
+            self._journal.close()
+            self._journal = None
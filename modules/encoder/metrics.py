@@ -0,0 +1,132 @@
+import math
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def fmt_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Base of metrics exported in the Prometheus text format, one value per label combination"""
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name: str = name
+        self.description: str = description
+        self.labels: Tuple[str, ...] = tuple(labels)
+        self.values: Dict[tuple, float] = {}
+
+    def key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} expects labels {self.labels}, got {tuple(labels)}')
+        return tuple('none' if labels[k] is None else str(labels[k]) for k in self.labels)
+
+    def fmt_labels(self, key: tuple, extra: str = '') -> str:
+        pairs = [f'{k}="{escape(v)}"' for k, v in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{self.fmt_labels(k)} {fmt_value(v)}' for k, v in sorted(self.values.items())]
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}'] + self.samples()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only increase')
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (), buckets: Sequence[float] = None):
+        super().__init__(name, description, labels)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets or self.default_buckets)) + (math.inf,)
+        # Label key -> per bucket counts (not cumulative), sum
+        self.counts: Dict[tuple, List[int]] = {}
+        self.sums: Dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts = self.counts.setdefault(key, [0] * len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the with block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                le = f'le="{fmt_value(bound)}"'
+                lines.append(f'{self.name}_bucket{self.fmt_labels(key, le)} {total}')
+            lines.append(f'{self.name}_sum{self.fmt_labels(key)} {fmt_value(self.sums[key])}')
+            lines.append(f'{self.name}_count{self.fmt_labels(key)} {total}')
+        return lines
+
+
+class EncoderMetrics:
+    """Metrics of the encoder pipeline, rendered by the /metrics route"""
+    def __init__(self):
+        self.jobs = Counter('encoder_jobs_total', 'Finished jobs by codec and outcome', ('codec', 'outcome'))
+        self.encode_seconds = Histogram('encoder_encode_seconds', 'Encode wall time', ('codec',),
+                                        buckets=(1, 10, 30, 60, 300, 600, 1800, 3600, 7200, 14400, 28800))
+        self.speed = Histogram('encoder_speed_ratio', 'Seconds of video encoded per wall second', ('codec',),
+                               buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 25, 50, 100))
+        self.allocation_speed = Histogram('encoder_allocation_speed_ratio',
+                                          'Speed of single x265 processes by the number of CPUs they had', ('cpus',),
+                                          buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 25, 50, 100))
+        self.bytes_in = Counter('encoder_bytes_in_total', 'Size of encoded source files', ('codec',))
+        self.bytes_out = Counter('encoder_bytes_out_total', 'Size of encoded output files', ('codec',))
+        self.queue_depth = Gauge('encoder_queue_depth', 'Jobs waiting for a slot', ('codec',))
+        self.running = Gauge('encoder_running_jobs', 'Jobs encoding locally or on workers', ('codec',))
+        self.stage_seconds = Histogram('encoder_stage_seconds', 'Time spent in pipeline stages', ('stage',))
+        self.notification_seconds = Histogram('encoder_notification_seconds', 'Discord notification latency')
+
+    @property
+    def metrics(self) -> List[Metric]:
+        return [v for v in vars(self).values() if isinstance(v, Metric)]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,107 @@
+import re
+from datetime import timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from .job import Job
+
+re_preset = re.compile(r'-preset(?::v)?\s+(\w+)')
+
+
+def fmt_td(seconds: float) -> str:
+    return str(timedelta(seconds=int(seconds)))
+
+
+class PresetPolicy:
+    """
+    Picks the x265 preset of each HEVC job so the backlog drains within target_latency
+
+    Encode speed (seconds of video per second of wall time) is tracked per preset
+    as an exponentially weighted moving average. Presets without measurements are
+    extrapolated from a measured one using rough relative speeds. The slowest
+    preset whose estimated drain time fits the target wins, the fastest allowed
+    preset is used when none does.
+    """
+    # x265 presets, fastest first, with speeds relative to medium
+    relative_speed = {
+        'ultrafast': 6.0,
+        'superfast': 5.0,
+        'veryfast': 3.5,
+        'faster': 2.2,
+        'fast': 1.8,
+        'medium': 1.0,
+        'slow': 0.45,
+        'slower': 0.2,
+        'veryslow': 0.1,
+    }
+
+    def __init__(self, target_latency: float, default: str = 'fast', fastest: str = 'veryfast',
+                 slowest: str = 'slow', alpha: float = 0.3):
+        # Seconds
+        self.target_latency: float = target_latency
+        self.default: str = default
+        names = list(self.relative_speed)
+        self.presets = names[names.index(fastest):names.index(slowest) + 1]
+        self.alpha: float = alpha
+        # Preset -> EWMA of speed
+        self.speeds: Dict[str, float] = {}
+        # Preset -> number of measurements
+        self.samples: Dict[str, int] = {}
+        # Incremented whenever speeds change
+        self.version: int = 0
+
+    def observe(self, preset: str, speed: float):
+        if preset not in self.relative_speed or speed <= 0:
+            return
+        if preset in self.speeds:
+            self.speeds[preset] += self.alpha * (speed - self.speeds[preset])
+        else:
+            self.speeds[preset] = speed
+        self.samples[preset] = self.samples.get(preset, 0) + 1
+        self.version += 1
+
+    def load_history(self, jobs: Iterable[Job], last: int = 20):
+        """Seed speeds from the last finished HEVC jobs"""
+        done = [j for j in jobs if j.enc_codec == 'hevc' and j.duration and j.enc_start and j.enc_end and not j.error]
+        done.sort(key=lambda j: j.enc_end)
+        for job in done[-last:]:
+            preset = job.preset
+            if not preset and job.ffmpeg_args and (m := re_preset.search(job.ffmpeg_args)):
+                preset = m.group(1)
+            elapsed = (job.enc_end - job.enc_start).total_seconds()
+            if preset and elapsed > 0:
+                self.observe(preset, job.duration / elapsed)
+
+    def speed(self, preset: str) -> Optional[float]:
+        """Measured or extrapolated speed of preset, None before anything was measured"""
+        if preset in self.speeds:
+            return self.speeds[preset]
+        if not self.speeds:
+            return None
+        # Extrapolate from the preset with the most measurements
+        ref = max(self.samples, key=self.samples.get)
+        return self.speeds[ref] * self.relative_speed[preset] / self.relative_speed[ref]
+
+    def choose(self, backlog: float, parallel: int = 1) -> Tuple[str, str]:
+        """
+        Returns preset and the reason it was picked.
+        backlog is the seconds of video waiting to be encoded, including the current job,
+        parallel the number of HEVC encodes running at the same time.
+        """
+        parallel = max(parallel, 1)
+        target = fmt_td(self.target_latency)
+        if self.speed(self.default) is None:
+            return self.default, 'no encode speed measured yet'
+        for preset in reversed(self.presets):
+            speed = self.speed(preset)
+            eta = backlog / (speed * parallel)
+            if eta <= self.target_latency:
+                return preset, (f'{fmt_td(backlog)} backlog at {speed:.2f}x on {parallel} slot(s) '
+                                f'drains in {fmt_td(eta)}, target {target}')
+        preset = self.presets[0]
+        speed = self.speed(preset)
+        eta = backlog / (speed * parallel)
+        return preset, (f'{fmt_td(backlog)} backlog at {speed:.2f}x on {parallel} slot(s) '
+                        f'drains in {fmt_td(eta)} even with the fastest preset, target {target}')
+
+    def to_dict(self) -> dict:
+        return dict(target_latency=self.target_latency, speeds={p: round(s, 3) for p, s in self.speeds.items()})
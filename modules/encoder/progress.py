@@ -0,0 +1,85 @@
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+
+from utils import parse_duration
+
+
+class Progress:
+    """Live progress of one encode, updates are fanned out to subscriber queues"""
+    def __init__(self, job_id: str, duration: Optional[float] = None):
+        self.job_id: str = job_id
+        # Input duration in seconds, used for percent complete
+        self.duration: Optional[float] = duration
+        self.started: datetime = datetime.utcnow()
+        self.frame: int = 0
+        self.fps: float = 0.0
+        self.total_size: int = 0
+        # Seconds of output written
+        self.out_time: float = 0.0
+        # Realtime speed factor reported by ffmpeg
+        self.speed: Optional[float] = None
+        # running/done/error
+        self.state: str = 'running'
+        self.subscribers: List[asyncio.Queue] = []
+
+    @property
+    def percent(self) -> Optional[float]:
+        if not self.duration:
+            return None
+        return min(100.0, 100 * self.out_time / self.duration)
+
+    def update(self, sample: dict):
+        """Update from a watch_ffmpeg sample"""
+        try:
+            if 'frame' in sample:
+                self.frame = int(sample['frame'])
+            if 'fps' in sample:
+                self.fps = float(sample['fps'])
+            if 'total_size' in sample:
+                self.total_size = int(sample['total_size'])
+            if 'speed' in sample:
+                self.speed = float(sample['speed'])
+            if (td := parse_duration(sample.get('out_time', ''))) is not None:
+                self.out_time = td.total_seconds()
+        except ValueError:
+            return
+        self.publish()
+
+    def finish(self, state: str = 'done'):
+        self.state = state
+        if state == 'done' and self.duration:
+            self.out_time = self.duration
+        self.publish()
+
+    def publish(self):
+        data = self.to_dict()
+        for q in self.subscribers:
+            # Slow readers only need the latest state
+            if q.full():
+                q.get_nowait()
+            q.put_nowait(data)
+
+    def subscribe(self) -> asyncio.Queue:
+        q = asyncio.Queue(maxsize=16)
+        q.put_nowait(self.to_dict())
+        self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue):
+        if q in self.subscribers:
+            self.subscribers.remove(q)
+
+    def to_dict(self) -> dict:
+        return dict(
+            id=self.job_id,
+            state=self.state,
+            started=self.started.isoformat(),
+            frame=self.frame,
+            fps=self.fps,
+            total_size=self.total_size,
+            out_time=self.out_time,
+            duration=self.duration,
+            speed=self.speed,
+            percent=self.percent,
+        )
@@ -0,0 +1,262 @@
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .job import Job
+
+
+class Deferred(Exception):
+    """Raised by run_func when a job cannot start yet, it is queued again after delay seconds"""
+    def __init__(self, reason: str, delay: float):
+        super().__init__(reason)
+        self.delay: float = delay
+
+
+class Slot:
+    """One concurrent worker slot for a codec"""
+    def __init__(self, codec: str, num: int):
+        self.codec: str = codec
+        self.num: int = num
+        # Job currently running in this slot
+        self.job: Optional[Job] = None
+        # Time the current job was started
+        self.since: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def to_dict(self) -> dict:
+        d = dict(codec=self.codec, slot=self.num, busy=self.job is not None)
+        if self.job:
+            d['input'] = self.job.input
+            d['since'] = self.since.isoformat()
+        return d
+
+
+class Lease:
+    """A queued job handed out to a remote worker, it is re-queued unless renewed before it expires"""
+    def __init__(self, codec: str, priority: int, seq: int, job: Job, fut: asyncio.Future, worker: str, seconds: float):
+        self.id: str = uuid.uuid4().hex
+        self.codec: str = codec
+        self.priority: int = priority
+        # Submission order, kept so an expired job goes back to its old place
+        self.seq: int = seq
+        self.job: Job = job
+        self.fut: asyncio.Future = fut
+        # Worker name
+        self.worker: str = worker
+        self.seconds: float = seconds
+        self.since: datetime = datetime.utcnow()
+        self.expires: float = 0
+        self.expires_at: Optional[datetime] = None
+        self.renew()
+
+    def renew(self):
+        self.expires = time.monotonic() + self.seconds
+        self.expires_at = datetime.utcnow() + timedelta(seconds=self.seconds)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() > self.expires
+
+    def to_dict(self) -> dict:
+        return dict(id=self.id, codec=self.codec, input=self.job.input, worker=self.worker,
+                    since=self.since.isoformat(), expires=self.expires_at.isoformat())
+
+
+class Scheduler:
+    """
+    Bounded worker pool with one priority queue per codec
+
+    Each codec gets a fixed number of slots, a slot runs one job at a time.
+    Lower priority values run first, ties are broken by submission order.
+    Queued jobs can also be leased by remote workers, on_expire is called
+    with the job when a lease runs out and the job goes back in the queue.
+    Once draining, running jobs finish but nothing new is started or leased.
+    version is incremented whenever status() would change.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, run_func: Callable[[Job], Awaitable[None]],
+                 slots: Dict[str, int], logger: logging.Logger = None,
+                 on_expire: Callable[[Job], None] = None):
+        self.loop = loop
+        self.run_func = run_func
+        self.on_expire = on_expire
+        self.logger: logging.Logger = logger or logging.getLogger(self.__class__.__name__)
+        self.queues: Dict[str, asyncio.PriorityQueue] = {}
+        self.slots: Dict[str, List[Slot]] = {}
+        # Jobs waiting in each queue, in submission order
+        self.queued: Dict[str, List[Job]] = {}
+        # Jobs waiting to be queued again after being deferred
+        self.deferred: Dict[str, List[Job]] = {}
+        # Lease ID -> jobs running on remote workers
+        self.leases: Dict[str, Lease] = {}
+        self.tasks: List[asyncio.Task] = []
+        self.draining: bool = False
+        self.version: int = 0
+        self._seq = itertools.count()
+        for codec, num in slots.items():
+            self.queues[codec] = asyncio.PriorityQueue()
+            self.slots[codec] = [Slot(codec, i) for i in range(max(int(num), 0))]
+            self.queued[codec] = []
+            self.deferred[codec] = []
+
+    def start(self):
+        """Start one worker task per slot"""
+        for slots in self.slots.values():
+            for slot in slots:
+                slot.task = self.loop.create_task(self.worker(slot))
+                self.tasks.append(slot.task)
+        self.tasks.append(self.loop.create_task(self.reaper()))
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+    def drain(self):
+        """Stop idle slots, busy ones stop after their current job"""
+        self.draining = True
+        self.version += 1
+        for slots in self.slots.values():
+            for slot in slots:
+                if slot.task and not slot.job:
+                    slot.task.cancel()
+
+    async def wait_idle(self, interval: float = 0.5):
+        """Wait until no job runs locally or on a worker"""
+        while self.running():
+            await asyncio.sleep(interval)
+
+    def submit(self, job: Job, codec: str, priority: int = 0) -> asyncio.Future:
+        """Queue job, the returned future is resolved with the job once it has run"""
+        if codec not in self.queues:
+            raise KeyError(f'No slots for codec {codec}')
+        fut = self.loop.create_future()
+        self.queued[codec].append(job)
+        self.queues[codec].put_nowait((priority, next(self._seq), job, fut))
+        self.version += 1
+        self.logger.debug('Queued %s [%s, priority %d, depth %d]', job.input, codec, priority, self.queues[codec].qsize())
+        return fut
+
+    async def worker(self, slot: Slot):
+        queue = self.queues[slot.codec]
+        while not self.draining:
+            priority, seq, job, fut = await queue.get()
+            self.queued[slot.codec].remove(job)
+            slot.job = job
+            slot.since = datetime.utcnow()
+            self.version += 1
+            deferred = False
+            try:
+                await self.run_func(job)
+            except asyncio.CancelledError:
+                raise
+            except Deferred as e:
+                deferred = True
+                self.defer(slot.codec, priority, seq, job, fut, e)
+            except Exception:
+                self.logger.exception('Job %s failed in %s slot %d', job.input, slot.codec, slot.num)
+            finally:
+                slot.job = None
+                slot.since = None
+                self.version += 1
+                queue.task_done()
+                if not deferred and not fut.done():
+                    fut.set_result(job)
+
+    def defer(self, codec: str, priority: int, seq: int, job: Job, fut: asyncio.Future, e: Deferred):
+        """Put job back in its queue after e.delay seconds, in its old position"""
+        self.logger.info('Deferred %s for %.0fs: %s', job.input, e.delay, str(e))
+        self.deferred[codec].append(job)
+        self.version += 1
+
+        def _requeue():
+            self.deferred[codec].remove(job)
+            self.queued[codec].append(job)
+            self.queues[codec].put_nowait((priority, seq, job, fut))
+            self.version += 1
+
+        self.loop.call_later(e.delay, _requeue)
+
+    def lease(self, codecs: List[str], worker: str, seconds: float) -> Optional[Lease]:
+        """Take the next queued job of the first codec in codecs that has one, None if all are empty"""
+        if self.draining:
+            return None
+        for codec in codecs:
+            queue = self.queues.get(codec)
+            if not queue or queue.empty():
+                continue
+            priority, seq, job, fut = queue.get_nowait()
+            self.queued[codec].remove(job)
+            lease = Lease(codec, priority, seq, job, fut, worker, seconds)
+            self.leases[lease.id] = lease
+            self.version += 1
+            self.logger.info('Leased %s to %s [%s, %s]', job.input, worker, codec, lease.id)
+            return lease
+        return None
+
+    def renew(self, lease_id: str) -> Optional[Lease]:
+        """Extend a lease, None if it does not exist (anymore)"""
+        lease = self.leases.get(lease_id)
+        if lease:
+            lease.renew()
+            self.version += 1
+        return lease
+
+    def defer_lease(self, lease_id: str, e: Deferred):
+        """Take back a lease that cannot run yet"""
+        lease = self.release(lease_id)
+        if lease:
+            self.defer(lease.codec, lease.priority, lease.seq, lease.job, lease.fut, e)
+
+    def release(self, lease_id: str) -> Optional[Lease]:
+        """Remove a finished lease, the caller resolves its future"""
+        lease = self.leases.pop(lease_id, None)
+        if lease:
+            self.queues[lease.codec].task_done()
+            self.version += 1
+        return lease
+
+    def requeue(self, lease_id: str) -> Optional[Lease]:
+        """Take back a lease whose job has to run again, it keeps its place in the queue"""
+        lease = self.release(lease_id)
+        if lease:
+            self.queued[lease.codec].append(lease.job)
+            self.queues[lease.codec].put_nowait((lease.priority, lease.seq, lease.job, lease.fut))
+            self.version += 1
+        return lease
+
+    async def reaper(self, interval: float = 1):
+        """Re-queue jobs of workers that stopped renewing their lease"""
+        while True:
+            await asyncio.sleep(interval)
+            for lease in [le for le in self.leases.values() if le.expired]:
+                self.requeue(lease.id)
+                self.logger.warning('Lease of %s by %s expired, re-queueing', lease.job.input, lease.worker)
+                if self.on_expire:
+                    try:
+                        self.on_expire(lease.job)
+                    except Exception:
+                        self.logger.exception('on_expire failed for %s', lease.job.input)
+
+    def running(self, codec: str = None) -> List[Job]:
+        ret = []
+        for c, slots in self.slots.items():
+            if codec and c != codec:
+                continue
+            ret.extend(s.job for s in slots if s.job)
+        ret.extend(le.job for le in self.leases.values() if not codec or le.codec == codec)
+        return ret
+
+    def status(self) -> dict:
+        """Queue depth and slot state, JSON serializable"""
+        ret = dict(queued={}, deferred={}, slots=[], leases=[], draining=self.draining)
+        for codec, slots in self.slots.items():
+            ret['queued'][codec] = [j.input for j in self.queued[codec]]
+            ret['deferred'][codec] = [j.input for j in self.deferred[codec]]
+            ret['slots'].extend(s.to_dict() for s in slots)
+        ret['leases'] = [le.to_dict() for le in self.leases.values()]
+        return ret
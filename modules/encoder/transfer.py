@@ -0,0 +1,94 @@
+import asyncio
+import errno
+import hashlib
+import logging
+import os
+import shutil
+from typing import Callable, Optional
+
+
+class FileTransfer:
+    """
+    Moves files without blocking the event loop
+
+    Within one filesystem a move stays an atomic rename. Across filesystems the
+    file is copied in large chunks by an executor thread into <dst>.part, which
+    is renamed into place before the source is deleted. With hash_name set the
+    content hash is computed while copying, renamed files are not read again.
+    Without it the kernel copies the data (copy_file_range or sendfile).
+    progress is called on the loop with bytes done and total bytes.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, chunk_size: int = 64 * 1024 * 1024,
+                 hash_name: Optional[str] = None, logger: logging.Logger = None):
+        self.loop = loop
+        self.chunk_size: int = chunk_size
+        self.hash_name: Optional[str] = hash_name
+        self.logger: logging.Logger = logger or logging.getLogger(self.__class__.__name__)
+
+    async def move(self, src: str, dst: str, progress: Callable[[int, int], None] = None) -> Optional[str]:
+        """Move src to dst, returns the hex digest of its content if hash_name is set and it was copied"""
+        total = os.path.getsize(src)
+
+        def report(done: int):
+            if progress:
+                self.loop.call_soon_threadsafe(progress, done, total)
+
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        else:
+            report(total)
+            return None
+        self.logger.debug('Copying %s -> %s [%.1fMB]', src, dst, total / 1e6)
+        return await self.loop.run_in_executor(None, self._copy, src, dst, report)
+
+    def _copy(self, src: str, dst: str, report: Callable[[int], None]) -> Optional[str]:
+        tmp = f'{dst}.part'
+        digest = hashlib.new(self.hash_name) if self.hash_name else None
+        try:
+            with open(src, 'rb') as fr, open(tmp, 'wb') as fw:
+                if digest is None:
+                    self._copy_range(fr.fileno(), fw.fileno(), report)
+                else:
+                    buf = bytearray(self.chunk_size)
+                    view = memoryview(buf)
+                    done = 0
+                    while n := fr.readinto(buf):
+                        digest.update(view[:n])
+                        fw.write(view[:n])
+                        done += n
+                        report(done)
+                fw.flush()
+                os.fsync(fw.fileno())
+            shutil.copystat(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        os.unlink(src)
+        return digest.hexdigest() if digest else None
+
+    def _copy_range(self, fd_in: int, fd_out: int, report: Callable[[int], None]):
+        """Copy in the kernel, copy_file_range falls back to sendfile if the filesystems do not support it"""
+        size = os.fstat(fd_in).st_size
+        copy_range = getattr(os, 'copy_file_range', None)
+        done = 0
+        while done < size:
+            count = min(self.chunk_size, size - done)
+            try:
+                if copy_range:
+                    n = copy_range(fd_in, fd_out, count, done)
+                else:
+                    n = os.sendfile(fd_out, fd_in, done, count)
+            except OSError as e:
+                if copy_range and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    copy_range = None
+                    continue
+                raise
+            if n == 0:
+                break
+            done += n
+            report(done)
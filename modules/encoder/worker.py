@@ -0,0 +1,200 @@
+import asyncio
+import functools
+import logging
+import os
+import signal
+import socket
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+from aiohttp import ClientError, ClientSession, UnixConnector
+
+from modules import IntroTrimmer
+from modules.keyframe_index import probe_duration
+from utils import setup_logger
+from . import ChunkedEncode, CpuAllocator, CpuTopology, Encoder, Job
+from .cpu import parse_cpulist
+
+
+class EncoderWorker:
+    """
+    Remote encoder, leases jobs from an Encoder running as coordinator
+
+    src_path must be the same shared storage the coordinator reads from, the
+    encoded file is written next to the source and the coordinator verifies
+    and moves it once the result is posted. The lease is renewed while the
+    encode runs, if the coordinator drops it the encode is aborted. A worker
+    that is stopped releases its lease so the job is queued again right away.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, **kwargs):
+        self.loop = loop
+        self.chunk_parallel: int = int(kwargs.pop('chunk_parallel', 4))
+        self.codecs: List[str] = kwargs.pop('codecs', None) or ['hevc']
+        self.coordinator_url: str = kwargs.pop('coordinator_url', 'http://127.0.0.1:3626')
+        cpus: Optional[str] = kwargs.pop('cpus', None)
+        self.dry_run: bool = kwargs.get('dry_run', False)
+        self.name: str = kwargs.pop('name', None) or f'{socket.gethostname()}-{os.getpid()}'
+        self.nice: int = int(kwargs.pop('nice', 10))
+        self.poll_interval: float = float(kwargs.pop('poll_interval', 10))
+        self.print_every: int = kwargs.pop('print_every', 30)
+        self.src_path: str = kwargs.pop('src_path', '.')
+        trim_cfg_path: str = kwargs.pop('trim_cfg_path', 'data/trimmer/config.json')
+        # --- Logger ---
+        logger_name = self.__class__.__name__
+        self.logger: logging.Logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.DEBUG)
+        setup_logger(self.logger, 'encoder_worker')
+        kwargs['log_parent'] = logger_name
+        # --- Logger ---
+        status_str = (
+            f'- PID: {os.getpid()}\n'
+            f'- Name: {self.name}\n'
+            f'- Coordinator: {self.coordinator_url}\n'
+            f'- Source: {self.src_path}\n'
+            f'- Codecs: {", ".join(self.codecs)}\n'
+        )
+        topology = CpuTopology.detect(parse_cpulist(cpus) if cpus else None)
+        status_str += f'- CPUs: {topology}, ffmpeg at nice {self.nice}\n'
+        if self.dry_run:
+            status_str += '- DRY RUN\n'
+        self.logger.info('\n%s', status_str)
+        self.sess: Optional[ClientSession] = None
+        self.cpu = CpuAllocator(topology, self.nice, logger=self.logger)
+        self.trimmer = IntroTrimmer(cfg_path=trim_cfg_path, **kwargs)
+        self.run_task: Optional[asyncio.Task] = None
+        self.loop.add_signal_handler(signal.SIGTERM, self.signal_handler)
+
+    def signal_handler(self):
+        # The current lease is released and the job is queued again
+        self.logger.info('Stopping')
+        if self.run_task:
+            self.run_task.cancel()
+
+    async def run(self):
+        """Lease and encode jobs until cancelled"""
+        self.run_task = asyncio.current_task()
+        if self.coordinator_url.startswith('/'):
+            self.sess = ClientSession(connector=UnixConnector(path=self.coordinator_url))
+        else:
+            self.sess = ClientSession()
+        try:
+            while True:
+                try:
+                    _, data = await self.post('/worker/lease', dict(worker=self.name, codecs=self.codecs))
+                except (ClientError, OSError, ValueError) as e:
+                    self.logger.warning('Cannot lease from %s: %s', self.coordinator_url, str(e))
+                    data = None
+                if not data:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                await self.run_lease(data)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self.sess.close()
+
+    async def post(self, url: str, data: dict = None) -> Tuple[int, Optional[dict]]:
+        """POST JSON to the coordinator, returns the HTTP status and the response data"""
+        if self.coordinator_url.startswith('/'):
+            url = f'http://unix{url}'
+        else:
+            url = f'{self.coordinator_url}{url}'
+        async with self.sess.post(url, json=data) as resp:
+            body = await resp.json()
+        return resp.status, body.get('data')
+
+    async def run_lease(self, data: dict):
+        lease_id = data['lease']
+        job = Job.from_dict(data['job'])
+        in_fp = os.path.join(self.src_path, job.input)
+        out_fp = os.path.join(self.src_path, data['tmp_file'])
+        self.logger.info('Encoding %s -> %s [lease %s]', job.input, data['tmp_file'], lease_id)
+        # Latest progress, sent with every heartbeat
+        state = dict(duration=None, sample=None, lost=False)
+        encode_task = self.loop.create_task(self.encode(job, data['args'], in_fp, out_fp, data.get('trim'), state))
+        heartbeat_task = self.loop.create_task(self.heartbeat(lease_id, data['lease_seconds'], state, encode_task))
+        result = dict(start_seconds=job.start_seconds, chunks=job.chunks, ffmpeg_args=None, error=None)
+        try:
+            result['ffmpeg_args'] = await encode_task
+            result['start_seconds'] = job.start_seconds
+            result['chunks'] = job.chunks
+            self.logger.info('Encoded %s', job.input)
+        except asyncio.CancelledError:
+            if not state['lost']:
+                heartbeat_task.cancel()
+                await self.release(lease_id, job)
+                raise
+            self.logger.warning('Lease of %s was dropped by the coordinator, encode aborted', job.input)
+            return
+        except Exception as e:
+            self.logger.exception('Encoding %s failed', job.input)
+            result['error'] = str(e)
+        # Keep renewing until the coordinator has the result
+        try:
+            while True:
+                try:
+                    status, _ = await self.post(f'/worker/result/{lease_id}', result)
+                    if status != 200:
+                        self.logger.warning('Result of %s rejected with HTTP %d', job.input, status)
+                    break
+                except (ClientError, OSError, ValueError) as e:
+                    self.logger.warning('Cannot send result of %s: %s', job.input, str(e))
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            heartbeat_task.cancel()
+
+    async def release(self, lease_id: str, job: Job, timeout: float = 5):
+        """Give the lease back, if the coordinator cannot be reached it expires instead"""
+        try:
+            status, _ = await asyncio.wait_for(self.post(f'/worker/release/{lease_id}'), timeout)
+            if status == 200:
+                self.logger.info('Released %s', job.input)
+        except (asyncio.TimeoutError, ClientError, OSError, ValueError) as e:
+            self.logger.warning('Cannot release lease of %s, it is queued again once it expires: %s',
+                                job.input, str(e))
+
+    async def heartbeat(self, lease_id: str, seconds: float, state: dict, encode_task: asyncio.Task):
+        """Renews the lease while encoding, cancels the encode if the coordinator no longer knows it"""
+        while True:
+            await asyncio.sleep(max(seconds / 3, 1))
+            try:
+                status, _ = await self.post(f'/worker/heartbeat/{lease_id}',
+                                            dict(duration=state['duration'], sample=state['sample']))
+            except (ClientError, OSError, ValueError) as e:
+                self.logger.warning('Heartbeat failed: %s', str(e))
+                continue
+            if status == 404:
+                state['lost'] = True
+                encode_task.cancel()
+                return
+
+    async def encode(self, job: Job, args: list, in_fp: str, out_fp: str, trim: bool, state: dict) -> str:
+        """Encode in_fp to out_fp, returns the ffmpeg command"""
+        if trim:
+            try:
+                fps = await self.trimmer.probe_fps(in_fp)
+                job.start_seconds = await self.loop.run_in_executor(
+                    None, functools.partial(self.trimmer.find_intro, file=in_fp, check_name=job.title, fps=fps))
+            except Exception:
+                self.logger.exception('Could not find intro seconds')
+        cmd = Encoder.input_args(job, in_fp) + args + [out_fp]
+        if self.dry_run:
+            return ' '.join(cmd)
+        duration = await probe_duration(in_fp, self.logger)
+        if duration and job.start_seconds:
+            duration -= timedelta(seconds=job.start_seconds)
+        state['duration'] = duration.total_seconds() if duration else None
+        if job.chunks and not duration:
+            self.logger.warning('Unknown duration of %s, encoding in one piece', in_fp)
+            job.chunks = None
+
+        def on_progress(sample: dict):
+            state['sample'] = sample
+
+        if job.chunks:
+            chunker = ChunkedEncode(self.logger, job.chunks, self.chunk_parallel, self.print_every, allocator=self.cpu)
+            await chunker.run(in_fp, out_fp, args, state['duration'], start_seconds=job.start_seconds,
+                              progress=on_progress)
+        else:
+            await self.cpu.run(self.logger, job.enc_codec, cmd, self.print_every, progress=on_progress)
+        return ' '.join(cmd)
@@ -1,5 +1,6 @@
 import logging
 import os
+import tempfile
 import time
 from typing import List, Optional
 
@@ -7,7 +8,8 @@ import cv2
 import numpy as np
 from skimage.metrics import structural_similarity
 
-from utils import run_ffmpeg, setup_logger
+from modules.keyframe_index import KeyframeIndex
+from utils import ProbeCache, probe_cache, read_video_fps, run_ffmpeg, setup_logger
 from .config import Config
 from .utils import crop_to_regions
 
@@ -20,6 +22,8 @@ class IntroTrimmer:
         self.tol: int = kwargs.pop('tol', 10)
         # Seconds to skip forwards the first time
         self.initial_gap: int = kwargs.pop('initial_gap', 300)
+        # Shared with the caller, files are probed once
+        self.probe_cache: ProbeCache = kwargs.pop('probe_cache', None) or probe_cache
         # --- Logger ---
         logger_name = self.__class__.__name__
         if log_parent:
@@ -51,7 +55,8 @@ class IntroTrimmer:
     async def run_crop(self, file: str, out_file: str, check_name='', cfg=None, use_ms=False) -> Optional[int]:
         """Find intro start and crop out start idle period"""
         # ffmpeg -ss 00:01:00 -i input.mp4 -c copy output.mp4
-        intro_seconds = self.find_intro(file=file, cfg=cfg, check_name=check_name, use_ms=use_ms)
+        fps = await self.probe_fps(file)
+        intro_seconds = self.find_intro(file=file, cfg=cfg, check_name=check_name, use_ms=use_ms, fps=fps)
         if intro_seconds is None:
             raise RuntimeError(f'No trim definition for {file}')
         args = ['-ss', str(intro_seconds), '-i', file, '-c', 'copy', out_file]
@@ -61,10 +66,15 @@ class IntroTrimmer:
             self.logger.error('Failed to trim %s from %d seconds: %s', file, intro_seconds, str(e))
         return intro_seconds
 
-    def find_intro(self, file: str, check_name='', cfg=None, use_ms=False, _test=0) -> Optional[int]:
+    async def probe_fps(self, file: str) -> Optional[float]:
+        """Frame rate of file for find_intro, from the probe cache"""
+        return await read_video_fps(file, self.logger, self.probe_cache)
+
+    def find_intro(self, file: str, check_name='', cfg=None, use_ms=False, fps: float = None, _test=0) -> Optional[int]:
         """
         Returns time in seconds where the intro starts
         Returns None if we don't have a definition for the file
+        fps of file is from probe_fps, read with CV2 if not given. Only needed when it has a keyframe index
         """
         if cfg is None:
             if check_name:
@@ -80,12 +90,15 @@ class IntroTrimmer:
         max_iter = 20
         num_iter = 0
         start = time.perf_counter()
+        index = None
+        if not _test and not use_ms and (index := KeyframeIndex.load(file)) and not fps:
+            fps = self.read_fps(file)
         while True:
             curr_t += gap
             if _test:
                 curr_is_intro = curr_t < _test
             else:
-                curr_is_intro = self.is_start_wait(file, curr_t, cfg, use_ms=use_ms)
+                curr_is_intro = self.is_start_wait(file, curr_t, cfg, use_ms=use_ms, index=index, fps=fps)
             if self.debug > 0:
                 self.logger.debug('%d: was %s, is %s, gap %d', curr_t, prev_is_intro, curr_is_intro, gap)
             if abs(gap) <= self.tol:
@@ -103,12 +116,13 @@ class IntroTrimmer:
         self.logger.info('Found intro at %d in %.2fms [%d iterations]', curr_t, (time.perf_counter()-start)*1000, num_iter)
         return curr_t
 
-    def is_start_wait(self, file: str, check_time: int, cfg: Config, use_ms=False) -> bool:
+    def is_start_wait(self, file: str, check_time: int, cfg: Config, use_ms=False,
+                      index: KeyframeIndex = None, fps: float = None) -> bool:
         """Return True is image is determined to be idle period before intro"""
         if use_ms:
             frame = self.extract_frame_ms(file, seconds=check_time)
         else:
-            frame = self.extract_frame(file, seconds=check_time)
+            frame = self.extract_frame(file, seconds=check_time, index=index, fps=fps)
         r_img = crop_to_regions(frame, cfg.check_areas)
         errors = []
         for i in range(len(cfg.regions)):
@@ -119,10 +133,16 @@ class IntroTrimmer:
             return False
         return True
 
-    def extract_frame(self, video_file: str, frame: int = 0, seconds: int = 0) -> np.ndarray:
-        """Returns 640x360 greyscale frame from video_file"""
+    def extract_frame(self, video_file: str, frame: int = 0, seconds: int = 0,
+                      index: KeyframeIndex = None, fps: float = None) -> np.ndarray:
+        """Returns 640x360 greyscale frame from video_file, index and fps are loaded if not given"""
         if not os.path.exists(video_file):
             raise FileNotFoundError(f'{video_file} not found')
+        if seconds and (index := index or KeyframeIndex.load(video_file)):
+            try:
+                return self.extract_keyframe(index, seconds, fps or self.read_fps(video_file))
+            except Exception as e:
+                self.logger.warning('Cannot read keyframe at %ds from index of %s: %s', seconds, video_file, str(e))
         start = time.perf_counter()
         cap = cv2.VideoCapture(video_file)
         try:
@@ -144,6 +164,41 @@ class IntroTrimmer:
         finally:
             cap.release()
 
+    @staticmethod
+    def read_fps(video_file: str) -> float:
+        cap = cv2.VideoCapture(video_file)
+        try:
+            return cap.get(cv2.CAP_PROP_FPS)
+        finally:
+            cap.release()
+
+    def extract_keyframe(self, index: KeyframeIndex, seconds: int, fps: float) -> np.ndarray:
+        """
+        Returns 640x360 greyscale frame at seconds, only the GOP it is in is read from the
+        recording instead of CV2 seeking through the file. fps is the frame rate of the
+        recording, the snippet has no metadata so CV2 can only guess it.
+        """
+        start = time.perf_counter()
+        kf_seconds, _ = index.keyframe_at(seconds)
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(index.video_fp)[1]) as tf:
+            tf.write(index.snippet(seconds))
+            tf.flush()
+            cap = cv2.VideoCapture(tf.name)
+            try:
+                # Decode forward from the keyframe to the requested frame
+                skip = max(0, round((seconds - kf_seconds) * fps))
+                ok = all(cap.grab() for _ in range(skip))
+                if ok:
+                    ok, img = cap.read()
+            finally:
+                cap.release()
+        if not ok:
+            raise Exception(f'CV2 cannot read frame {skip} after keyframe at {kf_seconds:.3f}s')
+        greyscale = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        self.logger.debug('CV2 read frame %d after keyframe at %.3fs in %.2fms', skip, kf_seconds,
+                          (time.perf_counter()-start)*1000)
+        return cv2.resize(greyscale, (640, 360), interpolation=cv2.INTER_LINEAR)
+
     def extract_frame_ms(self, video_file: str, seconds: int = 0) -> np.ndarray:
         """Appears to be broken"""
         if not os.path.exists(video_file):
@@ -0,0 +1,310 @@
+import os
+import struct
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from utils import ProbeCache, read_video_info
+
+"""
+### Sidecar format
+<recording>.kfi, little-endian int64 pairs of (timestamp ms, byte offset) in file order.
+Records with timestamp CONFIG_TS are not keyframes, they are needed to decode from any
+keyframe after them: FLV decoder configuration tags, MPEG-TS PAT and PMT packets.
+"""
+
+SUFFIX = '.kfi'
+CONFIG_TS = -1
+RECORD = struct.Struct('<qq')
+TS_PACKET = 188
+# PTS are 33-bit counters of a 90kHz clock, they wrap after about 26.5 hours
+PTS_WRAP = 1 << 33
+# MPEG-TS stream types of H.264, H.265 and MPEG-2 video
+TS_VIDEO_TYPES = (0x1b, 0x24, 0x02)
+
+
+def sidecar_path(fp: str) -> str:
+    return f'{fp}{SUFFIX}'
+
+
+def remove_sidecar(fp: str):
+    """Delete the index of fp if it has one"""
+    try:
+        os.unlink(sidecar_path(fp))
+    except FileNotFoundError:
+        pass
+
+
+class KeyframeIndexer:
+    """
+    Builds the keyframe index of an FLV or MPEG-TS recording from its bytes as they are written
+
+    feed gets the bytes of the recording in order, in chunks of any size. Records are
+    flushed to index_fp after every chunk, so a recording that is cut off has an index
+    up to where it ends. Other formats are not indexed.
+    """
+    def __init__(self, index_fp: str):
+        self.index_fp: str = index_fp
+        self.fw = None
+        self.buf = bytearray()
+        # Offset of buf[0] in the recording
+        self.pos: int = 0
+        # Bytes to drop before the next tag or packet
+        self.skip: int = 0
+        # flv, ts, empty if not indexed, None until known
+        self.fmt: Optional[str] = None
+        self.count: int = 0
+        # MPEG-TS state
+        self.pmt_pid: Optional[int] = None
+        self.video_pid: Optional[int] = None
+        self.first_pts: Optional[int] = None
+        self.last_pts: Optional[int] = None
+        # Multiple of PTS_WRAP added to PTS after they wrapped around
+        self.pts_offset: int = 0
+        self.configs: set = set()
+
+    def feed(self, data: bytes):
+        if self.fmt == '':
+            return
+        self.buf += data
+        count = self.count
+        while True:
+            if self.skip:
+                n = min(self.skip, len(self.buf))
+                del self.buf[:n]
+                self.pos += n
+                self.skip -= n
+                if self.skip:
+                    break
+            if self.fmt is None:
+                self.skip = self.detect()
+                if not self.fmt:
+                    break
+                continue
+            self.skip = self.parse_flv() if self.fmt == 'flv' else self.parse_ts()
+            if not self.skip:
+                break
+        if self.count != count and self.fw:
+            self.fw.flush()
+
+    def close(self):
+        if self.fw:
+            self.fw.close()
+            self.fw = None
+
+    def add(self, ts: int, offset: int):
+        if not self.fw:
+            self.fw = open(self.index_fp, 'wb')
+        self.fw.write(RECORD.pack(ts, offset))
+        self.count += 1
+
+    def detect(self) -> int:
+        """Returns the size of the file header, 0 if more data is needed"""
+        if len(self.buf) < 13:
+            return 0
+        if self.buf[:3] == b'FLV':
+            self.fmt = 'flv'
+            # Header and the first PreviousTagSize
+            return int.from_bytes(self.buf[5:9], 'big') + 4
+        if self.buf[0] == 0x47:
+            self.fmt = 'ts'
+            return 0
+        self.fmt = ''
+        self.buf.clear()
+        return 0
+
+    def parse_flv(self) -> int:
+        """Returns the size of the next tag, 0 if more data is needed"""
+        if len(self.buf) < 11:
+            return 0
+        tag_type = self.buf[0] & 0x1f
+        size = int.from_bytes(self.buf[1:4], 'big')
+        if len(self.buf) < 11 + min(size, 2):
+            return 0
+        data = self.buf[11:13]
+        ts = int.from_bytes(self.buf[4:7], 'big') | self.buf[7] << 24
+        if tag_type == 9 and data:
+            if data[0] & 0x80:
+                # Enhanced FLV, the packet type is in the low bits
+                frame_type, config = (data[0] >> 4) & 0x07, data[0] & 0x0f == 0
+            else:
+                frame_type, config = data[0] >> 4, data[0] & 0x0f in (7, 12) and len(data) > 1 and data[1] == 0
+            if config:
+                self.add(CONFIG_TS, self.pos)
+            elif frame_type == 1:
+                self.add(ts, self.pos)
+        elif tag_type == 8 and len(data) > 1 and data[0] >> 4 == 10 and data[1] == 0:
+            # AAC sequence header
+            self.add(CONFIG_TS, self.pos)
+        return 11 + size + 4
+
+    def parse_ts(self) -> int:
+        """Returns the size of the next packet, 0 if more data is needed"""
+        if len(self.buf) < TS_PACKET:
+            return 0
+        if self.buf[0] != 0x47:
+            # Lost sync, skip to the next sync byte
+            idx = self.buf.find(b'\x47', 1)
+            return idx if idx > 0 else len(self.buf)
+        pkt = self.buf[:TS_PACKET]
+        pid = (pkt[1] & 0x1f) << 8 | pkt[2]
+        start = pkt[1] & 0x40
+        afc = (pkt[3] >> 4) & 0x03
+        payload = 4
+        random_access = False
+        if afc & 0x02:
+            af_len = pkt[4]
+            random_access = af_len > 0 and bool(pkt[5] & 0x40)
+            payload += 1 + af_len
+        if not afc & 0x01 or payload >= TS_PACKET or not start:
+            return TS_PACKET
+        if pid == 0 or pid == self.pmt_pid:
+            if pid not in self.configs:
+                self.configs.add(pid)
+                self.add(CONFIG_TS, self.pos)
+            self.parse_psi(pid, pkt[payload:])
+        elif pid == self.video_pid and random_access:
+            pts = self.pes_pts(pkt[payload:])
+            if pts is not None:
+                self.add(self.unwrap(pts) // 90, self.pos)
+        return TS_PACKET
+
+    def parse_psi(self, pid: int, payload: bytes):
+        """Finds the PMT PID in the PAT and the video PID in the PMT"""
+        section = payload[1 + payload[0]:]
+        if len(section) < 12:
+            return
+        end = min(len(section), 3 + ((section[1] & 0x0f) << 8 | section[2]) - 4)
+        if pid == 0:
+            for i in range(8, end - 3, 4):
+                if section[i:i + 2] != b'\x00\x00':
+                    self.pmt_pid = (section[i + 2] & 0x1f) << 8 | section[i + 3]
+                    return
+            return
+        i = 12 + ((section[10] & 0x0f) << 8 | section[11])
+        while i + 5 <= end:
+            if section[i] in TS_VIDEO_TYPES:
+                self.video_pid = (section[i + 1] & 0x1f) << 8 | section[i + 2]
+                return
+            i += 5 + ((section[i + 3] & 0x0f) << 8 | section[i + 4])
+
+    def unwrap(self, pts: int) -> int:
+        """PTS relative to the first keyframe, counting on past wraparounds"""
+        if self.first_pts is None:
+            self.first_pts = pts
+        elif pts < self.last_pts - PTS_WRAP // 2:
+            self.pts_offset += PTS_WRAP
+        self.last_pts = pts
+        return pts + self.pts_offset - self.first_pts
+
+    @staticmethod
+    def pes_pts(payload: bytes) -> Optional[int]:
+        if len(payload) < 14 or payload[:3] != b'\x00\x00\x01' or not payload[7] & 0x80:
+            return None
+        p = payload[9:14]
+        return ((p[0] >> 1) & 0x07) << 30 | p[1] << 22 | (p[2] >> 1) << 15 | p[3] << 7 | p[4] >> 1
+
+
+async def probe_duration(fp: str, logger=None, cache: ProbeCache = None) -> Optional[timedelta]:
+    """read_video_info, the last keyframe in the index of fp if ffprobe finds no duration"""
+    duration = await read_video_info(fp, logger, cache)
+    if duration is None and (index := KeyframeIndex.load(fp)):
+        if logger:
+            logger.info('Duration of %s from its keyframe index', fp)
+        duration = timedelta(seconds=index.last_seconds)
+    return duration
+
+
+def build_index(fp: str, chunk_size: int = 1 << 20) -> int:
+    """Index a finished recording, returns the number of records"""
+    indexer = KeyframeIndexer(sidecar_path(fp))
+    try:
+        with open(fp, 'rb') as fr:
+            while chunk := fr.read(chunk_size):
+                indexer.feed(chunk)
+    finally:
+        indexer.close()
+    return indexer.count
+
+
+class KeyframeIndex:
+    """
+    Keyframes of a recording, read from its memory mapped sidecar
+
+    Lookups are binary searches, nothing but the pages they touch is read.
+    """
+    dtype = np.dtype([('ts', '<i8'), ('offset', '<i8')])
+
+    def __init__(self, video_fp: str, records):
+        self.video_fp: str = video_fp
+        self.records = records
+        keyframes = records['ts'] != CONFIG_TS
+        # Milliseconds and byte offsets of keyframes
+        self.times = records['ts'][keyframes]
+        self.offsets = records['offset'][keyframes]
+        self.config_offsets = records['offset'][~keyframes]
+
+    @classmethod
+    def load(cls, video_fp: str) -> Optional['KeyframeIndex']:
+        """None if video_fp has no usable index"""
+        index_fp = sidecar_path(video_fp)
+        if not os.path.exists(index_fp):
+            return None
+        try:
+            size = os.path.getsize(index_fp) // RECORD.size
+            if not size:
+                return None
+            records = np.memmap(index_fp, dtype=cls.dtype, mode='r', shape=(size,))
+            # Written for another file of the same name
+            if records['offset'][-1] >= os.path.getsize(video_fp):
+                return None
+        except (OSError, ValueError):
+            return None
+        ret = cls(video_fp, records)
+        return ret if len(ret) else None
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def last_seconds(self) -> float:
+        return float(self.times[-1]) / 1000 if len(self) else 0.0
+
+    def find(self, seconds: float) -> int:
+        """Position of the last keyframe at or before seconds, the first one if there is none"""
+        return max(int(np.searchsorted(self.times, int(seconds * 1000), side='right')) - 1, 0)
+
+    def keyframe_at(self, seconds: float) -> Tuple[float, int]:
+        """Seconds and byte offset of the last keyframe at or before seconds"""
+        i = self.find(seconds)
+        return float(self.times[i]) / 1000, int(self.offsets[i])
+
+    def snippet(self, seconds: float, max_bytes: int = 8 << 20) -> bytes:
+        """
+        A playable file holding the GOP of the keyframe at or before seconds,
+        the file header and decoder configuration records come first
+        """
+        i = self.find(seconds)
+        offset = int(self.offsets[i])
+        end = int(self.offsets[i + 1]) if i + 1 < len(self) else offset + max_bytes
+        end = min(end, offset + max_bytes)
+        with open(self.video_fp, 'rb') as fr:
+            head = fr.read(13)
+            parts: List[bytes] = []
+            if head[:3] == b'FLV':
+                parts.append(head[:int.from_bytes(head[5:9], 'big') + 4])
+                configs = {}
+                for config in self.config_offsets[self.config_offsets < offset]:
+                    fr.seek(int(config))
+                    tag = fr.read(11)
+                    # Latest configuration of each tag type
+                    configs[tag[0] & 0x1f] = tag + fr.read(int.from_bytes(tag[1:4], 'big') + 4)
+                parts += configs.values()
+            else:
+                for config in self.config_offsets[self.config_offsets < offset]:
+                    fr.seek(int(config))
+                    parts.append(fr.read(TS_PACKET))
+            fr.seek(offset)
+            parts.append(fr.read(end - offset))
+        return b''.join(parts)
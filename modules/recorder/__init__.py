@@ -21,4 +21,8 @@ class InvalidResponseError(Exception):
 
 from .stream_data import StreamData
 from .user_data import UserData
+from .channel import Channel
+from .client import TTLCache, TwitchClient
+from .eventsub import EventSubReceiver
+from .schedule import PollSchedule
 from .recorder import Recorder
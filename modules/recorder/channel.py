@@ -0,0 +1,43 @@
+import asyncio
+import logging
+from typing import Optional
+
+from .stream_data import StreamData
+from .user_data import UserData
+
+
+class Channel:
+    """State of one watched channel"""
+    __slots__ = ('login', 'user', 'stream', 'next_check', 'process', 'ended_ok', 'stalled', 'received', 'rate', 'task',
+                 'logger')
+
+    def __init__(self, login: str, logger: logging.Logger):
+        self.login: str = login
+        self.user: Optional[UserData] = None
+        # Set while the channel is live and being recorded
+        self.stream: Optional[StreamData] = None
+        # time.monotonic() of the next live check
+        self.next_check: float = 0
+        # Running streamlink process
+        self.process: Optional[asyncio.subprocess.Process] = None
+        # streamlink reported the end of the stream, a non-zero exit code is expected then
+        self.ended_ok: bool = False
+        # streamlink was killed because the recording stopped growing
+        self.stalled: bool = False
+        # Bytes recorded by the running streamlink and the recent rate in bytes/s
+        self.received: int = 0
+        self.rate: float = 0
+        self.task: Optional[asyncio.Task] = None
+        self.logger: logging.Logger = logger
+
+    @property
+    def id(self) -> Optional[str]:
+        return self.user.id if self.user else None
+
+    @property
+    def display_name(self) -> str:
+        return self.user.display_name if self.user else self.login
+
+    @property
+    def recording(self) -> bool:
+        return self.task is not None and not self.task.done()
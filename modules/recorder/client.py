@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+from . import InvalidResponseError
+
+
+class TTLCache:
+    """
+    Key/value cache where every entry expires after its TTL
+
+    If store_path is given the cache is also kept on disk as JSON, so it
+    survives restarts. Values must be JSON serializable.
+    """
+    def __init__(self, store_path: str = None, ttl: float = 86400):
+        self.store_path: Optional[str] = store_path
+        self.ttl: float = ttl
+        # Key -> [expires at (epoch), value]
+        self._cache: Dict[str, list] = {}
+        if store_path and os.path.exists(store_path):
+            try:
+                with open(store_path, 'r', encoding='utf-8') as fr:
+                    self._cache.update(json.load(fr))
+            except Exception as e:
+                print(f'Cannot read cache {store_path}: {e}')
+            self.purge()
+
+    def get(self, key: str) -> Any:
+        """Returns None if missing or expired"""
+        entry = self._cache.get(key)
+        if not entry:
+            return None
+        if entry[0] <= time.time():
+            del self._cache[key]
+            return None
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        self._cache[key] = [time.time() + (self.ttl if ttl is None else ttl), value]
+        self._save()
+
+    def purge(self):
+        now = time.time()
+        for key in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+            del self._cache[key]
+
+    def _save(self):
+        if not self.store_path:
+            return
+        self.purge()
+        tmp_path = f'{self.store_path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as fw:
+                json.dump(self._cache, fw)
+            os.replace(tmp_path, self.store_path)
+        except OSError as e:
+            print(f'Cannot write cache {self.store_path}: {e}')
+
+
+class RateLimit:
+    """Request budget of one host, from Ratelimit-* response headers"""
+    __slots__ = ('limit', 'remaining', 'reset')
+
+    def __init__(self):
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        # Epoch when the bucket is refilled
+        self.reset: float = 0
+
+    def update(self, headers):
+        try:
+            if 'Ratelimit-Limit' in headers:
+                self.limit = int(headers['Ratelimit-Limit'])
+            if 'Ratelimit-Remaining' in headers:
+                self.remaining = int(headers['Ratelimit-Remaining'])
+            if 'Ratelimit-Reset' in headers:
+                self.reset = float(headers['Ratelimit-Reset'])
+        except ValueError:
+            pass
+
+    def wait_time(self, reserve: int) -> float:
+        """Seconds to wait before the next request, 0 if there is budget left"""
+        if self.remaining is None or self.remaining > reserve:
+            return 0
+        return max(0.0, self.reset - time.time())
+
+
+class TwitchClient:
+    """
+    HTTP client for the Twitch APIs
+
+    Connections are pooled in one session. Requests that fail with a
+    connection error, a timeout, 429 or 5xx are retried with jittered
+    exponential backoff, other errors raise InvalidResponseError at once.
+    Requests to a host wait for its rate limit bucket to refill when fewer
+    than reserve requests are left.
+    """
+    def __init__(self, logger: logging.Logger = None, **kwargs):
+        self.logger: logging.Logger = logger or logging.getLogger(self.__class__.__name__)
+        self.retries: int = int(kwargs.pop('retries', 4))
+        self.backoff: float = float(kwargs.pop('backoff', 1))
+        self.backoff_max: float = float(kwargs.pop('backoff_max', 60))
+        self.reserve: int = int(kwargs.pop('reserve', 5))
+        self.timeout: float = float(kwargs.pop('timeout', 30))
+        self.limits: Dict[str, RateLimit] = {}
+        self.sess: Optional[ClientSession] = None
+
+    async def start(self):
+        connector = TCPConnector(limit=10, ttl_dns_cache=300)
+        self.sess = ClientSession(connector=connector, timeout=ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        if self.sess:
+            await self.sess.close()
+
+    def backoff_time(self, attempt: int) -> float:
+        """Full jitter, a random time up to the exponential backoff"""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    async def get_json(self, url: str, headers: dict = None, params: dict = None) -> dict:
+        """GET url and return its JSON body"""
+        limit = self.limits.setdefault(urlsplit(url).netloc, RateLimit())
+        attempt = 0
+        while True:
+            if wait := limit.wait_time(self.reserve):
+                self.logger.info('Rate limit budget low, waiting %.1fs', wait)
+                await asyncio.sleep(wait)
+            if limit.remaining is not None:
+                # Concurrent requests count against the same budget
+                limit.remaining -= 1
+            try:
+                async with self.sess.get(url=url, headers=headers, params=params) as resp:
+                    limit.update(resp.headers)
+                    data = await resp.json(content_type=None)
+                    if resp.status == 200:
+                        return data
+                    error = InvalidResponseError(resp.status, resp.reason, data)
+                    if resp.status != 429 and resp.status < 500:
+                        raise error
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+            if attempt >= self.retries:
+                raise error
+            delay = self.backoff_time(attempt)
+            if isinstance(error, InvalidResponseError) and error.status == 429:
+                delay = max(delay, limit.reset - time.time())
+            self.logger.warning('GET %s failed (%s), retry %d/%d in %.1fs', url, error, attempt + 1, self.retries, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+from dateutil.parser import isoparse
+
+HEADER_ID = 'Twitch-Eventsub-Message-Id'
+HEADER_TIMESTAMP = 'Twitch-Eventsub-Message-Timestamp'
+HEADER_SIGNATURE = 'Twitch-Eventsub-Message-Signature'
+HEADER_TYPE = 'Twitch-Eventsub-Message-Type'
+
+
+def sign(secret: str, message_id: str, timestamp: str, body: bytes) -> str:
+    """Value of the signature header for a message"""
+    mac = hmac.new(secret.encode(), message_id.encode() + timestamp.encode() + body, hashlib.sha256)
+    return f'sha256={mac.hexdigest()}'
+
+
+class EventSubReceiver:
+    """
+    Receives EventSub webhook notifications
+
+    Messages are checked against the HMAC-SHA256 signature made with secret,
+    messages sent more than max_age ago (or ahead) and already seen message IDs are dropped, as
+    Twitch retries deliveries. Verification challenges are answered so the
+    subscriptions can be enabled. on_event is called with the subscription
+    type and the event of every notification.
+    """
+    def __init__(self, secret: str, on_event: Callable[[str, dict], Awaitable[None]], **kwargs):
+        self.secret: str = secret
+        self.on_event = on_event
+        self.listen_address: str = kwargs.pop('listen_address', '0.0.0.0:8080')
+        self.path: str = kwargs.pop('path', '/eventsub')
+        self.max_age: timedelta = timedelta(seconds=kwargs.pop('max_age', 600))
+        self.logger: logging.Logger = kwargs.pop('logger', None) or logging.getLogger(self.__class__.__name__)
+        # Message IDs already handled, oldest first
+        self.seen: OrderedDict = OrderedDict()
+        self.seen_max: int = 1000
+        self.runner: Optional[web.AppRunner] = None
+        self.tasks = set()
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes([web.post(self.path, self.handler)])
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        if self.listen_address.startswith('/'):
+            site = web.UnixSite(self.runner, self.listen_address)
+        else:
+            host, port = self.listen_address.rsplit(':', 1)
+            site = web.TCPSite(self.runner, host, int(port))
+        await site.start()
+        self.logger.info('EventSub receiver listening on %s%s', self.listen_address, self.path)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def verify(self, r: web.Request, body: bytes) -> Optional[str]:
+        """Returns why the message is rejected, None if it is valid"""
+        message_id = r.headers.get(HEADER_ID, '')
+        timestamp = r.headers.get(HEADER_TIMESTAMP, '')
+        if not message_id or not timestamp:
+            return 'Missing headers'
+        expected = sign(self.secret, message_id, timestamp, body)
+        if not hmac.compare_digest(expected, r.headers.get(HEADER_SIGNATURE, '')):
+            return 'Invalid signature'
+        try:
+            sent_at = isoparse(timestamp)
+        except ValueError:
+            return 'Invalid timestamp'
+        if sent_at.tzinfo is None:
+            sent_at = sent_at.replace(tzinfo=timezone.utc)
+        # Future timestamps too, a captured message could otherwise be replayed until then
+        now = datetime.now(timezone.utc)
+        if abs(now - sent_at) > self.max_age:
+            return 'Message too old' if sent_at < now else 'Message from the future'
+        return None
+
+    def is_duplicate(self, message_id: str) -> bool:
+        if message_id in self.seen:
+            return True
+        self.seen[message_id] = None
+        while len(self.seen) > self.seen_max:
+            self.seen.popitem(last=False)
+        return False
+
+    async def handler(self, r: web.Request) -> web.Response:
+        body = await r.read()
+        if reason := self.verify(r, body):
+            self.logger.warning('Rejected message from %s: %s', r.remote, reason)
+            return web.Response(status=web.HTTPForbidden.status_code, text=reason)
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return web.Response(status=web.HTTPBadRequest.status_code, text='Invalid JSON')
+        msg_type = r.headers.get(HEADER_TYPE, '')
+        sub_type = data.get('subscription', {}).get('type', '')
+        if msg_type == 'webhook_callback_verification':
+            self.logger.info('Verified %s subscription', sub_type)
+            return web.Response(text=data.get('challenge', ''), content_type='text/plain')
+        if msg_type == 'revocation':
+            self.logger.warning('%s subscription revoked: %s', sub_type, data.get('subscription', {}).get('status'))
+            return web.Response(status=web.HTTPNoContent.status_code)
+        if msg_type != 'notification':
+            return web.Response(status=web.HTTPBadRequest.status_code, text=f'Unknown message type {msg_type}')
+        if self.is_duplicate(r.headers[HEADER_ID]):
+            self.logger.debug('Duplicate message %s', r.headers[HEADER_ID])
+            return web.Response(status=web.HTTPNoContent.status_code)
+        # Reply right away, Twitch gives up on slow receivers
+        task = asyncio.get_running_loop().create_task(self.dispatch(sub_type, data.get('event', {})))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response(status=web.HTTPNoContent.status_code)
+
+    async def dispatch(self, sub_type: str, event: dict):
+        try:
+            await self.on_event(sub_type, event)
+        except Exception:
+            self.logger.exception('Failed to handle %s', sub_type)
@@ -1,17 +1,20 @@
 import asyncio
 import json
-import logging
 import os
 import re
 import signal
-from typing import Optional
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Union
 
 from aiohttp import ClientSession, UnixConnector
 from discord import Embed, Colour
 
 from modules.encoder import Job
+from modules.keyframe_index import KeyframeIndexer, build_index, sidecar_path
 from modules.notifier import Notifier
-from . import LOGGER, StreamData, InvalidResponseError, UserData
+from . import (LOGGER, Channel, EventSubReceiver, InvalidResponseError, PollSchedule, StreamData, TTLCache, TwitchClient,
+               UserData)
 
 NAME = 'Twitch Recorder'
 ICON_URL = 'https://raw.githubusercontent.com/cosandr/twitch-vods/master/icons/recorder.png'
@@ -19,7 +22,19 @@ ICON_URL = 'https://raw.githubusercontent.com/cosandr/twitch-vods/master/icons/r
 
 # noinspection PyBroadException
 class Recorder:
+    """Records any number of Twitch channels, live checks are batched into one API call"""
     dumps_path = 'log/dumps'
+    # Most IDs or logins the API accepts per request
+    batch_size = 100
+    # Seconds between checks of how fast a recording grows
+    stall_interval = 2
+    # ffmpeg output arguments of --remux, same streams as the encoder's copy profile. Fragmented so the file
+    # is usable if ffmpeg is killed. MP4s are not keyframe indexed, only the raw copy of --keep_raw is.
+    remux_args = [
+        '-c:v', 'copy', '-c:a', 'aac', '-err_detect', 'ignore_err',
+        '-movflags', '+frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4',
+        '-v', 'warning', '-y', '-nostats', '-hide_banner',
+    ]
 
     def __init__(self, loop: asyncio.AbstractEventLoop, **kwargs):
         self.loop = loop
@@ -27,35 +42,59 @@ class Recorder:
         self.enc_path: str = kwargs.pop('enc_path', 'http://127.0.0.1:3626')
         self.notifier: Optional[Notifier] = kwargs.pop('notifier', None)
         self.out_path: str = kwargs.pop('out_path', '.')
+        # Pipe streamlink into an MP4 remux, optionally keeping the raw FLV as well
+        self.remux: bool = kwargs.pop('remux', False)
+        self.keep_raw: bool = kwargs.pop('keep_raw', False)
+        # Write parts of this many seconds which are encoded while the stream continues, 0 to disable
+        self.segment_seconds: int = int(kwargs.pop('segment_seconds', 0))
+        # streamlink is restarted when less than stall_rate bytes/s were recorded for stall_seconds
+        self.stall_seconds: int = int(kwargs.pop('stall_seconds', 30))
+        self.stall_rate: int = int(kwargs.pop('stall_rate', 1024))
+        self.max_restarts: int = int(kwargs.pop('max_restarts', 10))
         self.time_format: str = kwargs.get('time_format', '%y%m%d-%H%M')
         self.timeout: int = int(kwargs.pop('timeout', 120))
         self.twitch_id: str = kwargs.pop('twitch_id')
-        user_login = kwargs.pop('user')
+        # Live checks are only a safety net when EventSub notifications are received
+        self.eventsub_address: str = kwargs.pop('eventsub_address', '0.0.0.0:8080')
+        self.eventsub_secret: str = kwargs.pop('eventsub_secret', '')
+        self.safety_timeout: int = int(kwargs.pop('safety_timeout', 900))
+        self.schedule = PollSchedule(kwargs.pop('history_file', 'data/recorder_history.json'), timeout=self.timeout,
+                                     fast=kwargs.pop('fast_timeout', 30), max_timeout=kwargs.pop('max_timeout', 1800))
+        # Users rarely change, cache them across restarts
+        self.cache = TTLCache(kwargs.pop('cache_file', 'data/recorder_cache.json'), ttl=int(kwargs.pop('cache_ttl', 7 * 86400)))
+        logins = self.parse_logins(kwargs.pop('user'))
         self.aio_sess: Optional[ClientSession] = None
+        # Set when a channel should be checked earlier than planned, e.g. a recording ended
         self.check_en = asyncio.Event()
-        self.ended_ok = False
         self.notifier: Optional[Notifier] = None
-        self.stream: Optional[StreamData] = None
         self.unix_sess: Optional[ClientSession] = None
-        self.user: Optional[UserData] = None
+        self.client: Optional[TwitchClient] = None
+        self.eventsub: Optional[EventSubReceiver] = None
         self.loop.add_signal_handler(signal.SIGTERM, self.signal_handler)
         # --- Logger ---
-        self.logger = logging.getLogger(f'{LOGGER.name}.{user_login}')
-        self.logger.setLevel(logging.DEBUG)
+        self.logger = LOGGER
         kwargs['log_parent'] = self.logger.name
         # --- Logger ---
+        self.channels: Dict[str, Channel] = {login: Channel(login, self.logger.getChild(login)) for login in logins}
         status_str = (
             f'- Encoder: {self.enc_path}\n'
             f'- File time format: {self.time_format}\n'
             f'- Output: {self.out_path}\n'
+            f'- Remux: {"yes, keeping raw FLV" if self.remux and self.keep_raw else "yes" if self.remux else "no"}\n'
+            f'- Segments: {f"{self.segment_seconds}s" if self.segment_seconds else "no"}\n'
+            f'- Stalls: under {self.stall_rate}B/s for {self.stall_seconds}s, up to {self.max_restarts} restarts\n'
             f'- PID: {os.getpid()}\n'
-            f'- Timeout: {self.timeout}\n'
+            f'- Timeout: {self.timeout}, {self.schedule.fast:g} in usual start windows, up to {self.schedule.max_timeout:g}\n'
             f'- Twitch client ID: {self.twitch_id}\n'
-            f'- User: {user_login}\n'
+            f'- Users: {", ".join(logins)}\n'
         )
+        if self.eventsub_secret:
+            status_str += f'- EventSub: {self.eventsub_address}, safety net timeout {self.safety_timeout}\n'
         if self.dry_run:
             status_str += f'- DRY RUN\n'
         self.logger.info("\n%s", status_str)
+        if self.segment_seconds and self.remux:
+            self.logger.warning('Parts are recorded as raw FLV, remuxing only applies to whole recordings')
 
         # Check args
         if not os.path.exists(self.out_path):
@@ -64,19 +103,41 @@ class Recorder:
                 os.mkdir(self.out_path, 0o750)
                 self.logger.info('%s created', self.out_path)
 
-        self.init_task = self.loop.create_task(self.async_init(user_login, **kwargs))
+        self.init_task = self.loop.create_task(self.async_init(**kwargs))
 
-    async def async_init(self, user_login, **kwargs):
+    @staticmethod
+    def parse_logins(user: Union[str, List[str]]) -> List[str]:
+        """Logins from comma separated strings, lower case and without duplicates"""
+        if isinstance(user, str):
+            user = [user]
+        return list(dict.fromkeys(u.strip().lower() for v in user for u in v.split(',') if u.strip()))
+
+    async def async_init(self, **kwargs):
         self.logger.debug("aiohttp session initialized.")
-        self.aio_sess = ClientSession()
+        self.client = TwitchClient(logger=self.logger.getChild('client'))
+        await self.client.start()
+        # Notifications and encoder requests share the connection pool
+        self.aio_sess = self.client.sess
         if self.enc_path.startswith('/'):
             self.unix_sess = ClientSession(connector=UnixConnector(path=self.enc_path))
             self.logger.debug("Unix session initialized.")
-        self.user = await self.get_user_id(user_login)
-        if not self.user:
-            self.logger.critical('Cannot find user %s', user_login)
+        users = await self.get_users(list(self.channels))
+        for login in list(self.channels):
+            if user := users.get(login):
+                self.channels[login].user = user
+            else:
+                self.logger.error('Cannot find user %s', login)
+                del self.channels[login]
+        if not self.channels:
+            self.logger.critical('Cannot find any users')
             await self.close()
-            raise RuntimeError(f'Cannot find user {user_login}')
+            raise RuntimeError('Cannot find any users')
+        for c in self.channels.values():
+            c.logger.info('%s usually goes live at %s', c.display_name, self.schedule.describe(c.login))
+        if self.eventsub_secret:
+            self.eventsub = EventSubReceiver(self.eventsub_secret, self.handle_event, listen_address=self.eventsub_address,
+                                             logger=self.logger.getChild('eventsub'))
+            await self.eventsub.start()
 
         if kwargs.get('no_notifications', False):
             self.logger.info('No notifications')
@@ -92,6 +153,7 @@ class Recorder:
             embed = self.make_embed()
             embed.colour = Colour.light_grey()
             embed.description = 'Started'
+            embed.add_field(name='Channels', value=', '.join(c.display_name for c in self.channels.values()))
             await self.send_notification(embed=embed)
         self.check_en.set()
 
@@ -100,7 +162,10 @@ class Recorder:
         embed.colour = Colour.orange()
         embed.description = 'Closing'
         await self.send_notification(embed=embed)
-        await self.aio_sess.close()
+        if self.eventsub:
+            await self.eventsub.close()
+        if self.client:
+            await self.client.close()
         self.logger.debug("aiohttp session closed")
 
     def signal_handler(self):
@@ -109,17 +174,17 @@ class Recorder:
             exit(0)
         self.loop.create_task(_run())
 
-    def make_embed(self) -> Embed:
+    def make_embed(self, channel: Channel = None) -> Embed:
         embed = Embed()
-        if self.user:
-            embed.title = self.user.display_name
-        if self.stream:
-            embed.description = f'Recording {self.stream.title}'
+        if channel:
+            embed.title = channel.display_name
+            if channel.stream:
+                embed.description = f'Recording {channel.stream.title}'
         embed.set_author(name=NAME, icon_url=ICON_URL)
         return embed
 
-    def make_embed_error(self, description: str, e: Exception = None) -> Embed:
-        embed = self.make_embed()
+    def make_embed_error(self, description: str, e: Exception = None, channel: Channel = None) -> Embed:
+        embed = self.make_embed(channel)
         embed.colour = Colour.red()
         embed.description = description
         if e:
@@ -139,68 +204,93 @@ class Recorder:
             self.logger.exception('Cannot send notification')
             return False
 
-    async def timer(self, timeout=None):
-        if timeout is None:
-            timeout = self.timeout
-        await asyncio.sleep(timeout)
-        self.check_en.set()
+    def next_delay(self, c: Channel) -> float:
+        """Time until the next live check of an offline channel"""
+        if self.eventsub:
+            return self.safety_timeout
+        return self.schedule.delay(c.login)
 
-    async def get_user_id(self, user_login: str) -> Optional[UserData]:
-        """Sets the user's ID"""
+    async def wait_due(self):
+        """Wait until an idle channel is due for a live check or check_en is set"""
+        due = [c.next_check for c in self.channels.values() if not c.recording]
+        delay = min(due) - time.monotonic() if due else None
+        if delay is not None and delay <= 0:
+            return
+        self.check_en.clear()
+        try:
+            await asyncio.wait_for(self.check_en.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def batches(self, items: list) -> List[list]:
+        return [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+
+    async def get_users(self, logins: List[str]) -> Dict[str, UserData]:
+        """Returns users by lower case login, missing ones are left out"""
         url = 'https://api.twitch.tv/kraken/users'
         headers = {'Client-ID': self.twitch_id, 'Accept': 'application/vnd.twitchtv.v5+json'}
-        params = {'login': user_login}
-        try:
-            data = await self.http_get_json(url=url, headers=headers, params=params)
-        except InvalidResponseError as e:
-            self.logger.error('get_user_id: %s\nData: %s', str(e), e.data_str)
-            return None
-        except Exception:
-            self.logger.exception('Failed to get hosting user data')
-            return None
-        if not data:
-            return None
-        for d in data.get('users', []):
-            u = UserData.from_json(d)
-            if u.name.lower() == user_login.lower():
-                return u
-        return None
-
-    async def get_stream_data(self) -> Optional[StreamData]:
-        """Returns some stream data if current user is streaming"""
-        url = f'https://api.twitch.tv/kraken/streams/{self.user.id}'
+        ret = {}
+        for login in logins:
+            if cached := self.cache.get(f'user:{login}'):
+                ret[login] = UserData.from_json(cached)
+        for batch in self.batches([login for login in logins if login not in ret]):
+            params = {'login': ','.join(batch)}
+            try:
+                data = await self.http_get_json(url=url, headers=headers, params=params)
+            except InvalidResponseError as e:
+                self.logger.error('get_users: %s\nData: %s', str(e), e.data_str)
+                continue
+            except Exception:
+                self.logger.exception('Failed to get user data')
+                continue
+            for d in (data or {}).get('users', []):
+                u = UserData.from_json(d)
+                ret[u.name.lower()] = u
+                self.cache.set(f'user:{u.name.lower()}', u.to_json())
+        return ret
+
+    async def get_user_id(self, user_login: str) -> Optional[UserData]:
+        """Returns a single user"""
+        return (await self.get_users([user_login.lower()])).get(user_login.lower())
+
+    async def get_streams(self, ids: List[str]) -> Dict[str, StreamData]:
+        """Returns stream data by user ID for users that are streaming"""
+        url = 'https://api.twitch.tv/kraken/streams/'
         headers = {'Client-ID': self.twitch_id, 'Accept': 'application/vnd.twitchtv.v5+json'}
-        data = await self.http_get_json(url=url, headers=headers)
-        ret = StreamData.from_json(data)
-        if ret and not ret.title:
-            ret.title = 'UNKNOWN'
-            self.logger.warning('Stream title missing\n%s', json.dumps(data, indent=2))
+        ret = {}
+        for batch in self.batches(ids):
+            params = {'channel': ','.join(batch), 'limit': self.batch_size}
+            data = await self.http_get_json(url=url, headers=headers, params=params)
+            for d in (data or {}).get('streams', []):
+                stream = StreamData.from_stream(d)
+                if not stream.title:
+                    stream.title = 'UNKNOWN'
+                    self.logger.warning('Stream title missing\n%s', json.dumps(d, indent=2))
+                ret[stream.user_id] = stream
         return ret
 
-    async def get_hosting_target(self) -> str:
-        """Returns who current is hosting, empty string if nobody"""
+    async def get_hosting_targets(self, ids: List[str]) -> Dict[str, str]:
+        """Returns target logins by host ID, users not hosting are left out"""
         url = "https://tmi.twitch.tv/hosts"
-        params = {'include_logins': 1, 'host': self.user.id}
-        try:
-            data = await self.http_get_json(url=url, params=params)
-        except InvalidResponseError as e:
-            self.logger.error('get_hosting_target: %s\nData: %s', str(e), e.data_str)
-            return ''
-        except Exception:
-            self.logger.exception('Failed to get hosting target data')
-            return ''
-        if not data or not data.get('hosts') or len(data['hosts']) == 0:
-            return ''
-        return data['hosts'][0].get('target_login', '')
+        ret = {}
+        for batch in self.batches(ids):
+            params = {'include_logins': 1, 'host': ','.join(batch)}
+            try:
+                data = await self.http_get_json(url=url, params=params)
+            except InvalidResponseError as e:
+                self.logger.error('get_hosting_targets: %s\nData: %s', str(e), e.data_str)
+                continue
+            except Exception:
+                self.logger.exception('Failed to get hosting target data')
+                continue
+            for d in (data or {}).get('hosts', []):
+                if d.get('target_login'):
+                    ret[str(d['host_id'])] = d['target_login']
+        return ret
 
     async def http_get_json(self, url, headers=None, params=None) -> dict:
         """Run HTTP GET"""
-        async with self.aio_sess.get(url=url, headers=headers, params=params) as resp:
-            # This can raise an exception
-            data = await resp.json()
-            if resp.status != 200:
-                raise InvalidResponseError(resp.status, resp.reason, data)
-        return data
+        return await self.client.get_json(url=url, headers=headers, params=params)
 
     async def http_post_data(self, url: str, data: str, **kwargs):
         if self.unix_sess:
@@ -217,116 +307,492 @@ class Recorder:
 
     async def check_if_live(self):
         """
-        1. Check for host
-        2. Check for streams
-        3. Run streamlink if appropriate
+        1. Wait for channels that are due
+        2. Check for streams and hosts of all of them at once
+        3. Start streamlink for live channels
         """
-        await self.check_en.wait()
+        await self.wait_due()
+        now = time.monotonic()
+        due = [c for c in self.channels.values() if not c.recording and c.next_check <= now]
+        if not due:
+            return
         try:
-            self.stream = await self.get_stream_data()
+            streams = await self.get_streams([c.id for c in due])
         except InvalidResponseError as e:
             self.logger.error('%s\nData: %s', str(e), e.data_str)
-            embed = self.make_embed_error('get_stream_data failed', e=e)
+            embed = self.make_embed_error('get_streams failed', e=e)
             embed.add_field(name='Data', value=f'```json\n{e.data_str}\n```', inline=False)
             await self.send_notification(embed=embed)
-            self.loop.create_task(self.timer())
-            self.check_en.clear()
+            self.postpone(due, self.timeout)
             return
         except Exception:
             self.logger.exception('Failed to get stream data')
-            self.loop.create_task(self.timer())
-            self.check_en.clear()
+            self.postpone(due, self.timeout)
             return
-        if not self.stream:
-            self.logger.debug('%s is offline, retrying in %ds', self.user.display_name, self.timeout)
-            self.loop.create_task(self.timer())
-            self.check_en.clear()
+        live = [c for c in due if c.id in streams]
+        offline = [c for c in due if c.id not in streams]
+        for c in offline:
+            delay = self.next_delay(c)
+            c.logger.debug('%s is offline, retrying in %ds', c.display_name, delay)
+            self.postpone([c], delay)
+        hosts = await self.get_hosting_targets([c.id for c in live]) if live else {}
+        for c in live:
+            if host_login := hosts.get(c.id):
+                delay = self.next_delay(c)
+                c.logger.info('%s is live but hosting %s, retrying in %ds.', c.display_name, host_login, delay)
+                self.postpone([c], delay)
+                continue
+            await self.start_recording(c, streams[c.id])
+
+    @staticmethod
+    def postpone(channels: List[Channel], delay: float):
+        next_check = time.monotonic() + delay
+        for c in channels:
+            c.next_check = next_check
+
+    async def handle_event(self, sub_type: str, event: dict):
+        """Called by the EventSub receiver"""
+        user_id = str(event.get('broadcaster_user_id', ''))
+        c = next((c for c in self.channels.values() if c.id == user_id), None)
+        if not c:
+            self.logger.debug('Ignoring %s of %s', sub_type, event.get('broadcaster_user_login', user_id))
             return
-        # Check if hosting
-        if host_login := await self.get_hosting_target():
-            self.logger.info('%s is live but hosting %s, retrying in 10m.', self.user.display_name, host_login)
-            self.loop.create_task(self.timer(600))
-            self.check_en.clear()
+        if sub_type == 'stream.offline':
+            c.logger.info('%s went offline', c.display_name)
             return
-        self.stream.created_at_str = self.time_format
-        self.logger.info('%s is live: %s', self.user.display_name, self.stream.title)
+        if sub_type != 'stream.online' or c.recording:
+            return
+        if event.get('type', 'live') != 'live':
+            c.logger.info('%s started a %s stream, not recording', c.display_name, event['type'])
+            return
+        # The notification has no title, the API may lag behind it
+        try:
+            stream = (await self.get_streams([c.id])).get(c.id)
+        except Exception:
+            c.logger.exception('Failed to get stream data')
+            stream = None
+        if not stream:
+            stream = StreamData.from_event(event)
+            stream.title = 'UNKNOWN'
+        await self.start_recording(c, stream)
+
+    async def start_recording(self, c: Channel, stream: StreamData):
+        # A notification and a live check may both find the stream
+        if c.recording:
+            return
+        c.stream = stream
+        c.stream.created_at_str = self.time_format
+        self.schedule.add_start(c.login, c.stream.created_at)
+        c.logger.info('%s is live: %s', c.display_name, c.stream.title)
+        c.task = self.loop.create_task(self.record(c))
         # --- Send notification ---
-        embed = self.make_embed()
+        embed = self.make_embed(c)
         embed.colour = Colour.green()
-        if self.stream.preview:
-            embed.set_image(url=self.stream.preview)
-        if self.stream.user_logo:
-            embed.set_thumbnail(url=self.stream.user_logo)
+        if c.stream.preview:
+            embed.set_image(url=c.stream.preview)
+        if not c.stream.user_logo:
+            c.stream.user_logo = c.user.logo
+        if c.stream.user_logo:
+            embed.set_thumbnail(url=c.stream.user_logo)
         await self.send_notification(embed=embed)
         # --- Send notification ---
-        await self.record()
 
-    async def record(self):
-        self.check_en.clear()
-        no_space_title = re.sub(r'[^a-zA-Z0-9]+', '_', self.stream.title)
-        rec_name = f"{self.stream.created_at_str}_{self.user.name}_{no_space_title}"
-        raw_name = f'{rec_name}.flv'
-        raw_fp = os.path.join(self.out_path, raw_name)
-        if os.path.exists(raw_fp):
-            self.logger.info('Raw file %s already exists', raw_fp)
+    async def record(self, c: Channel):
+        try:
+            await self.record_stream(c)
+        except Exception:
+            c.logger.exception('Recording failed')
+        finally:
+            c.stream = None
+            c.process = None
+            self.postpone([c], self.timeout)
+            self.check_en.set()
+
+    async def record_stream(self, c: Channel):
+        no_space_title = re.sub(r'[^a-zA-Z0-9]+', '_', c.stream.title)
+        rec_name = f"{c.stream.created_at_str}_{c.user.name}_{no_space_title}"
+        existing = self.existing_numbers(rec_name)
+        if '' in existing:
+            c.logger.info('Recording %s already exists', rec_name)
             # Number it
-            existing_num = len([f for f in os.listdir(self.out_path) if f.startswith(rec_name)])
-            raw_name = f'{rec_name}.{existing_num}.flv'
-            raw_fp = os.path.join(self.out_path, raw_name)
-        self.logger.info('Saving raw stream to %s', raw_fp)
+            num = len(existing)
+            while f'.{num}' in existing:
+                num += 1
+            rec_name = f'{rec_name}.{num}'
+        if self.segment_seconds:
+            await self.record_segmented(c, rec_name)
+            return
+        if self.remux:
+            await self.record_remux(c, rec_name)
+            return
+        c.logger.info('Saving raw stream to %s', os.path.join(self.out_path, f'{rec_name}.flv'))
         if self.dry_run:
-            self.logger.info('Dry run, do not run streamlink')
+            c.logger.info('Dry run, do not run streamlink')
+            return
+        pieces: List[str] = []
+
+        async def start(piece: int):
+            name = f'{rec_name}.piece{piece}.flv' if piece else f'{rec_name}.flv'
+            raw_fp = os.path.join(self.out_path, name)
+            args = [c.stream.url, '--default-stream', 'best', '-o', raw_fp, '-l', 'info', '--force']
+            try:
+                await self.run(c, args, size=lambda: self.file_size(raw_fp), raw_fp=raw_fp)
+            finally:
+                c.received = self.file_size(raw_fp)
+                if c.received:
+                    pieces.append(name)
+
+        await self.supervise(c, start)
+        if not pieces:
+            c.logger.critical('No raw file found %s', os.path.join(self.out_path, f'{rec_name}.flv'))
             return
-        cmd = f"streamlink {self.stream.url} --default-stream best -o {raw_fp} -l info --force"
+        await self.post_record(c, pieces[0], pieces=pieces[1:] or None)
+
+    def existing_numbers(self, rec_name: str) -> Set[str]:
+        """
+        Number suffixes ('' for none, '.1', ...) of recordings named rec_name in out_path,
+        pieces and index sidecars of a recording are not counted
+        """
+        pattern = re.compile(rf'{re.escape(rec_name)}(\.\d+)?(\.part\d+|\.joined)?\.(flv|mp4)')
+        ret = set()
+        for f in os.listdir(self.out_path):
+            if m := pattern.fullmatch(f):
+                ret.add(m.group(1) or '')
+        return ret
+
+    async def record_remux(self, c: Channel, rec_name: str):
+        """Record to MP4 through ffmpeg, so copy jobs need no second pass over the file"""
+        c.logger.info('Remuxing stream to %s%s', os.path.join(self.out_path, f'{rec_name}.mp4'),
+                      ', keeping raw copy' if self.keep_raw else '')
+        if self.dry_run:
+            c.logger.info('Dry run, do not run streamlink')
+            return
+        # (MP4 name, remux ok, raw copy name) of every piece
+        pieces: List[tuple] = []
+
+        async def start(piece: int):
+            suffix = f'.piece{piece}' if piece else ''
+            out_name = f'{rec_name}{suffix}.mp4'
+            raw_name = f'{rec_name}{suffix}.flv' if self.keep_raw else None
+            raw_fp = os.path.join(self.out_path, raw_name) if raw_name else None
+            remux_ok = await self.run_pipe(c, ['-i', 'pipe:0', *self.remux_args, os.path.join(self.out_path, out_name)],
+                                           raw_fp, size=lambda: c.received)
+            if c.received:
+                pieces.append((out_name, remux_ok, raw_name))
+
+        await self.supervise(c, start)
+        if len(pieces) > 1:
+            await self.post_remux_pieces(c, pieces)
+            return
+        out_name, remux_ok, raw_name = pieces[0] if pieces else (f'{rec_name}.mp4', False, None)
+        out_fp = os.path.join(self.out_path, out_name)
+        raw_fp = os.path.join(self.out_path, raw_name) if raw_name else None
+        has_raw = raw_fp and os.path.exists(raw_fp)
+        if remux_ok and os.path.exists(out_fp):
+            await self.post_record(c, out_name, remuxed=True, raw_copy=raw_name if has_raw else None)
+        elif has_raw:
+            c.logger.warning('Remux failed, sending raw copy %s', raw_fp)
+            await self.post_record(c, raw_name)
+        elif os.path.exists(out_fp):
+            c.logger.warning('Remux failed, %s is encoded again', out_fp)
+            await self.post_record(c, out_name)
+        else:
+            c.logger.critical('No recording found %s', out_fp)
+
+    async def post_remux_pieces(self, c: Channel, pieces: List[tuple]):
+        """
+        One job for a remuxed recording that was restarted. Raw copies are the safer input, so with
+        them the MP4 pieces are dropped and the encoder joins the raw pieces.
+        """
+        exists = [(out_name, remux_ok, raw_name) for out_name, remux_ok, raw_name in pieces
+                  if os.path.exists(os.path.join(self.out_path, out_name))
+                  or (raw_name and os.path.exists(os.path.join(self.out_path, raw_name)))]
+        raw_names = [raw_name for _, _, raw_name in exists
+                     if raw_name and os.path.exists(os.path.join(self.out_path, raw_name))]
+        if exists and len(raw_names) == len(exists):
+            c.logger.info('Sending %d raw pieces', len(raw_names))
+            for out_name, _, _ in exists:
+                if os.path.exists(out_fp := os.path.join(self.out_path, out_name)):
+                    os.unlink(out_fp)
+            await self.post_record(c, raw_names[0], pieces=raw_names[1:])
+            return
+        out_names = [out_name for out_name, _, _ in exists if os.path.exists(os.path.join(self.out_path, out_name))]
+        if not out_names:
+            c.logger.critical('No recording found %s', pieces[0][0])
+            return
+        c.logger.info('Sending %d remuxed pieces', len(out_names))
+        await self.post_record(c, out_names[0], pieces=out_names[1:] or None,
+                               remuxed=all(remux_ok for _, remux_ok, _ in exists) or None)
+
+    async def record_segmented(self, c: Channel, rec_name: str):
+        """
+        Record to parts cut at keyframes, each is keyframe indexed and sent to the encoder as soon as
+        it is complete
+        """
+        pattern = os.path.join(self.out_path, f'{rec_name}.part%03d.flv')
+        c.logger.info('Saving raw stream to %s, %ds parts', pattern, self.segment_seconds)
+        if self.dry_run:
+            c.logger.info('Dry run, do not run streamlink')
+            return
+        broadcast = uuid.uuid4().hex
+        parts: List[str] = []
+
+        async def on_line(line: str):
+            """ffmpeg lists every part once it is closed"""
+            parts.append(os.path.basename(line))
+            part_fp = os.path.join(self.out_path, parts[-1])
+            try:
+                await self.loop.run_in_executor(None, build_index, part_fp)
+            except Exception as e:
+                c.logger.warning('Keyframe index of %s failed: %s', part_fp, str(e))
+            await self.post_record(c, parts[-1], broadcast=broadcast, part=len(parts) - 1)
+
+        async def start(_piece: int):
+            """Restarts continue the numbering of the parts, they all belong to the same broadcast"""
+            args = [
+                '-i', 'pipe:0', '-map', '0', '-c', 'copy',
+                '-f', 'segment', '-segment_time', str(self.segment_seconds), '-segment_format', 'flv',
+                '-segment_start_number', str(len(parts)), '-reset_timestamps', '1',
+                '-segment_list', 'pipe:1', '-segment_list_type', 'flat',
+                '-v', 'warning', '-y', '-nostats', '-hide_banner', pattern,
+            ]
+            await self.run_pipe(c, args, on_line=on_line, size=lambda: c.received)
+
+        await self.supervise(c, start)
+        if not parts:
+            c.logger.critical('No parts found %s', pattern)
+            return
+        c.logger.info('Recorded %d parts', len(parts))
         try:
-            await self.run(cmd)
+            await self.http_post_data(url=f'/job/broadcast/{broadcast}', data=json.dumps(dict(parts=len(parts))))
         except Exception as e:
-            self.logger.error('Recording failed %s', str(e))
-            if not os.path.exists(raw_fp):
-                self.logger.critical('No raw file found %s', raw_fp)
-                self.loop.create_task(self.timer())
+            c.logger.exception('Failed to end broadcast')
+            embed = self.make_embed_error('Failed to end broadcast, parts are not stitched', e=e, channel=c)
+            await self.send_notification(embed=embed)
+
+    async def supervise(self, c: Channel, start: Callable[[int], Awaitable[None]]):
+        """
+        Await start(0) and start the next piece whenever streamlink stalled or exited before the stream
+        ended, up to max_restarts times. start must set c.received, a piece without data ends the recording.
+        """
+        piece = 0
+        while True:
+            c.ended_ok = c.stalled = False
+            c.received = 0
+            c.rate = 0
+            try:
+                await start(piece)
+            except Exception as e:
+                c.logger.error('Recording failed %s', str(e))
+            if c.ended_ok or not c.received:
+                return
+            if piece >= self.max_restarts:
+                c.logger.error('streamlink was restarted %d times, giving up', piece)
+                return
+            piece += 1
+            c.logger.warning('streamlink %s after %.1fMB, restarting [%d/%d]', 'stalled' if c.stalled else 'exited',
+                             c.received / 1e6, piece, self.max_restarts)
+
+    async def watch_stall(self, c: Channel, p: asyncio.subprocess.Process, size: Callable[[], int]):
+        """Kill p once size() grew slower than stall_rate bytes/s for stall_seconds"""
+        last_size, last_time = 0, time.monotonic()
+        last_ok = last_time
+        while p.returncode is None:
+            await asyncio.sleep(self.stall_interval)
+            now, c.received = time.monotonic(), size()
+            c.rate = (c.received - last_size) / (now - last_time)
+            last_size, last_time = c.received, now
+            if c.rate >= self.stall_rate:
+                last_ok = now
+            elif now - last_ok >= self.stall_seconds and p.returncode is None:
+                c.logger.warning('Recording stalled at %.1fMB, %.1fkB/s for %.0fs',
+                                 c.received / 1e6, c.rate / 1e3, now - last_ok)
+                c.stalled = True
+                p.kill()
                 return
-            self.logger.info("Premature exit but raw file exists.")
-        await self.post_record(raw_name)
 
-    async def post_record(self, raw_name: str):
-        # Send job to encoder
-        job = Job(input=raw_name, title=self.stream.title, user=self.user.display_name, created_at=self.stream.created_at)
+    async def index_file(self, c: Channel, p: asyncio.subprocess.Process, fp: str, chunk_size: int = 1 << 20):
+        """
+        Index keyframes of fp while p writes it, reads what was appended every stall_interval
+        in an executor
+        """
+        indexer = KeyframeIndexer(sidecar_path(fp))
+        fr = None
+
+        def _catch_up():
+            while chunk := fr.read(chunk_size):
+                indexer.feed(chunk)
+
+        try:
+            while True:
+                running = p.returncode is None
+                if fr is None and os.path.exists(fp):
+                    fr = open(fp, 'rb')
+                if fr:
+                    await self.loop.run_in_executor(None, _catch_up)
+                if not running:
+                    break
+                await asyncio.sleep(self.stall_interval)
+        except Exception as e:
+            c.logger.warning('Keyframe index of %s failed: %s', fp, str(e))
+        finally:
+            indexer.close()
+            if fr:
+                fr.close()
+
+    @staticmethod
+    def file_size(fp: str) -> int:
+        try:
+            return os.path.getsize(fp)
+        except OSError:
+            return 0
+
+    async def post_record(self, c: Channel, raw_name: str, **kwargs):
+        """Send job to encoder, kwargs are added to the job"""
+        job = Job(input=raw_name, title=c.stream.title, user=c.display_name, created_at=c.stream.created_at, **kwargs)
         job_str = job.to_json(indent=2)
-        self.logger.debug("Sending job to encoder\n%s", job_str)
+        c.logger.debug("Sending job to encoder\n%s", job_str)
         try:
             await self.http_post_data(url='/job/run', data=job.to_json(), params=dict(immediate='true'))
         except Exception as e:
-            self.logger.exception('Failed to send job to encoder')
-            embed = self.make_embed_error('Failed to send job to encoder', e=e)
+            c.logger.exception('Failed to send job to encoder')
+            embed = self.make_embed_error('Failed to send job to encoder', e=e, channel=c)
             await self.send_notification(embed=embed)
-        self.loop.create_task(self.timer())
 
-    async def run(self, cmd: str):
-        p = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    async def run(self, c: Channel, args: list, size: Callable[[], int] = None, raw_fp: str = None):
+        """
+        Run streamlink with args, size returns the bytes it wrote so far to detect stalls.
+        raw_fp is the file streamlink writes, its keyframes are indexed while it grows.
+        """
+        c.ended_ok = False
+        # Not through a shell, a stalled streamlink is killed directly
+        p = await asyncio.create_subprocess_exec('streamlink', *args, stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.PIPE)
+        c.process = p
+        tasks = [self.watch(c, p.stdout, prefix='STDOUT'), self.watch(c, p.stderr, prefix='STDERR')]
+        if size:
+            tasks.append(self.watch_stall(c, p, size))
+        if raw_fp:
+            tasks.append(self.index_file(c, p, raw_fp))
         try:
             # noinspection PyTypeChecker
-            await asyncio.gather(self.watch(p.stdout, prefix='STDOUT'), self.watch(p.stderr, prefix='STDERR'))
+            await asyncio.gather(*tasks)
         except Exception as e:
-            self.logger.critical('stdout/err critical failure: %s', str(e))
+            c.logger.critical('stdout/err critical failure: %s', str(e))
         await p.wait()
-        if p.returncode != 0 and not self.ended_ok:
+        if p.returncode == 0:
+            c.ended_ok = True
+        elif not c.ended_ok:
             raise Exception(f"[streamlink] Non-zero exit code {p.returncode}")
-        self.ended_ok = False
 
-    async def watch(self, stream, prefix=''):
+    async def run_pipe(self, c: Channel, ffmpeg_args: list, raw_fp: str = None,
+                       on_line: Callable[[str], Awaitable[None]] = None, size: Callable[[], int] = None) -> bool:
+        """
+        Pipe streamlink into ffmpeg, returns True if ffmpeg exited cleanly.
+        raw_fp gets a copy of streamlink's output, on_line is called with every line ffmpeg writes to stdout,
+        size returns the bytes received so far to detect stalls.
+        """
+        c.ended_ok = False
+        sl = await asyncio.create_subprocess_exec(
+            'streamlink', c.stream.url, 'best', '--stdout', '-l', 'info',
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        c.process = sl
+        ff = await asyncio.create_subprocess_exec(
+            'ffmpeg', *ffmpeg_args, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE if on_line else asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        tasks = [self.pump(c, sl.stdout, ff.stdin, raw_fp),
+                 self.watch(c, sl.stderr, prefix='LOG'),
+                 self.watch(c, ff.stderr, prefix='STDERR', name='ffmpeg')]
+        if on_line:
+            tasks.append(self.read_lines(ff.stdout, on_line))
+        if size:
+            tasks.append(self.watch_stall(c, sl, size))
+        try:
+            # noinspection PyTypeChecker
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            c.logger.critical('Remux pipe critical failure: %s', str(e))
+        finally:
+            for p in (sl, ff):
+                if p.returncode is None:
+                    p.kill()
+        await asyncio.gather(sl.wait(), ff.wait())
+        if sl.returncode == 0:
+            c.ended_ok = True
+        elif not c.ended_ok:
+            c.logger.error('[streamlink] Non-zero exit code %d', sl.returncode)
+        if ff.returncode != 0:
+            c.logger.error('[ffmpeg] Non-zero exit code %d', ff.returncode)
+        return ff.returncode == 0
+
+    @staticmethod
+    async def read_lines(stream: asyncio.StreamReader, on_line: Callable[[str], Awaitable[None]]):
+        async for line in stream:
+            if line := line.decode().strip():
+                await on_line(line)
+
+    @staticmethod
+    async def pump(c: Channel, src: asyncio.StreamReader, dst: asyncio.StreamWriter, raw_fp: str = None,
+                   chunk_size: int = 1 << 16, write_size: int = 1 << 20):
+        """
+        Copy streamlink's output to ffmpeg and raw_fp, the raw copy continues if ffmpeg dies.
+        The raw copy is written and its keyframes indexed in an executor, write_size bytes at a time
+        with at most one write running. Chunks received meanwhile are written with the next one.
+        """
+        loop = asyncio.get_event_loop()
+        fw = open(raw_fp, 'wb') if raw_fp else None
+        indexer = KeyframeIndexer(sidecar_path(raw_fp)) if raw_fp else None
+        buf = bytearray()
+        writing: Optional[asyncio.Future] = None
+
+        def _write(data: bytes):
+            fw.write(data)
+            indexer.feed(data)
+
+        try:
+            while chunk := await src.read(chunk_size):
+                c.received += len(chunk)
+                if fw:
+                    buf += chunk
+                    if len(buf) >= write_size and (writing is None or writing.done()):
+                        if writing:
+                            writing.result()
+                        writing = loop.run_in_executor(None, _write, bytes(buf))
+                        buf.clear()
+                if dst:
+                    try:
+                        dst.write(chunk)
+                        await dst.drain()
+                    except (BrokenPipeError, ConnectionResetError):
+                        c.logger.error('ffmpeg stopped reading')
+                        dst = None
+        finally:
+            if fw:
+                try:
+                    if writing:
+                        await writing
+                    if buf:
+                        await loop.run_in_executor(None, _write, bytes(buf))
+                finally:
+                    fw.close()
+                    indexer.close()
+            if dst:
+                dst.close()
+
+    @staticmethod
+    async def watch(c: Channel, stream, prefix='', name='streamlink'):
         try:
             async for line in stream:
                 tmp = line.decode()
                 if 'Opening stream' in tmp:
-                    self.logger.info("Stream opened.")
+                    c.logger.info("Stream opened.")
                 elif 'Stream ended' in tmp:
-                    self.ended_ok = True
-                    self.logger.info("Stream ended.")
+                    c.ended_ok = True
+                    c.logger.info("Stream ended.")
                 elif prefix == 'STDERR':
-                    self.logger.warning('[streamlink] %s: %s', prefix, tmp)
+                    c.logger.warning('[%s] %s: %s', name, prefix, tmp)
                 else:
-                    self.logger.debug('[streamlink] %s: %s', prefix, tmp)
+                    c.logger.debug('[%s] %s: %s', name, prefix, tmp)
         except ValueError as e:
-            self.logger.warning('[streamlink] STREAM: %s', str(e))
+            c.logger.warning('[%s] STREAM: %s', name, str(e))
             pass
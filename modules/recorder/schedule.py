@@ -0,0 +1,118 @@
+import json
+import os
+import random
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+DAY = 86400
+WEEK = 7 * DAY
+
+
+class PollSchedule:
+    """
+    Live check intervals learned from when channels went live before
+
+    Every past start opens a window from before seconds earlier to after
+    seconds later, at the same time of day or, once the history covers
+    weekly_after seconds, the same time of the week. Inside a window channels
+    are checked every fast seconds. Outside one the interval doubles with
+    every check from timeout up to max_timeout, but never skips the start of
+    the next window. Channels with fewer than min_samples starts are checked
+    every timeout seconds. All intervals get +-jitter so channels spread out.
+
+    If store_path is given the history is kept on disk as JSON.
+    """
+    def __init__(self, store_path: str = None, **kwargs):
+        self.store_path: Optional[str] = store_path
+        self.timeout: float = float(kwargs.pop('timeout', 120))
+        self.fast: float = float(kwargs.pop('fast', 30))
+        self.max_timeout: float = float(kwargs.pop('max_timeout', 1800))
+        self.before: float = float(kwargs.pop('before', 1800))
+        self.after: float = float(kwargs.pop('after', 3600))
+        self.min_samples: int = int(kwargs.pop('min_samples', 3))
+        self.max_samples: int = int(kwargs.pop('max_samples', 60))
+        self.weekly_after: float = float(kwargs.pop('weekly_after', 3 * WEEK))
+        self.jitter: float = float(kwargs.pop('jitter', 0.2))
+        # Login -> start times (epoch), oldest first
+        self.history: Dict[str, List[float]] = {}
+        # Login -> checks outside a window since the last one inside
+        self.misses: Dict[str, int] = {}
+        if store_path and os.path.exists(store_path):
+            try:
+                with open(store_path, 'r', encoding='utf-8') as fr:
+                    self.history.update(json.load(fr))
+            except Exception as e:
+                print(f'Cannot read schedule history {store_path}: {e}')
+
+    def _save(self):
+        if not self.store_path:
+            return
+        tmp_path = f'{self.store_path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as fw:
+                json.dump(self.history, fw)
+            os.replace(tmp_path, self.store_path)
+        except OSError as e:
+            print(f'Cannot write schedule history {self.store_path}: {e}')
+
+    def add_start(self, login: str, created_at: datetime):
+        """Remember when login went live, restarts of the same stream are only counted once"""
+        ts = created_at.timestamp()
+        starts = self.history.setdefault(login, [])
+        if any(abs(ts - s) < 60 for s in starts):
+            return
+        starts.append(ts)
+        starts.sort()
+        del starts[:-self.max_samples]
+        self.misses.pop(login, None)
+        self._save()
+
+    def period(self, login: str) -> Optional[int]:
+        """DAY or WEEK depending on how much history there is, None if too little"""
+        starts = self.history.get(login, [])
+        if len(starts) < self.min_samples:
+            return None
+        return WEEK if starts[-1] - starts[0] >= self.weekly_after else DAY
+
+    @staticmethod
+    def position(ts: float, period: int) -> float:
+        """Local seconds since Monday 00:00, modulo period"""
+        dt = datetime.fromtimestamp(ts)
+        return (dt.weekday() * DAY + dt.hour * 3600 + dt.minute * 60 + dt.second) % period
+
+    def until_window(self, login: str, now: float = None) -> Optional[float]:
+        """Seconds until the next window opens, 0 inside one, None without enough history"""
+        if not (period := self.period(login)):
+            return None
+        pos = self.position(now or time.time(), period)
+        ret = period
+        for start in self.history[login]:
+            start_pos = self.position(start, period)
+            if (pos - start_pos) % period <= self.after or (start_pos - pos) % period <= self.before:
+                return 0
+            ret = min(ret, (start_pos - self.before - pos) % period)
+        return ret
+
+    def delay(self, login: str, now: float = None) -> float:
+        """Seconds until the next live check of login, which was found offline"""
+        until = self.until_window(login, now)
+        if until is None:
+            return self.spread(self.timeout)
+        if until == 0:
+            self.misses.pop(login, None)
+            return self.spread(self.fast)
+        misses = self.misses.get(login, 0)
+        self.misses[login] = misses + 1
+        return max(1.0, min(self.spread(min(self.max_timeout, self.timeout * 2 ** misses)), until))
+
+    def spread(self, seconds: float) -> float:
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def describe(self, login: str) -> str:
+        """Windows of login for logs"""
+        if not (period := self.period(login)):
+            return 'not enough history'
+        fmt = '%a %H:%M' if period == WEEK else '%H:%M'
+        starts = sorted(self.history[login], key=lambda s: self.position(s, period))
+        return ', '.join(dict.fromkeys(datetime.fromtimestamp(s).strftime(fmt) for s in starts))
@@ -16,6 +16,7 @@ class StreamData:
         self.user_logo: str = kwargs.pop('user_logo', '')
         self.title: str = kwargs.pop('title', '')
         self.url: str = kwargs.pop('url', '')
+        self.user_id: str = kwargs.pop('user_id', '')
 
     @property
     def created_at_str(self) -> str:
@@ -28,9 +29,14 @@ class StreamData:
 
     @classmethod
     def from_json(cls, data: Optional[dict]):
+        """From a single stream response"""
         if not data or not data.get('stream'):
             return None
-        data = data['stream']
+        return cls.from_stream(data['stream'])
+
+    @classmethod
+    def from_stream(cls, data: dict):
+        """From one stream object, as found in single and multiple stream responses"""
         kwargs = {'type_': data['stream_type']}
         if time_str := data.get('created_at'):
             try:
@@ -41,8 +47,22 @@ class StreamData:
                 LOGGER.warning(f'Cannot parse time string "{time_str}": {e}')
         kwargs['preview'] = data['preview']['medium']
         if data.get('channel'):
+            kwargs['user_id'] = str(data['channel'].get('_id', ''))
             kwargs['url'] = data['channel']['url']
             kwargs['user_logo'] = data['channel']['logo']
             if data['channel'].get('status'):
                 kwargs['title'] = data['channel']['status'].replace("/", "")
         return cls(**kwargs)
+
+    @classmethod
+    def from_event(cls, event: dict):
+        """From an EventSub stream.online event, it has no title or images"""
+        kwargs = {'type_': event.get('type', 'live'), 'user_id': str(event.get('broadcaster_user_id', ''))}
+        if time_str := event.get('started_at'):
+            try:
+                kwargs['created_at'] = isoparse(time_str).astimezone(tz=None)
+            except Exception as e:
+                LOGGER.warning(f'Cannot parse time string "{time_str}": {e}')
+        if login := event.get('broadcaster_user_login'):
+            kwargs['url'] = f'https://www.twitch.tv/{login}'
+        return cls(**kwargs)
@@ -6,6 +6,7 @@ class UserData:
         self.name: str = kwargs.pop('name')
         self._display_name: str = kwargs.pop('display_name', '')
         self.id: str = kwargs.pop('id', '')
+        self.logo: str = kwargs.pop('logo', '')
 
     @property
     def display_name(self):
@@ -20,5 +21,10 @@ class UserData:
         return cls(
             display_name=data.get('display_name'),
             id=data.get('_id'),
+            logo=data.get('logo') or '',
             name=data.get('name'),
         )
+
+    def to_json(self) -> dict:
+        """Inverse of from_json"""
+        return {'display_name': self._display_name, '_id': self.id, 'logo': self.logo, 'name': self.name}
@@ -0,0 +1,201 @@
+"""
+Encoder pipeline benchmark on generated media
+
+Generates FLV recordings with ffmpeg's lavfi testsrc2 and sine sources, then
+runs each through Encoder.run_job once per profile and repeat. Every run is
+done in its own process so CPU time and peak RSS of it and its ffmpeg children
+are not mixed with other runs. Results are written as JSON, compare runs with
+the summary block or the per run entries.
+
+python scripts/bench_encoder.py --duration 120 --resolution 1280x720 --repeat 3 -o bench.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Profile -> file name tag and Encoder kwargs
+PROFILES = {
+    'copy': ('Copy', dict()),
+    'hevc': ('Hevc', dict(hevc_pattern='Hevc')),
+    'hevc-chunked': ('Hevc', dict(hevc_pattern='Hevc', chunk_segments=4)),
+}
+
+
+def generate(fp: str, duration: float, resolution: str, fps: int):
+    """Write a FLV like the recorder does, H.264 and AAC"""
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={resolution}:rate={fps}',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(duration),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-g', str(fps * 2), '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-f', 'flv', fp,
+    ], check=True)
+
+
+def ffmpeg_version() -> str:
+    try:
+        out = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, check=True).stdout
+        return out.splitlines()[0]
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def hist_sum(histogram, **labels) -> float:
+    key = histogram.key(labels) if labels else ()
+    return histogram.sums.get(key, 0.0)
+
+
+async def run_one(profile: str, in_fp: str, work_dir: str, kwargs: dict) -> dict:
+    from modules.encoder import Encoder
+
+    class BenchEncoder(Encoder):
+        jobs_file = os.path.join(work_dir, 'jobs.json')
+
+    src_path = os.path.join(work_dir, 'src')
+    out_path = os.path.join(work_dir, 'out')
+    os.makedirs(src_path)
+    os.makedirs(out_path)
+    tag, enc_kwargs = PROFILES[profile]
+    name = f'{datetime.now():%y%m%d-%H%M}_bench_{tag}_{profile}.flv'
+    shutil.copy(in_fp, os.path.join(src_path, name))
+    enc = BenchEncoder(asyncio.get_running_loop(), src_path=src_path, out_path=out_path, no_notifications=True,
+                       probe_cache_file=None, trim_cfg_path=os.path.join(ROOT, 'data/trimmer/config.json'),
+                       **enc_kwargs, **kwargs)
+    await enc.async_init()
+    job = enc.job_from_file(name)
+    ret = dict(profile=profile, input_bytes=os.path.getsize(os.path.join(src_path, name)))
+    try:
+        if not await enc.prepare_job(job):
+            raise RuntimeError(f'{name} was not accepted by {profile}')
+        cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        await enc.run_job(job)
+        wall = time.perf_counter() - start
+        cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        await enc.close()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    encode = hist_sum(enc.metrics.encode_seconds, codec=job.enc_codec)
+    ret.update(
+        codec=job.enc_codec,
+        preset=job.preset,
+        chunks=job.chunks,
+        error=job.error,
+        duration=job.duration,
+        output_bytes=job.out_size,
+        wall_seconds=round(wall, 3),
+        encode_seconds=round(encode, 3),
+        speed=round(job.duration / wall, 3) if job.duration and wall else None,
+        # Probing, trimming, moving and bookkeeping around the encode
+        overhead_seconds=round(wall - encode, 3),
+        stages={k[0]: round(v, 3) for k, v in enc.metrics.stage_seconds.sums.items()},
+        ffmpeg_cpu_seconds=round(children.ru_utime + children.ru_stime, 3),
+        python_cpu_seconds=round((cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime), 3),
+        # ru_maxrss is KiB on Linux
+        ffmpeg_peak_rss_mb=round(children.ru_maxrss / 1024, 1),
+        python_peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    )
+    return ret
+
+
+def run_process(queue: multiprocessing.Queue, profile: str, in_fp: str, work_dir: str, kwargs: dict):
+    try:
+        queue.put(asyncio.run(run_one(profile, in_fp, work_dir, kwargs)))
+    except Exception as e:
+        queue.put(dict(profile=profile, error=f'{e.__class__.__name__}: {e}'))
+
+
+def summarize(runs: list) -> dict:
+    ret = {}
+    for profile in dict.fromkeys(r['profile'] for r in runs):
+        ok = [r for r in runs if r['profile'] == profile and not r.get('error')]
+        if not ok:
+            continue
+        ret[profile] = {
+            k: round(statistics.median(r[k] for r in ok), 3)
+            for k in ('wall_seconds', 'speed', 'overhead_seconds', 'ffmpeg_cpu_seconds', 'ffmpeg_peak_rss_mb')
+            if all(r.get(k) is not None for r in ok)
+        }
+        ret[profile]['runs'] = len(ok)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the encoder pipeline on generated media')
+    parser.add_argument('-d', '--duration', type=float, default=60, help='Seconds of media per input')
+    parser.add_argument('-r', '--resolution', type=str, default='1280x720', help='WIDTHxHEIGHT')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('-p', '--profile', action='append', choices=list(PROFILES),
+                        help='Profiles to run, repeat for several (default all)')
+    parser.add_argument('-n', '--repeat', type=int, default=1, help='Runs per profile')
+    parser.add_argument('--chunk_parallel', type=int, default=4, help='Segments encoded at once by hevc-chunked')
+    parser.add_argument('--nice', type=int, default=0, help='Niceness of ffmpeg processes')
+    parser.add_argument('-o', '--out', type=str, help='JSON result file (default bench-<time>.json)')
+    parser.add_argument('--work_dir', type=str, help='Scratch directory (default a temporary one)')
+    args = parser.parse_args()
+
+    started = datetime.now()
+    profiles = args.profile or list(PROFILES)
+    out = os.path.abspath(args.out or f'bench-{started:%y%m%d-%H%M%S}.json')
+    work_root = args.work_dir or tempfile.mkdtemp(prefix='bench_encoder_')
+    os.makedirs(work_root, exist_ok=True)
+    in_fp = os.path.join(work_root, f'input_{args.resolution}_{args.fps}_{args.duration:g}.flv')
+    if not os.path.exists(in_fp):
+        print(f'Generating {in_fp}')
+        generate(in_fp, args.duration, args.resolution, args.fps)
+    # Loggers write to log/ in the working directory
+    os.makedirs(os.path.join(work_root, 'log'), exist_ok=True)
+    os.chdir(work_root)
+    kwargs = dict(chunk_parallel=args.chunk_parallel, nice=args.nice)
+    ctx = multiprocessing.get_context('spawn')
+    runs = []
+    try:
+        for i in range(args.repeat):
+            for profile in profiles:
+                work_dir = os.path.join(work_root, f'{profile}_{i}')
+                shutil.rmtree(work_dir, ignore_errors=True)
+                queue = ctx.Queue()
+                proc = ctx.Process(target=run_process, args=(queue, profile, in_fp, work_dir, kwargs))
+                proc.start()
+                result = queue.get()
+                proc.join()
+                result['repeat'] = i
+                runs.append(result)
+                shutil.rmtree(work_dir, ignore_errors=True)
+                print(f'{profile} #{i}: ' + (f"error {result['error']}" if result.get('error') else
+                                            f"{result['wall_seconds']}s wall, {result['speed']}x"))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_root, ignore_errors=True)
+    report = dict(
+        started=started.isoformat(timespec='seconds'),
+        host=dict(hostname=socket.gethostname(), cpus=os.cpu_count(), platform=platform.platform(),
+                  python=platform.python_version(), ffmpeg=ffmpeg_version()),
+        params=dict(duration=args.duration, resolution=args.resolution, fps=args.fps, repeat=args.repeat,
+                    profiles=profiles, **kwargs),
+        summary=summarize(runs),
+        runs=runs,
+    )
+    with open(out, 'w', encoding='utf-8') as fw:
+        json.dump(report, fw, indent=2)
+    print(f'Results written to {out}')
+
+
+if __name__ == '__main__':
+    main()
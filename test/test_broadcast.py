@@ -0,0 +1,91 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+from modules.encoder import Encoder, Job
+
+
+def make_encoder(tmp_path) -> Encoder:
+    class TestEncoder(Encoder):
+        jobs_file = str(tmp_path / 'jobs.json')
+    return TestEncoder(asyncio.get_running_loop(), src_path=str(tmp_path / 'src'), out_path=str(tmp_path / 'out'),
+                       no_notifications=True, probe_cache_file=None, hevc_pattern='Hevc', trim_cfg_path='data/trimmer/config.json')
+
+
+def test_stitch(tmp_path):
+    async def _run():
+        enc = make_encoder(tmp_path)
+        concat = []
+
+        async def fake_concat(files, out_fp, audio_codec='copy', list_fp=None):
+            concat.append(([os.path.basename(f) for f in files], audio_codec))
+            with open(out_fp, 'wb') as fw:
+                fw.write(b'stitched')
+        enc.chunker.concat = fake_concat
+        parts = []
+        for i in range(3):
+            job = Job(input=f'rec.part{i:03d}.flv', title='Some Hevc', user='user', created_at=datetime(2020, 1, 1),
+                      broadcast='b1', part=i)
+            await enc.prepare_job(job)
+            job.enc_end = datetime.utcnow()
+            os.makedirs(enc.broadcast_dir('b1'), exist_ok=True)
+            with open(enc.part_path(job), 'wb') as fw:
+                fw.write(b'x')
+            enc.store.save(job)
+            parts.append(job)
+        # Number of parts is not known yet
+        await enc.stitch('b1')
+        assert not concat
+        for job in parts:
+            job.parts_total = 4
+        # A part is missing
+        await enc.stitch('b1')
+        assert not concat
+        for job in parts:
+            job.parts_total = 3
+        await enc.stitch('b1')
+        assert concat == [(['part_0000.mkv', 'part_0001.mkv', 'part_0002.mkv'], 'aac')]
+        # Parts copy audio, it is encoded once while stitching
+        args = enc.job_args(parts[0])
+        assert args[args.index('-c:a') + 1] == 'copy'
+        await enc.close()
+        return parts
+    parts = asyncio.run(_run())
+    assert parts[0].out_file == '200101-0000_Some Hevc.mkv'
+    assert (tmp_path / 'out' / 'user' / parts[0].out_file).read_bytes() == b'stitched'
+    # Renamed within one filesystem, not hashed
+    assert parts[-1].out_sha256 is None
+    assert not (tmp_path / 'src' / 'broadcast_b1').exists()
+
+
+def test_join_pieces(tmp_path, monkeypatch):
+    async def fake_info(fp, *_args, **_kwargs):
+        return timedelta(seconds=10) if 'joined' in fp or not fp.endswith('.flv') else timedelta(seconds=5)
+    monkeypatch.setattr('modules.encoder.encoder.probe_duration', fake_info)
+
+    async def _run():
+        enc = make_encoder(tmp_path)
+        concat = []
+
+        async def fake_concat(files, out_fp, audio_codec='copy', list_fp=None):
+            concat.append([os.path.basename(f) for f in files])
+            with open(out_fp, 'wb') as fw:
+                fw.write(b'joined')
+        enc.chunker.concat = fake_concat
+        for name in ('rec.flv', 'rec.piece1.flv'):
+            (tmp_path / 'src' / name).write_bytes(b'x')
+        job = Job(input='rec.flv', title='Some Hevc', user='user', pieces=['rec.piece1.flv'])
+        enc.store.save(job)
+        assert enc.is_claimed('rec.piece1.flv')
+        await enc.join_task(job)
+        assert concat == [['rec.flv', 'rec.piece1.flv']]
+        assert job.input == 'rec.joined.flv' and job.pieces is None
+        assert not enc.is_claimed('rec.piece1.flv')
+        # A piece is missing, the job encodes its input alone
+        (tmp_path / 'src' / 'other.flv').write_bytes(b'x')
+        other = Job(input='other.flv', title='Some Hevc', user='user', pieces=['other.piece1.flv'])
+        await enc.join_task(other)
+        assert other.input == 'other.flv' and other.pieces is None
+        await enc.close()
+    asyncio.run(_run())
+    assert sorted(os.listdir(tmp_path / 'src')) == ['other.flv', 'rec.joined.flv']
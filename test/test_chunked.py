@@ -0,0 +1,85 @@
+import asyncio
+import json
+import logging
+import os
+import subprocess
+
+import pytest
+
+from modules.encoder import ChunkedEncode
+from test.test_broadcast import make_encoder
+
+# Like Encoder.hevc_args, with a faster codec
+ENC_ARGS = ['-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac'] + ChunkedEncode.out_flags
+
+
+def generate(fp: str, duration: int = 6):
+    """H.264 and AAC FLV with a keyframe every second"""
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', 'testsrc2=size=320x180:rate=15',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '15', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-f', 'flv', fp,
+    ], check=True)
+
+
+class RecordingChunkedEncode(ChunkedEncode):
+    """Remembers the output of every ffmpeg run, cancels the encode of cancel_at"""
+    def __init__(self, *args, cancel_at: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cancel_at = cancel_at
+        self.outputs = []
+
+    async def ffmpeg(self, codec: str, args: list, progress=None):
+        out = os.path.basename(args[-1])
+        if out == self.cancel_at:
+            raise asyncio.CancelledError()
+        self.outputs.append(out)
+        await super().ffmpeg(codec, args, progress)
+
+
+def test_run(tmp_path):
+    in_fp = str(tmp_path / 'in.flv')
+    out_fp = str(tmp_path / 'out.mkv')
+    generate(in_fp)
+    samples = []
+
+    async def _run():
+        chunked = RecordingChunkedEncode(logging.getLogger('test'), segments=3, parallel=2, print_every=1)
+        await chunked.run(in_fp, out_fp, ENC_ARGS, 6, progress=samples.append)
+        enc = make_encoder(tmp_path)
+        await enc.check_duration(in_fp, out_fp)
+        await enc.close()
+        return chunked.outputs
+    outputs = asyncio.run(_run())
+    assert outputs[0] == 'seg_%03d.mkv' and outputs[-1] == 'out.mkv'
+    assert sorted(outputs[1:-1]) == ['enc_seg_000.mkv', 'enc_seg_001.mkv', 'enc_seg_002.mkv']
+    assert not os.path.exists(ChunkedEncode.work_dir(out_fp))
+    # Samples of all segments are summed
+    assert samples and float(samples[-1]['out_time'].split(':')[-1]) > 2
+
+
+def test_resume(tmp_path):
+    in_fp = str(tmp_path / 'in.flv')
+    out_fp = str(tmp_path / 'out.mkv')
+    generate(in_fp)
+    work_dir = ChunkedEncode.work_dir(out_fp)
+    logger = logging.getLogger('test')
+    chunked = RecordingChunkedEncode(logger, segments=3, parallel=1, cancel_at='enc_seg_002.mkv')
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(chunked.run(in_fp, out_fp, ENC_ARGS, 6))
+    with open(os.path.join(work_dir, 'manifest.json'), 'r', encoding='utf-8') as fr:
+        assert json.load(fr)['done'] == ['seg_000.mkv', 'seg_001.mkv']
+    # Only the unfinished segment is encoded again
+    chunked = RecordingChunkedEncode(logger, segments=3, parallel=1)
+    asyncio.run(chunked.run(in_fp, out_fp, ENC_ARGS, 6))
+    assert chunked.outputs == ['enc_seg_002.mkv', 'out.mkv']
+    assert os.path.exists(out_fp) and not os.path.exists(work_dir)
+    # Other arguments do not match the manifest, the input is split again
+    chunked = RecordingChunkedEncode(logger, segments=3, parallel=1, cancel_at='enc_seg_000.mkv')
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(chunked.run(in_fp, out_fp, ENC_ARGS, 6))
+    chunked = RecordingChunkedEncode(logger, segments=2, parallel=1)
+    asyncio.run(chunked.run(in_fp, out_fp, ENC_ARGS, 6))
+    assert chunked.outputs[0] == 'seg_%03d.mkv'
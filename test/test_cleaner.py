@@ -298,3 +298,17 @@ class TestCleanup:
                     is_in_err.append(f"EXTRA {name} - {ref_dt}")
         if is_in_err:
             print(f"\nExpected in warn_str but not found:\n" + '\n'.join(is_in_err))
+
+
+def test_get_files(tmp_path):
+    """Remuxed recordings are cleaned like FLV ones, sidecars are not listed"""
+    for name in ('200401-0000_A.flv', '200401-0000_B.mp4', '200401-0000_A.flv.kfi', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'x')
+
+    async def _run():
+        cleaner = Cleaner(loop=asyncio.get_running_loop(), check_path=str(tmp_path), no_notifications=True,
+                          dry_run=True)
+        await cleaner.init_task
+        return cleaner
+    cleaner = asyncio.run(_run())
+    assert sorted(cleaner.pending) == ['200401-0000_A.flv', '200401-0000_B.mp4']
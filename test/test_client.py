@@ -0,0 +1,74 @@
+import asyncio
+import socket
+import time
+
+import pytest
+from aiohttp import web
+
+from modules.recorder import InvalidResponseError, TTLCache, TwitchClient
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_ttl_cache(tmp_path, monkeypatch):
+    store_path = str(tmp_path / 'cache.json')
+    cache = TTLCache(store_path, ttl=60)
+    cache.set('user:a', dict(_id='1'))
+    cache.set('short', 1, ttl=-1)
+    assert cache.get('user:a') == dict(_id='1')
+    assert cache.get('short') is None
+    # Survives a restart
+    assert TTLCache(store_path).get('user:a') == dict(_id='1')
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    assert TTLCache(store_path).get('user:a') is None
+
+
+def test_client():
+    async def _run():
+        responses = []
+
+        async def handler(r: web.Request):
+            status, headers = responses.pop(0)
+            return web.json_response(dict(path=r.path, query=dict(r.query)), status=status, headers=headers)
+        app = web.Application()
+        app.add_routes([web.get('/{tail:.*}', handler)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        port = free_port()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        client = TwitchClient(backoff=0.01, retries=2, reserve=1)
+        await client.start()
+        url = f'http://127.0.0.1:{port}/users'
+        try:
+            # Server errors are retried
+            responses += [(500, {}), (200, {'Ratelimit-Limit': '800', 'Ratelimit-Remaining': '700'})]
+            assert (await client.get_json(url, params=dict(login='a')))['query'] == dict(login='a')
+            assert not responses
+            assert client.limits[f'127.0.0.1:{port}'].remaining == 700
+            # Client errors are not
+            responses += [(404, {}), (200, {})]
+            with pytest.raises(InvalidResponseError):
+                await client.get_json(url)
+            assert len(responses) == 1
+            responses.clear()
+            # Out of retries
+            responses += [(503, {})] * 3
+            with pytest.raises(InvalidResponseError):
+                await client.get_json(url)
+            assert not responses
+            # Budget used up, wait for the reset
+            reset = str(time.time() + 0.5)
+            responses += [(200, {'Ratelimit-Remaining': '1', 'Ratelimit-Reset': reset}), (200, {})]
+            await client.get_json(url)
+            start = time.monotonic()
+            await client.get_json(url)
+            assert time.monotonic() - start > 0.3
+        finally:
+            await client.close()
+            await runner.cleanup()
+    asyncio.run(_run())
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+
+import pytest
+
+from modules.encoder import CpuAllocator, CpuTopology
+from modules.encoder.cpu import fmt_cpulist, parse_cpulist
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def make_sys(tmp_path):
+    """Two nodes with 2 cores each, hyperthread siblings are n and n+4"""
+    sys_path = tmp_path / 'sys'
+    write(sys_path / 'devices/system/node/node0/cpulist', '0-1,4-5\n')
+    write(sys_path / 'devices/system/node/node1/cpulist', '2-3,6-7\n')
+    for cpu in range(8):
+        write(sys_path / f'devices/system/cpu/cpu{cpu}/topology/core_id', str(cpu % 4))
+        write(sys_path / f'devices/system/cpu/cpu{cpu}/topology/physical_package_id', str((cpu % 4) // 2))
+    return str(sys_path)
+
+
+def test_cpulist():
+    assert parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert fmt_cpulist([11, 0, 1, 2, 3, 8, 10]) == '0-3,8,10-11'
+    assert parse_cpulist('') == []
+
+
+def test_quota(tmp_path):
+    write(tmp_path / 'v2/cpu.max', '250000 100000\n')
+    assert CpuTopology.read_quota(str(tmp_path / 'v2')) == 2.5
+    write(tmp_path / 'v2max/cpu.max', 'max 100000\n')
+    assert CpuTopology.read_quota(str(tmp_path / 'v2max')) is None
+    write(tmp_path / 'v1/cpu/cpu.cfs_quota_us', '400000')
+    write(tmp_path / 'v1/cpu/cpu.cfs_period_us', '100000')
+    assert CpuTopology.read_quota(str(tmp_path / 'v1')) == 4
+    write(tmp_path / 'v1none/cpu/cpu.cfs_quota_us', '-1')
+    write(tmp_path / 'v1none/cpu/cpu.cfs_period_us', '100000')
+    assert CpuTopology.read_quota(str(tmp_path / 'v1none')) is None
+
+
+def test_detect(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda _: set(range(8)), raising=False)
+    topo = CpuTopology.detect(sys_path=make_sys(tmp_path), cgroup_path=str(tmp_path / 'none'))
+    assert topo.nodes == {0: [0, 1, 4, 5], 1: [2, 3, 6, 7]}
+    # Siblings next to each other, one node after the other
+    assert topo.ordered == [0, 4, 1, 5, 2, 6, 3, 7]
+    assert topo.quota is None and topo.usable == 8
+    topo = CpuTopology.detect(cpus=[0, 1, 2], sys_path=make_sys(tmp_path), cgroup_path=str(tmp_path / 'none'))
+    assert topo.cpus == [0, 1, 2]
+    assert topo.nodes == {0: [0, 1], 1: [2]}
+
+
+@pytest.fixture
+def allocator():
+    topo = CpuTopology(list(range(8)), nodes={0: [0, 1, 4, 5], 1: [2, 3, 6, 7]},
+                       cores={c: ((c % 4) // 2, c % 4) for c in range(8)})
+    return CpuAllocator(topo, logger=logging.getLogger('test'))
+
+
+def test_rebalance(allocator):
+    with allocator.process('hevc') as a:
+        assert a.cpus == allocator.topology.ordered and a.threads == 8
+        with allocator.process('hevc') as b:
+            # One node each
+            assert a.cpus == [0, 4, 1, 5] and b.cpus == [2, 6, 3, 7]
+            assert b.threads == 4
+            with allocator.process('copy') as c:
+                assert c.cpus == allocator.topology.ordered and c.threads == 0
+                assert len(a.cpus) == 4
+        assert a.cpus == allocator.topology.ordered
+        # Threads do not change once started
+        assert a.threads == 8
+    assert not allocator.allocations
+
+
+def test_more_processes_than_cpus(allocator):
+    allocs = []
+    for _ in range(10):
+        ctx = allocator.process('hevc')
+        allocs.append((ctx, ctx.__enter__()))
+    assert all(len(a.cpus) == 1 for _, a in allocs)
+    for ctx, _ in reversed(allocs):
+        ctx.__exit__(None, None, None)
+
+
+def test_quota_threads():
+    allocator = CpuAllocator(CpuTopology(list(range(8)), quota=3))
+    with allocator.process('hevc') as a:
+        assert len(a.cpus) == 8 and a.threads == 3
+        with allocator.process('hevc') as b:
+            assert b.threads == 1
+
+
+def test_apply(allocator):
+    args = ['-c:v', 'libx265', '-x265-params', 'crf=23:pools=4', '-preset:v', 'fast']
+    with allocator.process('hevc') as a:
+        ret = allocator.apply(a, args)
+    assert ret[3] == 'crf=23:pools=8:frame-threads=3'
+    assert args[3] == 'crf=23:pools=4'
+    with allocator.process('copy') as c:
+        assert allocator.apply(c, args) == args
+
+
+def test_throughput(allocator):
+    released = []
+    allocator.on_release = released.append
+    with allocator.process('hevc') as a:
+        a.start -= 10
+        allocator.track(a)(dict(out_time='00:00:20.000000'))
+    assert released == [a]
+    assert round(allocator.throughput[8], 1) == 2.0
+    assert allocator.to_dict()['throughput'] == {8: round(allocator.throughput[8], 3)}
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'), reason='Linux only')
+def test_run(allocator):
+    cpus = sorted(os.sched_getaffinity(0))
+    allocator.topology = CpuTopology(cpus)
+    started = []
+    allocator.attach = lambda alloc: started.append
+    asyncio.run(allocator.run(logging.getLogger('test'), 'hevc',
+                              ['-f', 'lavfi', '-i', 'nullsrc=d=0.1', '-f', 'null', '-']))
+    assert len(started) == 1
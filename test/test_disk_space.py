@@ -0,0 +1,47 @@
+import shutil
+from collections import namedtuple
+
+from modules.encoder import DiskAdmission, Job, SizeModel
+
+Usage = namedtuple('Usage', 'total used free')
+
+
+def make_job(**kwargs) -> Job:
+    return Job(input='1.flv', title='1', user='u', **kwargs)
+
+
+def test_size_model():
+    model = SizeModel()
+    assert model.estimate(make_job(enc_codec='hevc'), 1000) == 600
+    model.observe(make_job(enc_codec='hevc', preset='fast', in_size=1000, out_size=400, duration=10))
+    # Errors are not learned from
+    model.observe(make_job(enc_codec='hevc', preset='fast', in_size=1000, out_size=1, duration=10, error='x'))
+    assert model.estimate(make_job(enc_codec='hevc', preset='fast'), 2000) == 800
+    assert model.estimate(make_job(enc_codec='hevc', preset='fast'), 2000, duration=5) == 200
+    # Unmeasured preset falls back to the codec
+    assert model.estimate(make_job(enc_codec='hevc', preset='slow'), 2000, duration=20) == 800
+    assert model.estimate(make_job(enc_codec='copy'), 1000) == 1050
+
+
+def test_admission(tmp_path, monkeypatch):
+    monkeypatch.setattr(shutil, 'disk_usage', lambda _: Usage(10000, 7000, 3000))
+    admission = DiskAdmission(reserve=1000, margin=1)
+    first = make_job(enc_codec='copy')
+    second = make_job(enc_codec='copy')
+    assert admission.admit(first, 1500, None, str(tmp_path), str(tmp_path)) is None
+    # First job's output is reserved
+    reason = admission.admit(second, 1500, None, str(tmp_path), str(tmp_path))
+    assert reason and 'reserved' in reason
+    admission.release(first)
+    assert admission.admit(second, 1500, None, str(tmp_path), str(tmp_path)) is None
+    # Chunked jobs also need room for segments
+    admission.release(second)
+    assert admission.admit(make_job(enc_codec='hevc', chunks=4), 1000, None, str(tmp_path), str(tmp_path)) is not None
+    assert admission.admit(make_job(enc_codec='hevc'), 1000, None, str(tmp_path), str(tmp_path)) is None
+
+
+def test_deferred_status():
+    job = make_job(enc_codec='copy', queued_at='2020-01-01T00:00:00')
+    assert job.statuses() == {'queued'}
+    job.deferred = 'no space'
+    assert job.statuses() == {'deferred'}
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+from modules.encoder import Job
+from test.test_broadcast import make_encoder
+
+
+def test_list(tmp_path):
+    async def _run():
+        enc = make_encoder(tmp_path)
+        for i in range(3):
+            enc.store.save(Job(input=f'{i}.flv', title='Some Hevc', user='user'))
+        resp = await enc.handler_list(make_mocked_request('GET', '/job/list?limit=0'))
+        assert resp.status == 400
+        resp = await enc.handler_list(make_mocked_request('GET', '/job/list?limit=2'))
+        data = json.loads(resp.text)['data']
+        assert len(data['jobs']) == 2 and data['total'] == 3
+        etag = resp.headers['ETag']
+        resp = await enc.handler_list(make_mocked_request('GET', '/job/list?limit=2', headers={'If-None-Match': etag}))
+        assert resp.status == 304
+        # Another page is another body
+        resp = await enc.handler_list(make_mocked_request('GET', f'/job/list?limit=2&cursor={data["next"]}',
+                                                          headers={'If-None-Match': etag}))
+        assert resp.status == 200 and resp.headers['ETag'] != etag
+        # Parameter order does not matter
+        resp = await enc.handler_list(make_mocked_request('GET', '/job/list?order=asc&limit=2'))
+        etag = resp.headers['ETag']
+        assert etag == (await enc.handler_list(make_mocked_request('GET', '/job/list?limit=2&order=asc'))).headers['ETag']
+        # Nothing changed, answered without querying
+        query = enc.store.index.query
+        enc.store.index.query = None
+        resp = await enc.handler_list(make_mocked_request('GET', '/job/list?limit=2&order=asc',
+                                                          headers={'If-None-Match': etag}))
+        assert resp.status == 304
+        # A queued job is not in the index yet but changes the scheduler status
+        enc.store.index.query = query
+        enc.scheduler.submit(Job(input='3.flv', title='Some Hevc', user='user'), 'hevc')
+        resp = await enc.handler_list(make_mocked_request('GET', '/job/list?limit=2&order=asc',
+                                                          headers={'If-None-Match': etag}))
+        assert resp.status == 200 and resp.headers['ETag'] != etag
+        await enc.close()
+    asyncio.run(_run())
+
+
+def test_recover_jobs(tmp_path, monkeypatch):
+    async def fake_duration(*_args, **_kwargs):
+        return timedelta(seconds=10)
+    monkeypatch.setattr('modules.encoder.encoder.probe_duration', fake_duration)
+    started = datetime(2020, 1, 1)
+
+    async def _run():
+        enc = make_encoder(tmp_path)
+        src = tmp_path / 'src'
+        user_out = tmp_path / 'out' / 'user'
+        user_out.mkdir(parents=True)
+        jobs = dict(
+            finished=dict(input='a.flv', enc_end=started),
+            interrupted=dict(input='b.flv', enc_codec='hevc', preset='fast', ffmpeg_args='-c:v libx265'),
+            saved=dict(input='c.flv', enc_end=started),
+            lost=dict(input='d.flv'),
+        )
+        for key, kwargs in jobs.items():
+            jobs[key] = Job(title='Title', user='user', enc_start=started, out_file=kwargs['input'][0] + '.mkv',
+                            **kwargs)
+            enc.store.save(jobs[key])
+        for name in ('a.flv', 'enc_a.mkv', 'b.flv', 'enc_b.mkv'):
+            (src / name).write_bytes(b'x')
+        (user_out / 'c.mkv').write_bytes(b'x')
+        await enc.recover_jobs()
+        await enc.close()
+        return jobs
+    jobs = asyncio.run(_run())
+    # Finished encode is moved, its raw input deleted
+    assert jobs['finished'].deleted and not jobs['finished'].error
+    assert (tmp_path / 'out' / 'user' / 'a.mkv').exists()
+    # Interrupted encode is queued again without its partial output
+    job = jobs['interrupted']
+    assert job.enc_start is None and job.ffmpeg_args is None and job.queued_at and not job.deleted
+    assert sorted(os.listdir(tmp_path / 'src')) == ['b.flv']
+    # Only the final save was lost
+    assert jobs['saved'].deleted and not jobs['saved'].error
+    # Nothing left to recover from
+    assert jobs['lost'].ignored and jobs['lost'].error
+
+
+def test_trim(tmp_path, monkeypatch):
+    """The intro is found on the raw input and skipped by the encode itself"""
+    async def fake_duration(*_args, **_kwargs):
+        return timedelta(seconds=100)
+    monkeypatch.setattr('modules.encoder.encoder.probe_duration', fake_duration)
+
+    async def _run():
+        enc = make_encoder(tmp_path)
+        saved = []
+        checked = []
+        cmds = []
+        save = enc.store.save
+
+        def record_save(job: Job):
+            saved.append((job.start_seconds, job.enc_start))
+            save(job)
+        enc.store.save = record_save
+        enc.trimmer.get_cfg = lambda name: object()
+        enc.trimmer.find_intro = lambda file, check_name, fps=None: 42
+
+        async def fake_run(_logger, _codec, args, _print_every, progress=None):
+            cmds.append(args)
+            with open(args[-1], 'wb') as fw:
+                fw.write(b'encoded')
+        enc.cpu.run = fake_run
+
+        async def fake_check(raw_fp, proc_fp, offset=0):
+            checked.append(offset)
+        enc.check_duration = fake_check
+        (tmp_path / 'src' / 'rec.flv').write_bytes(b'x')
+        job = Job(input='rec.flv', title='Some Hevc', user='user', created_at=datetime(2020, 1, 1))
+        enc.store.save(job)
+        await enc.run_job(job)
+        await enc.close()
+        return job, saved, checked, cmds
+    job, saved, checked, cmds = asyncio.run(_run())
+    assert job.start_seconds == 42 and not job.error
+    # Saved before the encode started, a restart does not search for it again
+    assert (42, None) in saved
+    cmd = cmds[0]
+    assert cmd[:4] == ['-ss', '42', '-i', str(tmp_path / 'src' / 'rec.flv')]
+    assert job.ffmpeg_args == ' '.join(cmd)
+    assert checked == [42]
+    # Trimmed jobs keep their raw input
+    assert (tmp_path / 'src' / 'rec.flv').exists() and not job.deleted
+
+
+def test_drain(tmp_path, monkeypatch):
+    """An encode still running when the drain times out is checkpointed"""
+    async def fake_duration(*_args, **_kwargs):
+        return timedelta(seconds=100)
+    monkeypatch.setattr('modules.encoder.encoder.probe_duration', fake_duration)
+
+    async def _run():
+        enc = make_encoder(tmp_path)
+        enc.drain_seconds = 0.1
+        started = asyncio.Event()
+
+        async def fake_run(_logger, _codec, args, _print_every, progress=None):
+            with open(args[-1], 'wb') as fw:
+                fw.write(b'partial')
+            started.set()
+            await asyncio.sleep(60)
+        enc.cpu.run = fake_run
+        (tmp_path / 'src' / 'rec.flv').write_bytes(b'x')
+        job = Job(input='rec.flv', title='Some Copy', user='user', created_at=datetime(2020, 1, 1),
+                  enc_codec='copy', out_file='200101-0000_Some Copy.mp4')
+        enc.scheduler.start()
+        enc.enqueue(job)
+        await asyncio.wait_for(started.wait(), 1)
+        assert job.enc_start and os.path.exists(enc.tmp_path(job, 'enc'))
+        await enc.drain()
+        await enc.close()
+        assert job.enc_start is None and job.ffmpeg_args is None and not job.error
+        assert not os.path.exists(enc.tmp_path(job, 'enc'))
+        # The next start queues it again
+        enc = make_encoder(tmp_path)
+        job = enc.store.jobs[job.id]
+        await enc.close()
+        return job
+    job = asyncio.run(_run())
+    assert job.queued_at and job.enc_codec == 'copy'
+    assert not any((job.enc_start, job.enc_end, job.ignored, job.error, job.deleted))
+    assert os.listdir(tmp_path / 'src') == ['rec.flv']
+
+
+def test_batch(tmp_path):
+    async def _run():
+        enc = make_encoder(tmp_path)
+        (tmp_path / 'src' / 'a.flv').write_bytes(b'x')
+        app = web.Application()
+        app.add_routes([web.post('/job/batch', enc.handler_batch)])
+        results = []
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.post('/job/batch', json=dict(input='a.flv'))
+            assert resp.status == 400
+            job = dict(title='Some Hevc', user='user', created_at='2020-01-01T00:00:00')
+            resp = await client.post('/job/batch', json=[
+                'a.flv',
+                dict(input='a.flv'),
+                dict(job, input='missing.flv'),
+                dict(job, input='a.flv'),
+                dict(job, input='a.flv'),
+            ])
+            results += (await resp.json())['data']
+            enc.scheduler.drain()
+            resp = await client.post('/job/batch', json=[dict(job, input='a.flv')])
+            results += (await resp.json())['data']
+        status = enc.scheduler.status()
+        await enc.close()
+        return results, status
+    results, status = asyncio.run(_run())
+    assert [r['status'] for r in results] == ['invalid', 'invalid', 'missing', 'queued', 'duplicate', 'draining']
+    assert results[1]['input'] == 'a.flv' and 'title' in results[1]['error']
+    assert status['queued']['hevc'] == ['a.flv']
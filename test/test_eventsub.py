@@ -0,0 +1,65 @@
+import asyncio
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import ClientSession
+
+from modules.recorder import EventSubReceiver
+from modules.recorder.eventsub import HEADER_ID, HEADER_SIGNATURE, HEADER_TIMESTAMP, HEADER_TYPE, sign
+
+SECRET = 'test secret'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def post_sample(sess: ClientSession, url: str, sample: str, msg_type: str = 'notification',
+                      message_id: str = None, secret: str = SECRET, age: float = 0):
+    """Stand-in for Twitch, posts a signed sample payload"""
+    with open(f'samples/{sample}', 'rb') as fr:
+        body = fr.read()
+    message_id = message_id or uuid.uuid4().hex
+    timestamp = (datetime.now(timezone.utc) - timedelta(seconds=age)).isoformat().replace('+00:00', 'Z')
+    headers = {
+        HEADER_ID: message_id,
+        HEADER_TIMESTAMP: timestamp,
+        HEADER_SIGNATURE: sign(secret, message_id, timestamp, body),
+        HEADER_TYPE: msg_type,
+        'Content-Type': 'application/json',
+    }
+    async with sess.post(url, data=body, headers=headers) as resp:
+        return resp.status, await resp.text()
+
+
+def test_receiver():
+    async def _run():
+        events = []
+
+        async def on_event(sub_type, event):
+            events.append((sub_type, event))
+        address = f'127.0.0.1:{free_port()}'
+        receiver = EventSubReceiver(SECRET, on_event, listen_address=address)
+        await receiver.start()
+        url = f'http://{address}/eventsub'
+        try:
+            async with ClientSession() as sess:
+                assert await post_sample(sess, url, 'eventsub_verification.json', 'webhook_callback_verification') == \
+                       (200, 'pogchamp-kappa-360noscope-vohiyo')
+                assert (await post_sample(sess, url, 'eventsub_stream_online.json', message_id='a'))[0] == 204
+                # Retried delivery
+                assert (await post_sample(sess, url, 'eventsub_stream_online.json', message_id='a'))[0] == 204
+                assert (await post_sample(sess, url, 'eventsub_stream_offline.json'))[0] == 204
+                assert (await post_sample(sess, url, 'eventsub_stream_online.json', secret='wrong'))[0] == 403
+                assert (await post_sample(sess, url, 'eventsub_stream_online.json', age=3600))[0] == 403
+                assert (await post_sample(sess, url, 'eventsub_stream_online.json', age=-3600))[0] == 403
+                await asyncio.sleep(0.1)
+        finally:
+            await receiver.close()
+        return events
+    events = asyncio.run(_run())
+    assert [t for t, _ in events] == ['stream.online', 'stream.offline']
+    assert events[0][1]['broadcaster_user_login'] == 'esl_csgo'
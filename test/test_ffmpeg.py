@@ -3,6 +3,7 @@ import logging
 import unittest
 from typing import Iterable
 
+from modules.encoder import Progress
 from utils import watch_ffmpeg
 
 
@@ -62,6 +63,39 @@ speed=1.69x
 progress=continue"""
         await watch_ffmpeg(self.logger, to_async_stream(ffmpeg_output.split('\n')), print_every=0)
 
+    def test_watch_progress(self):
+        asyncio.run(self.async_test_watch_progress())
+
+    async def async_test_watch_progress(self):
+        ffmpeg_output = """frame=61
+fps=36.08
+total_size=3050
+out_time=00:00:02.838000
+speed=N/A
+progress=continue
+frame=1200
+fps=42.00
+total_size=30500000
+out_time=00:01:00.000000
+speed=1.69x
+progress=end"""
+        samples = []
+        progress = Progress('test', duration=120)
+        q = progress.subscribe()
+
+        def on_progress(sample: dict):
+            samples.append(sample)
+            progress.update(sample)
+
+        await watch_ffmpeg(self.logger, to_async_stream(ffmpeg_output.split('\n')), progress=on_progress)
+        self.assertEqual(2, len(samples))
+        self.assertNotIn('speed', samples[0])
+        self.assertEqual('end', samples[1]['progress'])
+        self.assertEqual(3, q.qsize())
+        self.assertEqual(1200, progress.frame)
+        self.assertEqual(1.69, progress.speed)
+        self.assertEqual(50.0, progress.percent)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,155 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from modules.encoder import Encoder, Ingester
+
+
+def touch(path, data=b'x', age=0):
+    with open(path, 'ab') as fw:
+        fw.write(data)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def make_ingester(tmp_path, claimed=(), **kwargs) -> Ingester:
+    async def on_ready(_):
+        pass
+    return Ingester(None, str(tmp_path), on_ready, lambda n: n in claimed, **kwargs)
+
+
+def test_job_from_file(tmp_path):
+    enc = SimpleNamespace(time_format='%y%m%d-%H%M', src_path=str(tmp_path))
+    job = Encoder.job_from_file(enc, '200101-1200_user_Some_Title_Here.flv')
+    assert job.input == '200101-1200_user_Some_Title_Here.flv'
+    assert job.user == 'user'
+    assert job.title == 'Some Title Here'
+    assert job.created_at == datetime(2020, 1, 1, 12)
+    job = Encoder.job_from_file(enc, '200101-1200_user_Title.1.flv')
+    assert job.title == 'Title'
+    job = Encoder.job_from_file(enc, '200101-1200_user_Title.part003.flv')
+    assert job.title == 'Title'
+
+
+def test_job_from_file_mtime(tmp_path):
+    touch(tmp_path / 'rec.flv', age=3600)
+    enc = SimpleNamespace(time_format='%y%m%d-%H%M', src_path=str(tmp_path))
+    job = Encoder.job_from_file(enc, 'rec.flv')
+    assert job.title == 'rec'
+    assert abs((datetime.now() - job.created_at).total_seconds() - 3600) < 5
+
+
+def test_scan_skips_claimed(tmp_path):
+    for name in ('a.flv', 'b.flv', 'c.mp4'):
+        touch(tmp_path / name)
+    ing = make_ingester(tmp_path, claimed={'b.flv'})
+    ing.scan()
+    assert list(ing.candidates) == ['a.flv']
+
+
+def test_ready_after_settle(tmp_path):
+    touch(tmp_path / 'old.flv', age=600)
+    touch(tmp_path / 'new.flv')
+    ing = make_ingester(tmp_path, settle=60)
+    ing.scan()
+    # First check only records sizes
+    assert ing.ready() == []
+    assert ing.ready() == ['old.flv']
+    assert list(ing.candidates) == ['new.flv']
+
+
+def test_growing_file(tmp_path):
+    touch(tmp_path / 'a.flv', age=600)
+    ing = make_ingester(tmp_path, settle=0)
+    ing.scan()
+    ing.ready()
+    touch(tmp_path / 'a.flv', age=600)
+    assert ing.ready() == []
+    assert ing.ready() == ['a.flv']
+
+
+def test_deleted_and_claimed(tmp_path):
+    claimed = set()
+    touch(tmp_path / 'a.flv')
+    touch(tmp_path / 'b.flv')
+    ing = make_ingester(tmp_path, claimed=claimed, settle=0)
+    ing.scan()
+    os.unlink(tmp_path / 'a.flv')
+    claimed.add('b.flv')
+    assert ing.ready() == []
+    assert not ing.candidates
+
+
+def test_watch(tmp_path):
+    async def _run():
+        batches = []
+
+        async def on_ready(names):
+            batches.append(names)
+        touch(tmp_path / 'backlog.flv', age=600)
+        ing = Ingester(asyncio.get_running_loop(), str(tmp_path), on_ready, lambda _: False, settle=0, poll_interval=0.1)
+        ing.start()
+        await asyncio.sleep(0.2)
+        touch(tmp_path / 'new.flv', age=600)
+        await asyncio.sleep(2.5)
+        await ing.close()
+        return batches
+    batches = asyncio.run(_run())
+    assert [n for b in batches for n in b] == ['backlog.flv', 'new.flv']
+
+
+def test_raw_copy_is_claimed():
+    from modules.encoder import Job
+    job = Job(input='rec.mp4', title='t', user='u', remuxed=True, raw_copy='rec.flv')
+    enc = SimpleNamespace(store=SimpleNamespace(jobs={job.id: job}))
+    assert Encoder.is_claimed(enc, 'rec.flv')
+    assert not Encoder.is_claimed(enc, 'other.flv')
+
+
+def test_restarted_recording(tmp_path):
+    """A recording is not ingested while streamlink writes its next piece, its pieces are joined to it"""
+    touch(tmp_path / 'rec.flv', age=600)
+    touch(tmp_path / 'rec.piece1.flv')
+    ing = make_ingester(tmp_path, settle=60)
+    ing.scan()
+    assert list(ing.candidates) == ['rec.flv']
+    ing.ready()
+    touch(tmp_path / 'rec.piece1.flv')
+    assert ing.ready() == []
+    # Restarted again, the first pieces stopped changing long ago
+    touch(tmp_path / 'rec.piece1.flv', age=600)
+    touch(tmp_path / 'rec.piece2.flv', data=b'')
+    assert ing.ready() == []
+    assert ing.ready() == []
+    # The stream ended, nothing changed for settle seconds
+    for name in ('rec.flv', 'rec.piece1.flv', 'rec.piece2.flv'):
+        touch(tmp_path / name, data=b'', age=600)
+    ing.ready()
+    assert ing.ready() == ['rec.flv']
+    enc = SimpleNamespace(time_format='%y%m%d-%H%M', src_path=str(tmp_path))
+    # The last piece got no data
+    assert Encoder.job_from_file(enc, 'rec.flv').pieces == ['rec.piece1.flv']
+    assert Encoder.job_from_file(enc, 'rec.piece1.flv').pieces is None
+
+
+def test_ingest_pieces(tmp_path):
+    from test.test_broadcast import make_encoder
+
+    async def _run():
+        enc = make_encoder(tmp_path)
+        name = '200101-1200_user_Some_Hevc.flv'
+        for n in (name, '200101-1200_user_Some_Hevc.piece1.flv'):
+            touch(tmp_path / 'src' / n, age=600)
+        enc.ingester = Ingester(asyncio.get_running_loop(), enc.src_path, enc.ingest_files, enc.is_claimed, settle=0)
+        enc.ingester.start()
+        await asyncio.sleep(1.5)
+        jobs = list(enc.store.jobs.values())
+        claimed = enc.is_claimed('200101-1200_user_Some_Hevc.piece1.flv')
+        await enc.close()
+        return jobs, claimed
+    jobs, claimed = asyncio.run(_run())
+    assert [(j.input, j.pieces) for j in jobs] == [('200101-1200_user_Some_Hevc.flv',
+                                                    ['200101-1200_user_Some_Hevc.piece1.flv'])]
+    assert claimed
@@ -0,0 +1,70 @@
+from datetime import datetime, timezone
+
+from modules.encoder import Job, JobIndex
+
+
+def make_jobs():
+    return [
+        Job(input='1.flv', title='One', user='UserA', enc_codec='copy', created_at='2020-01-01T12:00:00',
+            enc_start='2020-01-01T13:00:00', enc_end='2020-01-01T13:10:00', deleted=True),
+        Job(input='2.flv', title='Two', user='UserB', enc_codec='hevc', created_at='2020-01-02T12:00:00',
+            enc_start='2020-01-02T13:00:00'),
+        Job(input='3.flv', title='Three', user='usera', ignored=True, created_at='2020-01-03T12:00:00+00:00'),
+        Job(input='4.flv', title='Four', user='UserA', enc_codec='hevc', created_at='2020-01-04T12:00:00',
+            error='ffmpeg exit code: 1', ignored=True, deleted=False),
+        Job(input='5.flv', title='Five', user='UserB', enc_codec='copy', queued_at='2020-01-05T12:00:00'),
+    ]
+
+
+def titles(jobs):
+    return [j.title for j in jobs]
+
+
+def test_filters():
+    index = JobIndex()
+    index.rebuild(make_jobs())
+    assert titles(index.query(user='usera')[0]) == ['One', 'Three', 'Four']
+    assert titles(index.query(codec='hevc')[0]) == ['Two', 'Four']
+    assert titles(index.query(status=['running'])[0]) == ['Two']
+    assert titles(index.query(status=['error', 'ignored'])[0]) == ['Three', 'Four']
+    assert titles(index.query(status=['queued'])[0]) == ['Five']
+    assert titles(index.query(user='UserA', codec='hevc', status=['error'])[0]) == ['Four']
+    assert titles(index.query(since=datetime(2020, 1, 2), until=datetime(2020, 1, 4))[0]) == ['Two', 'Three']
+    aware = datetime(2020, 1, 2, tzinfo=timezone.utc)
+    assert titles(index.query(since=aware, codec='copy')[0]) == []
+
+
+def test_update():
+    jobs = make_jobs()
+    index = JobIndex()
+    index.rebuild(jobs)
+    version = index.version
+    running = jobs[1]
+    running.enc_end = datetime(2020, 1, 2, 14)
+    running.deleted = True
+    index.update(running)
+    assert index.version > version
+    assert titles(index.query(status=['running'])[0]) == []
+    assert titles(index.query(status=['done'])[0]) == ['One', 'Two']
+    index.update(Job(input='6.flv', title='Six', user='UserC'))
+    assert titles(index.query(user='userc')[0]) == ['Six']
+
+
+def test_pagination():
+    index = JobIndex()
+    index.rebuild(make_jobs())
+    seen = []
+    cursor = None
+    while True:
+        jobs, cursor, total = index.query(limit=2, cursor=cursor)
+        assert total == 5
+        seen.extend(titles(jobs))
+        if cursor is None:
+            break
+    assert seen == ['One', 'Two', 'Three', 'Four', 'Five']
+    jobs, cursor, _ = index.query(limit=2, desc=True)
+    assert titles(jobs) == ['Five', 'Four']
+    jobs, cursor, _ = index.query(limit=2, desc=True, cursor=cursor)
+    assert titles(jobs) == ['Three', 'Two']
+    jobs, cursor, _ = index.query(limit=0)
+    assert jobs == [] and cursor is None
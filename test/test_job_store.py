@@ -0,0 +1,71 @@
+import asyncio
+import json
+import os
+
+from modules.encoder import Job, JobStore
+
+OLD_JOBS = [
+    {
+        "src": "/tank/downloads/twitch/200917-2259_user_Stream_One.flv",
+        "file_name": "200917-2259_Stream One",
+        "user": "User",
+        "enc_cmd": "-i in.flv out.mp4",
+        "ignore": False,
+    },
+    {
+        "input": "200918-2259_user_Stream_Two.flv",
+        "title": "Stream Two",
+        "user": "User",
+    },
+]
+
+
+def test_migrate_and_replay(tmp_path):
+    jobs_file = str(tmp_path / 'jobs.json')
+    with open(jobs_file, 'w') as fw:
+        json.dump(OLD_JOBS, fw)
+
+    async def _run():
+        loop = asyncio.get_running_loop()
+        store = JobStore(loop, jobs_file)
+        jobs = store.load()
+        assert [j.input for j in jobs] == ['200917-2259_user_Stream_One.flv', '200918-2259_user_Stream_Two.flv']
+        assert jobs[0].title == 'Stream One'
+        assert jobs[0].ffmpeg_args == '-i in.flv out.mp4'
+        # IDs were written to the snapshot during migration
+        with open(jobs_file) as fr:
+            assert [d['id'] for d in json.load(fr)] == [j.id for j in jobs]
+        jobs[1].error = 'failed'
+        store.save(jobs[1])
+        store.save(Job(input='new.flv', title='New', user='User'))
+        # Simulate crash without compaction, last line is incomplete
+        store._journal.write('{"input": "torn')
+        store._journal.close()
+        store._journal = None
+
+        store = JobStore(loop, jobs_file)
+        jobs = store.load()
+        assert [j.input for j in jobs] == ['200917-2259_user_Stream_One.flv', '200918-2259_user_Stream_Two.flv', 'new.flv']
+        assert jobs[1].error == 'failed'
+        await store.close()
+        assert os.path.getsize(store.journal_path) == 0
+        with open(jobs_file) as fr:
+            assert len(json.load(fr)) == 3
+
+    asyncio.run(_run())
+
+
+def test_compact_every(tmp_path):
+    jobs_file = str(tmp_path / 'jobs.json')
+
+    async def _run():
+        store = JobStore(asyncio.get_running_loop(), jobs_file, compact_every=5)
+        store.load()
+        for i in range(12):
+            store.save(Job(input=f'{i}.flv', title=str(i), user='User'))
+            await asyncio.sleep(0.01)
+        await store.close()
+        store.load()
+        return len(store.jobs)
+
+    assert asyncio.run(_run()) == 12
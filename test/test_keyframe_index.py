@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import random
+from datetime import timedelta
+
+from modules.keyframe_index import (CONFIG_TS, KeyframeIndex, KeyframeIndexer, build_index, probe_duration,
+                                    sidecar_path)
+from modules.recorder import Channel, Recorder
+
+
+def flv_tag(tag_type: int, ts: int, data: bytes) -> bytes:
+    header = bytes([tag_type]) + len(data).to_bytes(3, 'big') + (ts & 0xffffff).to_bytes(3, 'big') + bytes([ts >> 24])
+    return header + b'\x00\x00\x00' + data + (11 + len(data)).to_bytes(4, 'big')
+
+
+def make_flv(gops: int = 5, gop_ms: int = 2000, frame_ms: int = 500) -> bytes:
+    ret = b'FLV\x01\x05\x00\x00\x00\x09' + b'\x00' * 4
+    ret += flv_tag(18, 0, b'\x02\x00\x0aonMetaData')
+    ret += flv_tag(9, 0, b'\x17\x00\x00\x00\x00config')
+    ret += flv_tag(8, 0, b'\xaf\x00\x12\x10')
+    for ts in range(0, gops * gop_ms, frame_ms):
+        key = ts % gop_ms == 0
+        ret += flv_tag(9, ts, (b'\x17' if key else b'\x27') + b'\x01\x00\x00\x00' + b'v' * random.randint(10, 3000))
+        ret += flv_tag(8, ts, b'\xaf\x01' + b'a' * 50)
+    return ret
+
+
+def ts_packet(pid: int, payload: bytes, start: bool = False, random_access: bool = False) -> bytes:
+    header = bytes([0x47, (0x40 if start else 0) | pid >> 8, pid & 0xff])
+    if random_access:
+        adaptation = bytes([0x40]) + b'\xff' * (182 - len(payload))
+        return header + b'\x30' + bytes([len(adaptation)]) + adaptation + payload
+    return header + b'\x10' + payload + b'\xff' * (184 - len(payload))
+
+
+def psi(table_id: int, body: bytes) -> bytes:
+    # Pointer field, table ID, section length (with a fake CRC)
+    return b'\x00' + bytes([table_id]) + (0xb000 | len(body) + 5 + 4).to_bytes(2, 'big') + b'\x00\x01\xc1\x00\x00' + \
+        body + b'\x00' * 4
+
+
+def make_ts(keyframes: int = 4, first_pts: int = 90000) -> bytes:
+    ret = ts_packet(0, psi(0, b'\x00\x01\xf0\x00'), start=True)
+    ret += ts_packet(0x1000, psi(2, b'\xe1\x00\xf0\x00' + b'\x1b\xe1\x00\xf0\x00' + b'\x0f\xe1\x01\xf0\x00'), start=True)
+    for i in range(keyframes * 2):
+        pts = (first_pts + i * 45000) % (1 << 33)
+        p = (pts >> 30) << 1 | 0x21, (pts >> 22) & 0xff, ((pts >> 15) & 0x7f) << 1 | 1, (pts >> 7) & 0xff, (pts & 0x7f) << 1 | 1
+        pes = b'\x00\x00\x01\xe0\x00\x00\x80\x80\x05' + bytes(p)
+        ret += ts_packet(0x100, pes, start=True, random_access=i % 2 == 0)
+        ret += ts_packet(0x100, b'v' * 100)
+        ret += ts_packet(0x101, b'\x00\x00\x01\xc0', start=True)
+    return ret
+
+
+def feed_chunks(fp: str, data: bytes) -> KeyframeIndexer:
+    indexer = KeyframeIndexer(sidecar_path(fp))
+    pos = 0
+    while pos < len(data):
+        n = random.randint(1, 4096)
+        indexer.feed(data[pos:pos + n])
+        pos += n
+    indexer.close()
+    return indexer
+
+
+def test_flv(tmp_path):
+    fp = str(tmp_path / 'rec.flv')
+    data = make_flv()
+    with open(fp, 'wb') as fw:
+        fw.write(data)
+    indexer = feed_chunks(fp, data)
+    assert indexer.fmt == 'flv' and indexer.count == 7
+    chunked = open(sidecar_path(fp), 'rb').read()
+    assert build_index(fp) == 7 and open(sidecar_path(fp), 'rb').read() == chunked
+    index = KeyframeIndex.load(fp)
+    assert index.times.tolist() == [0, 2000, 4000, 6000, 8000]
+    assert index.records['ts'][:2].tolist() == [CONFIG_TS, CONFIG_TS]
+    assert index.last_seconds == 8
+    for offset in index.offsets:
+        assert data[offset] == 9 and data[offset + 11] == 0x17
+    assert index.keyframe_at(5.9) == (4, int(index.offsets[2]))
+    assert index.keyframe_at(0) == (0, int(index.offsets[0]))
+    snippet = index.snippet(3)
+    config = [data[o:o + 11 + int.from_bytes(data[o + 1:o + 4], 'big') + 4] for o in index.config_offsets]
+    assert snippet == data[:13] + b''.join(config) + data[index.offsets[1]:index.offsets[2]]
+
+
+def test_ts(tmp_path):
+    fp = str(tmp_path / 'rec.flv')
+    data = make_ts()
+    with open(fp, 'wb') as fw:
+        fw.write(data)
+    indexer = feed_chunks(fp, data)
+    assert indexer.fmt == 'ts' and indexer.video_pid == 0x100
+    index = KeyframeIndex.load(fp)
+    assert index.times.tolist() == [0, 1000, 2000, 3000]
+    assert index.config_offsets.tolist() == [0, 188]
+    assert all(o % 188 == 0 for o in index.offsets)
+    assert index.snippet(1.5) == data[:376] + data[index.offsets[1]:index.offsets[2]]
+    # PTS wrap around after the second keyframe
+    data = make_ts(first_pts=(1 << 33) - 100000)
+    with open(fp, 'wb') as fw:
+        fw.write(data)
+    build_index(fp)
+    assert KeyframeIndex.load(fp).times.tolist() == [0, 1000, 2000, 3000]
+
+
+def test_not_indexed(tmp_path):
+    fp = str(tmp_path / 'rec.mp4')
+    with open(fp, 'wb') as fw:
+        fw.write(b'\x00\x00\x00\x20ftypisom' + b'\x00' * 1000)
+    assert build_index(fp) == 0
+    assert KeyframeIndex.load(fp) is None
+    # Index of an older, longer recording of the same name
+    fp = str(tmp_path / 'rec.flv')
+    with open(fp, 'wb') as fw:
+        fw.write(make_flv())
+    build_index(fp)
+    with open(fp, 'wb') as fw:
+        fw.write(b'FLV')
+    assert KeyframeIndex.load(fp) is None
+
+
+def test_probe_duration(tmp_path, monkeypatch):
+    fp = str(tmp_path / 'rec.flv')
+    with open(fp, 'wb') as fw:
+        fw.write(make_flv())
+
+    async def no_duration(*_args, **_kwargs):
+        return None
+    monkeypatch.setattr('modules.keyframe_index.read_video_info', no_duration)
+    assert asyncio.run(probe_duration(fp)) is None
+    build_index(fp)
+    assert asyncio.run(probe_duration(fp)) == timedelta(seconds=8)
+
+
+def test_index_file(tmp_path):
+    """The recorder indexes a file while streamlink writes it"""
+    fp = str(tmp_path / 'rec.flv')
+    data = make_flv()
+
+    async def _run():
+        rec = Recorder.__new__(Recorder)
+        rec.loop = asyncio.get_running_loop()
+        rec.stall_interval = 0.05
+        p = await asyncio.create_subprocess_exec('sleep', '0.5')
+        task = asyncio.get_running_loop().create_task(rec.index_file(None, p, fp))
+        with open(fp, 'wb') as fw:
+            for i in range(0, len(data), 1000):
+                fw.write(data[i:i + 1000])
+                fw.flush()
+                await asyncio.sleep(0.01)
+        await p.wait()
+        await task
+    asyncio.run(_run())
+    assert KeyframeIndex.load(fp).times.tolist() == [0, 2000, 4000, 6000, 8000]
+
+
+def test_pump(tmp_path):
+    """The raw copy of a remux is written and indexed in batches"""
+    fp = str(tmp_path / 'rec.flv')
+    data = make_flv()
+
+    async def _run():
+        src = asyncio.StreamReader()
+        src.feed_data(data)
+        src.feed_eof()
+        await Recorder.pump(Channel('a', logging.getLogger('test')), src, None, fp, chunk_size=1000, write_size=4096)
+    asyncio.run(_run())
+    assert open(fp, 'rb').read() == data
+    assert KeyframeIndex.load(fp).times.tolist() == [0, 2000, 4000, 6000, 8000]
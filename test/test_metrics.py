@@ -0,0 +1,48 @@
+import pytest
+
+from modules.encoder.metrics import Counter, EncoderMetrics, Gauge, Histogram
+
+
+def test_counter_gauge():
+    c = Counter('jobs_total', 'Jobs', ('codec', 'outcome'))
+    c.inc(codec='hevc', outcome='done')
+    c.inc(2, codec='hevc', outcome='done')
+    c.inc(codec=None, outcome='ignored')
+    with pytest.raises(ValueError):
+        c.inc(codec='hevc')
+    with pytest.raises(ValueError):
+        c.inc(-1, codec='hevc', outcome='done')
+    assert c.render() == [
+        '# HELP jobs_total Jobs',
+        '# TYPE jobs_total counter',
+        'jobs_total{codec="hevc",outcome="done"} 3',
+        'jobs_total{codec="none",outcome="ignored"} 1',
+    ]
+    g = Gauge('depth', 'Depth', ('codec',))
+    g.set(4, codec='a"b')
+    assert g.samples() == ['depth{codec="a\\"b"} 4']
+
+
+def test_histogram():
+    h = Histogram('latency_seconds', 'Latency', buckets=(0.5, 1))
+    for v in (0.1, 0.7, 3):
+        h.observe(v)
+    with h.time():
+        pass
+    samples = h.samples()
+    assert samples[:3] == [
+        'latency_seconds_bucket{le="0.5"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+    ]
+    assert samples[3].startswith('latency_seconds_sum 3.8')
+    assert samples[4] == 'latency_seconds_count 4'
+
+
+def test_render():
+    m = EncoderMetrics()
+    m.stage_seconds.observe(0.2, stage='probe')
+    text = m.render()
+    assert text.endswith('\n')
+    assert '# TYPE encoder_stage_seconds histogram' in text
+    assert 'encoder_stage_seconds_count{stage="probe"} 1' in text
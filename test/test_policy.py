@@ -0,0 +1,48 @@
+from modules.encoder import Job, PresetPolicy
+
+
+def test_no_measurements():
+    policy = PresetPolicy(target_latency=3600)
+    assert policy.choose(backlog=10 * 3600) == ('fast', 'no encode speed measured yet')
+
+
+def test_choose():
+    policy = PresetPolicy(target_latency=6 * 3600)
+    policy.observe('fast', 1.8)
+    # Extrapolated from fast: medium 1.0x, slow 0.45x
+    assert round(policy.speed('medium'), 2) == 1.0
+    # Empty queue, slowest allowed preset
+    assert policy.choose(backlog=3600)[0] == 'slow'
+    assert policy.choose(backlog=5 * 3600)[0] == 'medium'
+    # Two slots drain twice as fast
+    assert policy.choose(backlog=5 * 3600, parallel=2)[0] == 'slow'
+    preset, reason = policy.choose(backlog=50 * 3600)
+    assert preset == 'veryfast'
+    assert 'fastest' in reason
+
+
+def test_observe_ewma():
+    policy = PresetPolicy(target_latency=3600, alpha=0.5)
+    policy.observe('fast', 2.0)
+    policy.observe('fast', 1.0)
+    policy.observe('nope', 1.0)
+    policy.observe('fast', 0)
+    assert policy.speeds == dict(fast=1.5)
+
+
+def test_load_history():
+    jobs = [
+        Job(input='1.flv', title='1', user='u', enc_codec='hevc', duration=3600, preset='medium',
+            enc_start='2020-01-01T10:00:00', enc_end='2020-01-01T11:00:00'),
+        # Older job, preset from the ffmpeg command
+        Job(input='2.flv', title='2', user='u', enc_codec='hevc', duration=1800,
+            ffmpeg_args='-i 2.flv -c:v libx265 -preset:v fast out.mkv',
+            enc_start='2020-01-01T08:00:00', enc_end='2020-01-01T08:15:00'),
+        Job(input='3.flv', title='3', user='u', enc_codec='hevc', duration=1800, preset='slow', error='failed',
+            enc_start='2020-01-01T08:00:00', enc_end='2020-01-01T08:15:00'),
+        Job(input='4.flv', title='4', user='u', enc_codec='copy', duration=1800,
+            enc_start='2020-01-01T08:00:00', enc_end='2020-01-01T08:01:00'),
+    ]
+    policy = PresetPolicy(target_latency=3600)
+    policy.load_history(jobs)
+    assert policy.speeds == dict(medium=1.0, fast=2.0)
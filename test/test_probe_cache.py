@@ -0,0 +1,116 @@
+import asyncio
+import json
+import os
+import shutil
+from datetime import timedelta
+
+import pytest
+
+from utils import ProbeCache, parse_duration, read_video_info
+
+
+def test_parse_duration():
+    assert parse_duration('0:00:20.042000') == timedelta(seconds=20, milliseconds=42)
+    assert parse_duration('01:02:03.5') == timedelta(hours=1, minutes=2, seconds=3, milliseconds=500)
+    assert parse_duration('nope') is None
+
+
+def test_cached(tmp_path):
+    calls = []
+
+    async def fake_probe(vid_fp, logger=None):
+        calls.append(vid_fp)
+        await asyncio.sleep(0.01)
+        return dict(format={}, streams=[], duration=12.5, codec='h264', keyframes=None)
+
+    vid_fp = str(tmp_path / 'a.flv')
+    with open(vid_fp, 'wb') as fw:
+        fw.write(b'abc')
+    store_path = str(tmp_path / 'probe_cache.json')
+    cache = ProbeCache(max_size=1, store_path=store_path)
+    cache._run_probe = fake_probe
+
+    async def main():
+        # Concurrent probes share one run
+        infos = await asyncio.gather(*(cache.probe(vid_fp) for _ in range(3)))
+        assert all(i['duration'] == 12.5 for i in infos)
+        assert len(calls) == 1
+        assert await read_video_info(vid_fp, cache=cache) == timedelta(seconds=12.5)
+        assert len(calls) == 1
+        # Modified file is probed again
+        with open(vid_fp, 'ab') as fw:
+            fw.write(b'def')
+        await cache.probe(vid_fp)
+        assert len(calls) == 2
+        await cache.close()
+
+    asyncio.run(main())
+    with open(store_path) as fr:
+        assert list(json.load(fr).keys()) == [cache.cache_key(vid_fp)]
+    reloaded = ProbeCache(store_path=store_path)
+    assert asyncio.run(reloaded.probe(vid_fp))['duration'] == 12.5
+
+
+def test_save_delay(tmp_path):
+    """Probes close together are written once, in the background"""
+    async def fake_probe(vid_fp, logger=None):
+        return dict(format={}, streams=[], duration=1.0, codec='h264', keyframes=None)
+
+    store_path = str(tmp_path / 'probe_cache.json')
+    cache = ProbeCache(store_path=store_path, save_delay=0.05)
+    cache._run_probe = fake_probe
+    writes = []
+    write = cache._write
+
+    def counted_write(data):
+        writes.append(len(data))
+        write(data)
+    cache._write = counted_write
+
+    async def main():
+        for i in range(5):
+            (tmp_path / f'{i}.flv').write_bytes(b'x')
+            await cache.probe(str(tmp_path / f'{i}.flv'))
+        assert not writes and not os.path.exists(store_path)
+        await asyncio.sleep(0.1)
+        assert writes == [5]
+        (tmp_path / 'last.flv').write_bytes(b'x')
+        await cache.probe(str(tmp_path / 'last.flv'))
+        await cache.close()
+        assert writes == [5, 6]
+
+    asyncio.run(main())
+    assert len(ProbeCache(store_path=store_path)._cache) == 6
+
+
+def test_save_after_close(tmp_path):
+    """Made outside of a loop like probe_cache, a flush by close does not skip the delay of later saves"""
+    async def fake_probe(vid_fp, logger=None):
+        return dict(format={}, streams=[], duration=1.0, codec='h264', keyframes=None)
+
+    store_path = str(tmp_path / 'probe_cache.json')
+    cache = ProbeCache(store_path=store_path, save_delay=0.2)
+    cache._run_probe = fake_probe
+
+    async def main(name: str):
+        (tmp_path / name).write_bytes(b'x')
+        await cache.probe(str(tmp_path / name))
+        await asyncio.sleep(0.05)
+        saved = os.path.exists(store_path) and len(ProbeCache(store_path=store_path)._cache)
+        await cache.close()
+        return saved
+
+    assert asyncio.run(main('a.flv')) is False
+    # Another loop, the previous close has no effect
+    assert asyncio.run(main('b.flv')) == 1
+    assert len(ProbeCache(store_path=store_path)._cache) == 2
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg not installed')
+def test_probe_flv(tmp_path):
+    vid_fp = str(tmp_path / 'test.flv')
+    os.system(f'ffmpeg -v quiet -f lavfi -i testsrc=duration=3:size=160x120:rate=10 -g 10 -y {vid_fp}')
+    info = asyncio.run(ProbeCache().probe(vid_fp, keyframes=True))
+    assert info['codec'] == 'flv1'
+    assert abs(info['duration'] - 3) < 0.2
+    assert info['keyframes'] == 3
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import os
+import time
+
+from modules.keyframe_index import sidecar_path
+from modules.recorder import Channel, PollSchedule, Recorder, StreamData, UserData
+from test.test_keyframe_index import make_flv
+
+
+def make_recorder(logins) -> Recorder:
+    rec = Recorder.__new__(Recorder)
+    rec.loop = asyncio.get_running_loop()
+    rec.logger = logging.getLogger('test')
+    rec.check_en = asyncio.Event()
+    rec.notifier = None
+    rec.eventsub = None
+    rec.time_format = '%y%m%d-%H%M'
+    rec.timeout = 120
+    rec.schedule = PollSchedule(timeout=120, jitter=0)
+    rec.stall_seconds = 30
+    rec.stall_rate = 1024
+    rec.max_restarts = 10
+    rec.channels = {}
+    for i, login in enumerate(logins):
+        c = Channel(login, rec.logger)
+        c.user = UserData(name=login, id=str(i))
+        rec.channels[login] = c
+    return rec
+
+
+def test_parse_logins():
+    assert Recorder.parse_logins('a, B,,c') == ['a', 'b', 'c']
+    assert Recorder.parse_logins(['a,b', 'A', 'd']) == ['a', 'b', 'd']
+
+
+def test_check_if_live():
+    async def _run():
+        rec = make_recorder(['off', 'live', 'hosting'])
+        calls = []
+        recorded = asyncio.Event()
+
+        async def get_streams(ids):
+            calls.append(ids)
+            return {i: StreamData(type_='live', title='Title', user_id=i) for i in ('1', '2')}
+
+        async def get_hosting_targets(ids):
+            calls.append(ids)
+            return {'2': 'other'}
+
+        async def record(c):
+            recorded.set()
+        rec.get_streams = get_streams
+        rec.get_hosting_targets = get_hosting_targets
+        rec.record = record
+        await rec.check_if_live()
+        # All channels in one request
+        assert calls == [['0', '1', '2'], ['1', '2']]
+        await recorded.wait()
+        assert rec.channels['live'].stream.title == 'Title'
+        now = time.monotonic()
+        assert 100 < rec.channels['off'].next_check - now <= 120
+        assert 100 < rec.channels['hosting'].next_check - now <= 120
+        # Nothing due, check_en wakes it up
+        rec.channels['off'].next_check = 0
+        rec.check_en.set()
+        await asyncio.wait_for(rec.check_if_live(), 1)
+        assert calls[-2:] == [['0', '1'], ['1']]
+    asyncio.run(_run())
+
+
+def test_handle_event():
+    async def _run():
+        rec = make_recorder(['a', 'b'])
+        rec.eventsub = object()
+        rec.safety_timeout = 900
+        started = []
+
+        async def get_streams(ids):
+            # API did not catch up yet
+            return {}
+
+        async def record(c):
+            started.append(c.stream)
+            await asyncio.sleep(0.1)
+        rec.get_streams = get_streams
+        rec.record = record
+        event = dict(broadcaster_user_id='1', broadcaster_user_login='b', type='live', started_at='2020-06-25T12:04:50Z')
+        await rec.handle_event('stream.online', event)
+        await rec.handle_event('stream.online', event)
+        await rec.handle_event('stream.online', dict(event, broadcaster_user_id='9'))
+        await asyncio.sleep(0)
+        assert len(started) == 1
+        assert started[0].title == 'UNKNOWN' and started[0].url == 'https://www.twitch.tv/b'
+        assert rec.next_delay(rec.channels['a']) == 900
+        assert list(rec.schedule.history) == ['b']
+    asyncio.run(_run())
+
+
+class BrokenWriter:
+    def __init__(self, fail_after: int):
+        self.data = b''
+        self.fail_after = fail_after
+        self.closed = False
+
+    def write(self, chunk):
+        if len(self.data) >= self.fail_after:
+            raise BrokenPipeError()
+        self.data += chunk
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_pump(tmp_path):
+    async def _run():
+        src = asyncio.StreamReader()
+        src.feed_data(b'a' * 100 + b'b' * 100)
+        src.feed_eof()
+        dst = BrokenWriter(fail_after=100)
+        raw_fp = str(tmp_path / 'raw.flv')
+        await Recorder.pump(Channel('a', logging.getLogger('test')), src, dst, raw_fp, chunk_size=100)
+        return dst
+    dst = asyncio.run(_run())
+    # Raw copy continues after ffmpeg is gone
+    assert dst.data == b'a' * 100 and not dst.closed
+    assert (tmp_path / 'raw.flv').read_bytes() == b'a' * 100 + b'b' * 100
+
+
+def test_record_remux(tmp_path):
+    async def _run(remux_ok, files):
+        rec = make_recorder(['a'])
+        rec.out_path = str(tmp_path)
+        rec.dry_run = False
+        rec.keep_raw = True
+        posted = []
+
+        async def run_pipe(c, args, raw_fp=None, on_line=None, size=None):
+            for ext in files:
+                (tmp_path / f'rec{ext}').write_bytes(b'x')
+            c.received = len(files)
+            c.ended_ok = True
+            return remux_ok
+
+        async def post_record(c, name, **kwargs):
+            posted.append((name, kwargs))
+        rec.run_pipe = run_pipe
+        rec.post_record = post_record
+        await rec.record_remux(rec.channels['a'], 'rec')
+        for f in tmp_path.iterdir():
+            f.unlink()
+        return posted
+    assert asyncio.run(_run(True, ('.mp4', '.flv'))) == [('rec.mp4', dict(remuxed=True, raw_copy='rec.flv'))]
+    assert asyncio.run(_run(False, ('.mp4', '.flv'))) == [('rec.flv', {})]
+    assert asyncio.run(_run(False, ('.mp4',))) == [('rec.mp4', {})]
+    assert asyncio.run(_run(False, ())) == []
+
+
+def test_record_remux_pieces(tmp_path):
+    async def _run(keep_raw):
+        rec = make_recorder(['a'])
+        rec.out_path = str(tmp_path)
+        rec.dry_run = False
+        rec.keep_raw = keep_raw
+        posted = []
+
+        async def run_pipe(c, args, raw_fp=None, on_line=None, size=None):
+            with open(args[-1], 'wb') as fw:
+                fw.write(b'x')
+            if raw_fp:
+                with open(raw_fp, 'wb') as fw:
+                    fw.write(b'x')
+            c.received = 1
+            # Stalls once
+            c.ended_ok = os.path.basename(args[-1]) != 'rec.mp4'
+            return True
+
+        async def post_record(c, name, **kwargs):
+            posted.append((name, kwargs))
+        rec.run_pipe = run_pipe
+        rec.post_record = post_record
+        await rec.record_remux(rec.channels['a'], 'rec')
+        files = sorted(f.name for f in tmp_path.iterdir())
+        for f in tmp_path.iterdir():
+            f.unlink()
+        return posted, files
+    # Raw copies are the input, the MP4 pieces are not needed
+    assert asyncio.run(_run(True)) == ([('rec.flv', dict(pieces=['rec.piece1.flv']))], ['rec.flv', 'rec.piece1.flv'])
+    assert asyncio.run(_run(False)) == ([('rec.mp4', dict(pieces=['rec.piece1.mp4'], remuxed=True))],
+                                        ['rec.mp4', 'rec.piece1.mp4'])
+
+
+def test_record_segmented(tmp_path):
+    """Parts are indexed before they are sent"""
+    async def _run():
+        rec = make_recorder(['a'])
+        rec.out_path = str(tmp_path)
+        rec.dry_run = False
+        rec.segment_seconds = 10
+        posted = []
+
+        async def run_pipe(c, args, raw_fp=None, on_line=None, size=None):
+            for i in range(2):
+                fp = args[-1] % i
+                with open(fp, 'wb') as fw:
+                    fw.write(make_flv())
+                await on_line(fp)
+            c.received = 1
+            c.ended_ok = True
+            return True
+
+        async def post_record(c, name, **kwargs):
+            posted.append((name, kwargs['part'], os.path.exists(sidecar_path(os.path.join(rec.out_path, name)))))
+
+        async def http_post_data(**_kwargs):
+            pass
+        rec.run_pipe = run_pipe
+        rec.post_record = post_record
+        rec.http_post_data = http_post_data
+        await rec.record_segmented(rec.channels['a'], 'rec')
+        return posted
+    assert asyncio.run(_run()) == [('rec.part000.flv', 0, True), ('rec.part001.flv', 1, True)]
+
+
+def test_supervise():
+    async def _run(outcomes, max_restarts=10):
+        rec = make_recorder(['a'])
+        rec.max_restarts = max_restarts
+        c = rec.channels['a']
+        started = []
+
+        async def start(piece):
+            started.append(piece)
+            received, how = outcomes[piece]
+            c.received = received
+            if how == 'ended':
+                c.ended_ok = True
+            elif how == 'stalled':
+                c.stalled = True
+            elif how == 'error':
+                raise Exception('streamlink failed')
+        await rec.supervise(c, start)
+        return started
+    assert asyncio.run(_run([(100, 'stalled'), (100, 'error'), (100, 'ended')])) == [0, 1, 2]
+    # Stream is gone, streamlink found nothing after the restart
+    assert asyncio.run(_run([(100, 'stalled'), (0, 'error')])) == [0, 1]
+    assert asyncio.run(_run([(100, 'stalled')] * 5, max_restarts=2)) == [0, 1, 2]
+
+
+def test_watch_stall():
+    async def _run(grows):
+        rec = make_recorder(['a'])
+        rec.stall_interval = 0.05
+        rec.stall_seconds = 0.2
+        c = rec.channels['a']
+        p = await asyncio.create_subprocess_exec('sleep', '1')
+        written = [0]
+
+        def size():
+            if grows:
+                written[0] += 1 << 20
+            return written[0]
+        start = time.monotonic()
+        await rec.watch_stall(c, p, size)
+        await p.wait()
+        return c.stalled, time.monotonic() - start, c.received
+    stalled, elapsed, received = asyncio.run(_run(False))
+    assert stalled and elapsed < 0.9 and received == 0
+    stalled, elapsed, received = asyncio.run(_run(True))
+    assert not stalled and elapsed >= 0.9 and received > 0
+
+
+def test_existing_numbers(tmp_path):
+    rec = Recorder.__new__(Recorder)
+    rec.out_path = str(tmp_path)
+    assert rec.existing_numbers('rec') == set()
+    for name in ('rec.part000.flv', 'rec.part001.flv', 'rec.part000.flv.kfi', 'rec.piece1.flv', 'record.flv'):
+        (tmp_path / name).write_bytes(b'x')
+    assert rec.existing_numbers('rec') == {''}
+    for name in ('rec.1.mp4', 'rec.1.piece1.mp4', 'rec.2.joined.flv'):
+        (tmp_path / name).write_bytes(b'x')
+    assert rec.existing_numbers('rec') == {'', '.1', '.2'}
@@ -0,0 +1,64 @@
+import json
+from datetime import datetime, timedelta
+
+from modules.recorder import PollSchedule
+from modules.recorder.schedule import DAY, WEEK
+
+
+def make_schedule(days=5, hour=20, **kwargs) -> PollSchedule:
+    schedule = PollSchedule(timeout=120, fast=30, max_timeout=1800, jitter=0, **kwargs)
+    start = datetime(2020, 6, 1, hour)
+    for i in range(days):
+        schedule.add_start('a', start + timedelta(days=i))
+    return schedule
+
+
+def test_not_enough_history():
+    schedule = make_schedule(days=2)
+    assert schedule.period('a') is None
+    assert schedule.delay('a') == 120
+    assert schedule.delay('unknown') == 120
+
+
+def test_daily_window():
+    schedule = make_schedule()
+    assert schedule.period('a') == DAY
+    # 30 minutes before to an hour after 20:00
+    assert schedule.delay('a', datetime(2020, 6, 10, 19, 45).timestamp()) == 30
+    assert schedule.delay('a', datetime(2020, 6, 10, 20, 50).timestamp()) == 30
+    assert schedule.until_window('a', datetime(2020, 6, 10, 19, 0).timestamp()) == 1800
+
+
+def test_backoff_outside_window():
+    schedule = make_schedule()
+    now = datetime(2020, 6, 10, 10, 0).timestamp()
+    delays = [schedule.delay('a', now) for _ in range(6)]
+    assert delays == [120, 240, 480, 960, 1800, 1800]
+    # Never past the start of the window
+    assert schedule.delay('a', datetime(2020, 6, 10, 19, 20).timestamp()) == 600
+    # Back to the start once inside
+    schedule.delay('a', datetime(2020, 6, 10, 20, 0).timestamp())
+    assert schedule.delay('a', now) == 120
+
+
+def test_weekly_window():
+    schedule = make_schedule(days=0)
+    # Mondays only, for four weeks
+    for week in range(4):
+        schedule.add_start('a', datetime(2020, 6, 1, 20) + timedelta(weeks=week))
+    assert schedule.period('a') == WEEK
+    assert schedule.delay('a', datetime(2020, 7, 6, 20, 10).timestamp()) == 30
+    # Tuesday at the same time is outside
+    assert schedule.until_window('a', datetime(2020, 7, 7, 20, 10).timestamp()) == 6 * DAY - 40 * 60
+    assert schedule.describe('a') == 'Mon 20:00'
+
+
+def test_history_file(tmp_path):
+    store_path = str(tmp_path / 'history.json')
+    schedule = PollSchedule(store_path)
+    schedule.add_start('a', datetime(2020, 6, 1, 20))
+    # Restarted recording of the same stream
+    schedule.add_start('a', datetime(2020, 6, 1, 20))
+    with open(store_path) as fr:
+        assert len(json.load(fr)['a']) == 1
+    assert PollSchedule(store_path).history == schedule.history
@@ -0,0 +1,137 @@
+import asyncio
+
+from modules.encoder import Deferred, Job, Scheduler
+
+
+def make_job(name: str, **kwargs) -> Job:
+    return Job(input=f'{name}.flv', title=name, user='test', **kwargs)
+
+
+def test_slot_limits():
+    async def _run():
+        running = dict(copy=0, hevc=0)
+        peak = dict(copy=0, hevc=0)
+
+        async def run_func(job: Job):
+            running[job.enc_codec] += 1
+            peak[job.enc_codec] = max(peak[job.enc_codec], running[job.enc_codec])
+            await asyncio.sleep(0.01)
+            running[job.enc_codec] -= 1
+
+        sched = Scheduler(asyncio.get_running_loop(), run_func, slots=dict(copy=2, hevc=1))
+        sched.start()
+        futures = []
+        for i in range(6):
+            codec = 'hevc' if i % 2 else 'copy'
+            futures.append(sched.submit(make_job(str(i), enc_codec=codec), codec))
+        await asyncio.gather(*futures)
+        await sched.close()
+        return peak
+
+    peak = asyncio.run(_run())
+    assert peak == dict(copy=2, hevc=1)
+
+
+def test_priority_order():
+    async def _run():
+        order = []
+
+        async def run_func(job: Job):
+            order.append(job.title)
+
+        sched = Scheduler(asyncio.get_running_loop(), run_func, slots=dict(copy=1))
+        futures = [
+            sched.submit(make_job('low'), 'copy', priority=5),
+            sched.submit(make_job('first'), 'copy'),
+            sched.submit(make_job('second'), 'copy'),
+            sched.submit(make_job('urgent'), 'copy', priority=-1),
+        ]
+        status = sched.status()
+        sched.start()
+        await asyncio.gather(*futures)
+        await sched.close()
+        return order, status
+
+    order, status = asyncio.run(_run())
+    assert order == ['urgent', 'first', 'second', 'low']
+    assert len(status['queued']['copy']) == 4
+    assert status['slots'] == [dict(codec='copy', slot=0, busy=False)]
+
+
+def test_lease_expiry():
+    async def _run():
+        async def run_func(job: Job):
+            pass
+
+        expired = []
+        sched = Scheduler(asyncio.get_running_loop(), run_func, slots=dict(hevc=0), on_expire=expired.append)
+        sched.start()
+        first = sched.submit(make_job('first'), 'hevc')
+        sched.submit(make_job('second'), 'hevc')
+        assert sched.lease(['copy'], 'w1', 10) is None
+        lease = sched.lease(['copy', 'hevc'], 'w1', 0.5)
+        assert lease.job.title == 'first'
+        assert [j.title for j in sched.running()] == ['first']
+        assert sched.status()['leases'][0]['worker'] == 'w1'
+        # Lease runs out, first goes back ahead of second
+        await asyncio.sleep(1.6)
+        assert [j.title for j in expired] == ['first']
+        assert sched.renew(lease.id) is None
+        lease = sched.lease(['hevc'], 'w2', 10)
+        assert lease.job.title == 'first'
+        assert sched.renew(lease.id) is lease
+        assert sched.release(lease.id) is lease
+        assert sched.release(lease.id) is None
+        lease.fut.set_result(lease.job)
+        await first
+        await sched.close()
+
+    asyncio.run(_run())
+
+
+def test_deferred():
+    async def _run():
+        attempts = []
+
+        async def run_func(job: Job):
+            attempts.append(job.title)
+            if len(attempts) == 1:
+                raise Deferred('no space', 0.2)
+
+        sched = Scheduler(asyncio.get_running_loop(), run_func, slots=dict(copy=1))
+        sched.start()
+        fut = sched.submit(make_job('big'), 'copy')
+        await asyncio.sleep(0.1)
+        assert not fut.done()
+        assert sched.status()['deferred']['copy'] == ['big.flv']
+        await asyncio.wait_for(fut, 1)
+        await sched.close()
+        return attempts
+
+    assert asyncio.run(_run()) == ['big', 'big']
+
+
+def test_drain():
+    async def _run():
+        started = []
+
+        async def run_func(job: Job):
+            started.append(job.title)
+            await asyncio.sleep(0.05)
+
+        sched = Scheduler(asyncio.get_running_loop(), run_func, slots=dict(copy=1, hevc=1))
+        sched.start()
+        running = sched.submit(make_job('running'), 'copy')
+        sched.submit(make_job('waiting'), 'copy')
+        await asyncio.sleep(0.01)
+        sched.drain()
+        assert sched.lease(['copy'], 'w1', 10) is None
+        await asyncio.wait_for(sched.wait_idle(interval=0.01), 1)
+        await sched.close()
+        return started, running.done(), sched.status()
+
+    started, done, status = asyncio.run(_run())
+    assert started == ['running']
+    assert done
+    assert status['queued']['copy'] == ['waiting.flv']
+    assert status['draining']
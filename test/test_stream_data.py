@@ -36,3 +36,11 @@ def test_stream_data_manual():
     assert actual.user_logo == expected['user_logo']
     assert actual.title == expected['title']
     assert actual.url == expected['url']
+
+
+def test_stream_data_from_stream():
+    with open('samples/live_kraken.json', 'r') as fr:
+        data = json.load(fr)
+    actual = StreamData.from_stream(data['stream'])
+    assert actual.user_id == str(data['stream']['channel']['_id'])
+    assert actual.title == data['stream']['channel']['status']
@@ -0,0 +1,67 @@
+import asyncio
+import errno
+import hashlib
+import os
+
+import pytest
+
+from modules.encoder import FileTransfer
+
+DATA = os.urandom(300_000)
+
+
+def make_src(tmp_path) -> str:
+    src = str(tmp_path / 'enc_a.mkv')
+    with open(src, 'wb') as fw:
+        fw.write(DATA)
+    return src
+
+
+def run_move(src, dst, **kwargs):
+    async def _run():
+        reports = []
+        transfer = FileTransfer(asyncio.get_running_loop(), chunk_size=64 * 1024, **kwargs)
+        digest = await transfer.move(src, dst, progress=lambda done, total: reports.append((done, total)))
+        await asyncio.sleep(0)
+        return digest, reports
+    return asyncio.run(_run())
+
+
+@pytest.fixture
+def cross_device(monkeypatch):
+    def rename(*_):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'rename', rename)
+
+
+def test_rename(tmp_path):
+    """Renamed files are not read again to hash them"""
+    src = make_src(tmp_path)
+    dst = str(tmp_path / 'out.mkv')
+    digest, reports = run_move(src, dst, hash_name='sha256')
+    assert digest is None
+    assert not os.path.exists(src)
+    assert reports == [(len(DATA), len(DATA))]
+
+
+def test_copy(tmp_path, cross_device):
+    src = make_src(tmp_path)
+    dst = str(tmp_path / 'out.mkv')
+    digest, reports = run_move(src, dst, hash_name='sha256')
+    assert digest == hashlib.sha256(DATA).hexdigest()
+    assert not os.path.exists(src)
+    assert not os.path.exists(f'{dst}.part')
+    with open(dst, 'rb') as fr:
+        assert fr.read() == DATA
+    assert len(reports) == 5
+    assert reports[-1] == (len(DATA), len(DATA))
+
+
+def test_copy_no_hash(tmp_path, cross_device):
+    src = make_src(tmp_path)
+    dst = str(tmp_path / 'out.mkv')
+    digest, reports = run_move(src, dst)
+    assert digest is None
+    with open(dst, 'rb') as fr:
+        assert fr.read() == DATA
+    assert reports[-1] == (len(DATA), len(DATA))
@@ -0,0 +1,46 @@
+import asyncio
+from datetime import datetime
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from modules.encoder import EncoderWorker, Job
+from test.test_broadcast import make_encoder
+
+
+def test_release(tmp_path):
+    """A stopped worker gives its lease back, the job does not wait for it to expire"""
+    async def _run():
+        enc = make_encoder(tmp_path)
+        app = web.Application()
+        app.add_routes([
+            web.post('/worker/lease', enc.handler_lease),
+            web.post('/worker/heartbeat/{lease}', enc.handler_heartbeat),
+            web.post('/worker/result/{lease}', enc.handler_result),
+            web.post('/worker/release/{lease}', enc.handler_release),
+        ])
+        (tmp_path / 'src' / 'rec.flv').write_bytes(b'x')
+        job = Job(input='rec.flv', title='Some Hevc', user='user', created_at=datetime(2020, 1, 1),
+                  enc_codec='hevc', out_file='200101-0000_Some Hevc.mkv')
+        enc.store.save(job)
+        enc.scheduler.submit(job, 'hevc')
+        started = asyncio.Event()
+        async with TestServer(app) as server:
+            worker = EncoderWorker(asyncio.get_running_loop(), coordinator_url=str(server.make_url('')).rstrip('/'),
+                                   src_path=str(tmp_path / 'src'), poll_interval=0.1, log_parent='test')
+
+            async def fake_encode(*_args):
+                started.set()
+                await asyncio.sleep(60)
+            worker.encode = fake_encode
+            task = asyncio.get_running_loop().create_task(worker.run())
+            await asyncio.wait_for(started.wait(), 5)
+            assert enc.scheduler.leases and job.worker == worker.name
+            worker.signal_handler()
+            await task
+        status = enc.scheduler.status()
+        await enc.close()
+        return job, status
+    job, status = asyncio.run(_run())
+    assert not status['leases'] and status['queued']['hevc'] == ['rec.flv']
+    assert job.enc_start is None and job.worker is None and not job.error
@@ -5,7 +5,8 @@ import os
 import re
 from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
-from typing import AsyncIterable, Union
+from collections import OrderedDict
+from typing import AsyncIterable, Callable, Dict, Optional, Union
 
 try:
     import cv2
@@ -19,42 +20,220 @@ re_watch = {
     'total_size': re.compile(r'total_size=(\d+)'),
     'out_time': re.compile(r'out_time=(\d{1,2}:\d{2}:\d{2}\.\d+)')
 }
+re_speed = re.compile(r'speed=\s*(\d+\.?\d*)x')
+re_progress = re.compile(r'progress=(\w+)')
 re_duration = re.compile(r'(?P<h>\d{1,2}):(?P<m>\d{2}):(?P<s>\d{2})\.(?P<ms>\d+)')
 
 
 def parse_duration(time_str: str):
     """Parse HH:MM:SS.MICROSECONDS to timedelta"""
     if m := re_duration.match(time_str):
-        return timedelta(hours=int(m.group('h')), minutes=int(m.group('m')), seconds=int(m.group('s')))
+        return timedelta(hours=int(m.group('h')), minutes=int(m.group('m')), seconds=int(m.group('s')),
+                         microseconds=int(m.group('ms')[:6].ljust(6, '0')))
     return None
 
 
-async def read_video_info(vid_fp: str, logger=None):
-    """Returns video duration (as timedelta) using ffprobe"""
-    args = ['-v', 'quiet', '-print_format', 'json', '-show_streams', '-sexagesimal', vid_fp]
-    p = await asyncio.create_subprocess_exec('ffprobe', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    stdout, _ = await p.communicate()
-    if p.returncode != 0:
-        err = f'Cannot get video info for {vid_fp}'
-        if logger:
-            logger.error(err)
-        else:
-            print(err)
-        return
-    # Find duration
-    metadata = json.loads(stdout.decode())
-    for stream in metadata['streams']:
-        if stream['codec_type'] != 'video':
-            continue
-        # Good for H264
-        dur = stream.get('duration')
-        # H265
-        if dur is None and stream.get('tags') is not None:
-            dur = stream['tags'].get('DURATION')
-        if dur is None:
+class ProbeCache:
+    """
+    Caches ffprobe results, keyed by path, size and modified time
+
+    Least recently used entries are evicted after max_size, if store_path is given
+    the cache is also kept on disk as JSON. Changes are written at most every
+    save_delay seconds in an executor, close writes the last ones. Concurrent
+    probes of the same file share one ffprobe process.
+
+    Cached info dict:
+        format, streams: as returned by ffprobe -show_format -show_streams -sexagesimal
+        duration: video duration in seconds or None
+        codec: video codec name or None
+        keyframes: number of video keyframes, only counted when requested
+    """
+    def __init__(self, max_size: int = 256, store_path: str = None, save_delay: float = 5):
+        self.max_size: int = max_size
+        self.store_path: Optional[str] = store_path
+        self.save_delay: float = save_delay
+        self._cache: 'OrderedDict[str, dict]' = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._save_task: Optional[asyncio.Task] = None
+        # Set by close, made with the writer task since probe_cache is created before any loop runs
+        self._flush: Optional[asyncio.Event] = None
+        self._dirty: bool = False
+        if store_path and os.path.exists(store_path):
+            try:
+                with open(store_path, 'r', encoding='utf-8') as fr:
+                    self._cache.update(json.load(fr))
+            except Exception as e:
+                print(f'Cannot read probe cache {store_path}: {e}')
+
+    @staticmethod
+    def cache_key(vid_fp: str) -> str:
+        """Raises FileNotFoundError if vid_fp does not exist"""
+        st = os.stat(vid_fp)
+        return f'{os.path.abspath(vid_fp)}:{st.st_size}:{st.st_mtime_ns}'
+
+    def _write(self, data: dict):
+        tmp_path = f'{self.store_path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as fw:
+                json.dump(data, fw)
+            os.replace(tmp_path, self.store_path)
+        except OSError as e:
+            print(f'Cannot write probe cache {self.store_path}: {e}')
+
+    def _save(self):
+        """Write the cache after save_delay, changes until then are written with it"""
+        if not self.store_path:
             return
-        return parse_duration(dur)
-    return
+        self._dirty = True
+        if not self._save_task:
+            self._save_task = asyncio.get_event_loop().create_task(self._delayed_save())
+
+    async def _delayed_save(self):
+        if self._flush is None:
+            self._flush = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._flush.wait(), self.save_delay)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            while self._dirty:
+                self._dirty = False
+                # Cached entries are never changed, a copy of the order is enough
+                await asyncio.get_event_loop().run_in_executor(None, self._write, dict(self._cache))
+        finally:
+            # The next save waits the whole delay again, on an event of its own loop
+            self._flush = None
+            self._save_task = None
+
+    async def close(self):
+        """Write pending changes now"""
+        if self._save_task:
+            # The task may not have run yet
+            if self._flush is None:
+                self._flush = asyncio.Event()
+            self._flush.set()
+            await self._save_task
+
+    async def probe(self, vid_fp: str, keyframes=False, logger: logging.Logger = None) -> Optional[dict]:
+        """Returns probed info of vid_fp, None if ffprobe fails"""
+        key = self.cache_key(vid_fp)
+        info = self._cache.get(key)
+        if info is not None and (not keyframes or info.get('keyframes') is not None):
+            self._cache.move_to_end(key)
+            return info
+        pending_key = f'{key}:{keyframes}'
+        if pending_key in self._pending:
+            return await asyncio.shield(self._pending[pending_key])
+        fut = asyncio.get_event_loop().create_future()
+        self._pending[pending_key] = fut
+        try:
+            if info is None:
+                info = await self._run_probe(vid_fp, logger)
+            if info is not None and keyframes:
+                # A new dict, the cached one may be being written
+                info = dict(info, keyframes=await self._count_keyframes(vid_fp, logger))
+            if info is not None:
+                self._cache[key] = info
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+                self._save()
+            fut.set_result(info)
+            return info
+        except Exception as e:
+            fut.set_exception(e)
+            # Nobody else might be waiting for it
+            fut.exception()
+            raise
+        finally:
+            self._pending.pop(pending_key, None)
+
+    @staticmethod
+    async def _ffprobe(args: list, vid_fp: str, logger: logging.Logger = None) -> Optional[dict]:
+        p = await asyncio.create_subprocess_exec('ffprobe', *args, vid_fp, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, _ = await p.communicate()
+        if p.returncode != 0:
+            err = f'Cannot get video info for {vid_fp}'
+            if logger:
+                logger.error(err)
+            else:
+                print(err)
+            return None
+        return json.loads(stdout.decode())
+
+    async def _run_probe(self, vid_fp: str, logger: logging.Logger = None) -> Optional[dict]:
+        args = ['-v', 'quiet', '-print_format', 'json', '-show_streams', '-show_format', '-sexagesimal']
+        metadata = await self._ffprobe(args, vid_fp, logger)
+        if metadata is None:
+            return None
+        info = dict(format=metadata.get('format', {}), streams=metadata.get('streams', []),
+                    duration=None, codec=None, keyframes=None)
+        for stream in info['streams']:
+            if stream['codec_type'] != 'video':
+                continue
+            info['codec'] = stream.get('codec_name')
+            # Good for H264
+            dur = stream.get('duration')
+            # H265
+            if dur is None and stream.get('tags') is not None:
+                dur = stream['tags'].get('DURATION')
+            # FLV, only the container has a duration
+            if dur is None:
+                dur = info['format'].get('duration')
+            if dur is not None and (td := parse_duration(dur)) is not None:
+                info['duration'] = td.total_seconds()
+            break
+        return info
+
+    async def _count_keyframes(self, vid_fp: str, logger: logging.Logger = None) -> Optional[int]:
+        """Decodes keyframes only, still has to read the whole file"""
+        args = ['-v', 'quiet', '-print_format', 'json', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+                '-count_frames', '-show_entries', 'stream=nb_read_frames']
+        metadata = await self._ffprobe(args, vid_fp, logger)
+        try:
+            return int(metadata['streams'][0]['nb_read_frames'])
+        except (TypeError, KeyError, IndexError, ValueError):
+            return None
+
+
+probe_cache = ProbeCache()
+
+
+async def read_video_info(vid_fp: str, logger=None, cache: ProbeCache = None):
+    """Returns video duration (as timedelta) using ffprobe, results are cached in cache or probe_cache"""
+    try:
+        info = await (cache or probe_cache).probe(vid_fp, logger=logger)
+    except FileNotFoundError:
+        info = None
+    if not info or info['duration'] is None:
+        if info is None:
+            err = f'Cannot get video info for {vid_fp}'
+            if logger:
+                logger.error(err)
+            else:
+                print(err)
+        return None
+    return timedelta(seconds=info['duration'])
+
+
+async def read_video_fps(vid_fp: str, logger=None, cache: ProbeCache = None) -> Optional[float]:
+    """Returns the frame rate of the first video stream, results are cached in cache or probe_cache"""
+    try:
+        info = await (cache or probe_cache).probe(vid_fp, logger=logger)
+    except FileNotFoundError:
+        return None
+    for stream in (info or {}).get('streams', []):
+        if stream.get('codec_type') != 'video':
+            continue
+        for rate in (stream.get('avg_frame_rate'), stream.get('r_frame_rate')):
+            try:
+                num, den = (int(v) for v in rate.split('/'))
+            except (AttributeError, ValueError):
+                continue
+            if num and den:
+                return num / den
+        break
+    return None
 
 
 def read_video_info_cv2(vid_fp: str):
@@ -69,11 +248,30 @@ def read_video_info_cv2(vid_fp: str):
     # return timedelta(milliseconds=total_ms)
 
 
-async def run_ffmpeg(logger: logging.Logger, args: list, print_every: int = 30):
+async def run_ffmpeg(logger: logging.Logger, args: list, print_every: int = 30, progress: Callable[[dict], None] = None,
+                     preexec_fn: Callable[[], None] = None, on_start: Callable[[int], None] = None):
+    """
+    Run ffmpeg, progress is passed on to watch_ffmpeg.
+    preexec_fn runs in the child before ffmpeg starts, on_start is called with its PID.
+    """
     logger.debug('CMD: ffmpeg %s', ' '.join(args))
-    p = await asyncio.create_subprocess_exec('ffmpeg', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    p = await asyncio.create_subprocess_exec('ffmpeg', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                             preexec_fn=preexec_fn)
+    if on_start:
+        on_start(p.pid)
     try:
-        await asyncio.gather(watch_ffmpeg(logger, p.stdout, print_every), watch_ffmpeg(logger, p.stderr, print_every))
+        await asyncio.gather(watch_ffmpeg(logger, p.stdout, print_every, progress),
+                             watch_ffmpeg(logger, p.stderr, print_every, progress))
+    except asyncio.CancelledError:
+        # Do not leave ffmpeg running on its own, give it a moment to exit cleanly
+        if p.returncode is None:
+            p.terminate()
+            try:
+                await asyncio.wait_for(p.wait(), 5)
+            except asyncio.TimeoutError:
+                p.kill()
+                await p.wait()
+        raise
     except Exception as e:
         logger.critical('stdout/err critical failure: %s', str(e))
     await p.wait()
@@ -81,16 +279,31 @@ async def run_ffmpeg(logger: logging.Logger, args: list, print_every: int = 30):
         raise Exception(f'ffmpeg exit code: {p.returncode}')
 
 
-async def watch_ffmpeg(logger: logging.Logger, stream: Union[AsyncIterable, asyncio.StreamReader], print_every: int = 30):
+async def watch_ffmpeg(logger: logging.Logger, stream: Union[AsyncIterable, asyncio.StreamReader], print_every: int = 30,
+                       progress: Callable[[dict], None] = None):
+    """
+    Parse ffmpeg -progress output, log it every print_every seconds of output time
+
+    If given, progress is called at the end of every progress block with the
+    raw string values of frame, fps, total_size, out_time, speed and progress.
+    """
     last_time = 0
     parsed_dict = {}
+    sample = {}
     try:
         async for line in stream:
+            line = line.decode()
             # Add found value to parsed_dict
             for name, regxp in re_watch.items():
-                if m := regxp.match(line.decode()):
+                if m := regxp.match(line):
                     parsed_dict[name] = m.group(1)
+                    sample[name] = m.group(1)
                     break
+            else:
+                if m := re_speed.match(line):
+                    sample['speed'] = m.group(1)
+                elif progress is not None and (m := re_progress.match(line)):
+                    progress(dict(sample, progress=m.group(1)))
             if len(parsed_dict) == len(re_watch):
                 # Log every print_every seconds
                 curr_time = parse_duration(parsed_dict['out_time'])